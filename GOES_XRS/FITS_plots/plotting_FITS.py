@@ -4,6 +4,9 @@ from astropy.io import fits
 from matplotlib import pyplot as plt
 from scipy import stats as st
 import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from fits_cache import FitsCache
 
 
 flare_fits = '../GOES_XRS_historical_finalversion.fits'
@@ -11,9 +14,7 @@ flare_fits = '../GOES_XRS_historical_finalversion.fits'
 class FITS_plots:
     
     def __init__(self, flare_fits):
-        fitsfile = fits.open(flare_fits)
-        self.data = fitsfile[1].data
-        self.header = fitsfile[1].header
+        self.data = FitsCache(flare_fits).load()
         
     def plot_one(self, i):
         xrsa = self.data['xrsa'][i]
@@ -141,11 +142,12 @@ class FITS_plots:
         belowmask = np.where(self.data['above c5']==False)[0]
         below_c5 = self.data['xrsa'][belowmask]
      
-        above_c5_lengths = [len(above_c5[i])-30 for i, data in enumerate(above_c5)]
-        both_length = len(np.where(np.array(above_c5_lengths) > 60)[0])
-        below_c5_lengths = [len(below_c5[i])-30 for i, data in enumerate(below_c5)]
-        total_lengths = [len(self.data['xrsa'][i])-30 for i, data in enumerate(self.data['xrsa'])]
-        duration_above_60 = len(np.where(np.array(total_lengths) > 60)[0])
+        #the lengths come straight from the FlareSeries offsets (minus the 15 min padding on each side)
+        above_c5_lengths = above_c5.lengths - 30
+        both_length = len(np.where(above_c5_lengths > 60)[0])
+        below_c5_lengths = below_c5.lengths - 30
+        total_lengths = self.data['xrsa'].lengths - 30
+        duration_above_60 = len(np.where(total_lengths > 60)[0])
         fig, ax = plt.subplots(1,1, figsize=(8,6))
         ax.hist([below_c5_lengths, above_c5_lengths], bins=25, range=(0, 250), stacked=True, color=['b', 'r'], label=['Below C5', 'Above C5'])
         #ax.hist(above_c5_lengths, range=(0, 250), color='r', stacked=True)
@@ -157,7 +159,7 @@ class FITS_plots:
         plt.savefig('duration_histogram.png', dpi=250)
         plt.show()
         
-        self.long_ones = np.where(np.array(total_lengths) > 200)[0]
+        self.long_ones = np.where(total_lengths > 200)[0]
         #plt.show()
         
     def long_plots(self):
@@ -0,0 +1,137 @@
+import numpy as np
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from flare_series import FlareSeries
+
+
+class CancellationRule:
+    ''' When a launch is cancelled: if a light curve went down between the reference (lookback samples before the
+    check) and the check, check_offset samples after the trigger. The usual rule (xrsa lower 3 minutes after the
+    trigger than at the trigger) is CancellationRule().
+
+    Input:
+    channel = light curve column of the flare FITS file ('xrsa', 'xrsb', 'em'), or 'temp' for xrsa/xrsb.
+    check_offset = samples after the trigger where the check is done. None uses the launch timing's cancellation_offset
+        (see observation_windows.LaunchTiming), which is 3 usually.
+    lookback = samples before the check that it is compared to. None is the same as check_offset, so the check is
+        compared to the trigger sample.
+    reference = 'point' compares to the sample lookback samples before the check, 'max'/'mean' to the max/mean of the
+        lookback samples before the check (so 'max' cancels on any decline from the recent peak).
+    tolerance = how much lower (relative to the reference) the check has to be to cancel. 0 cancels on any decline.
+    name = name of the rule in the score files (made from the settings if None).
+
+    The lookback is cut off at the flare start (the same way the observation windows are cut off at the flare end), so
+    a trigger close to the flare start is compared to the samples it does have. Launches where the check is past the
+    end of the flare are not checked (Cancelled? is NaN), the same as the usual rule. The check has to come before the
+    HiC start (see LaunchTiming.check_cancellation_rule), so those launches never have HiC data and are dropped.
+    '''
+
+    references = ('point', 'max', 'mean')
+
+    def __init__(self, channel='xrsa', check_offset=None, lookback=None, reference='point', tolerance=0, name=None):
+        if reference not in self.references:
+            raise ValueError(f'reference has to be one of {self.references}, not {reference}!')
+        if lookback is not None and lookback < 1:
+            raise ValueError('lookback has to be at least 1 sample!')
+        self.channel = channel
+        self.check_offset = check_offset
+        self.lookback = lookback
+        self.reference = reference
+        self.tolerance = tolerance
+        self.name = name if name is not None else self.make_name()
+
+    def make_name(self):
+        check = 'timing' if self.check_offset is None else self.check_offset
+        lookback = 'trigger' if self.lookback is None else f'{self.lookback}min'
+        return f'{self.channel} {self.reference} {lookback} check {check} tol {self.tolerance:g}'
+
+    def __repr__(self):
+        return f'CancellationRule({self.name!r})'
+
+    def find_offsets(self, default_check_offset):
+        check_offset = default_check_offset if self.check_offset is None else self.check_offset
+        lookback = check_offset if self.lookback is None else self.lookback
+        if check_offset < 1:
+            raise ValueError(f'The cancellation check of {self.name} has to be at least 1 sample after the trigger!')
+        return check_offset, lookback
+
+
+class CancellationTable:
+    ''' Evaluates a list of cancellation rules for many launches at once. A launch is given by its position in the flat
+    FlareSeries buffer (flare offset + trigger index), so every rule is a couple of gathers, and the rolling max/mean
+    the 'max'/'mean' references need are made once per (channel, lookback) over the whole buffer.
+
+    Input:
+    flare_data = the flare FITS columns (FitsCache, SharedDataset.flare_table() or similar).
+    rules = list of CancellationRule.
+    '''
+
+    def __init__(self, flare_data, rules):
+        self.data = flare_data
+        self.rules = list(rules)
+        self.channels = {}
+        self.positions = {}
+        self.rolled = {}
+
+    def channel(self, name):
+        if name not in self.channels:
+            if name == 'temp':
+                self.channels[name] = self.channel('xrsa')/self.channel('xrsb')
+            else:
+                self.channels[name] = FlareSeries.from_arrays(self.data[name]).astype(float)
+        return self.channels[name]
+
+    def flare_positions(self, name):
+        ''' (flat index of the flare end, index within the flare) of every sample of a channel. FlareSeries makes these
+        again every time they are asked for, so they are kept here.
+        '''
+        if name not in self.positions:
+            series = self.channel(name)
+            self.positions[name] = (series.flare_ends, series.sample_index)
+        return self.positions[name]
+
+    def rolling(self, name, lookback, func):
+        ''' func ('max' or 'mean') of the lookback samples ending at every sample, cut off at the flare start.
+
+        Every flare is cut into blocks of lookback samples, and func is run forwards and backwards inside every block
+        (one accumulate over a (blocks, lookback) array each way). A window is then either the start of one block, or
+        the end of one block and the start of the next, so it is at most two lookups.
+        '''
+        if (name, lookback, func) not in self.rolled:
+            values = self.channel(name).values
+            _, sample_index = self.flare_positions(name)
+            combine = np.maximum if func == 'max' else np.add
+            in_block = sample_index % lookback
+            blocks = np.cumsum(in_block == 0) - 1
+            padded = np.full((blocks[-1] + 1 if len(blocks) > 0 else 0, lookback), -np.inf if func == 'max' else 0.)
+            padded[blocks, in_block] = values
+            forward = combine.accumulate(padded, axis=1)[blocks, in_block]
+            backward = combine.accumulate(padded[:, ::-1], axis=1)[:, ::-1][blocks, in_block]
+            n_samples = np.minimum(sample_index, lookback - 1) + 1
+            starts = np.arange(len(values)) - n_samples + 1
+            rolled = np.where(blocks[starts] == blocks, forward, combine(backward[starts], forward))
+            self.rolled[(name, lookback, func)] = rolled if func == 'max' else rolled/n_samples
+        return self.rolled[(name, lookback, func)]
+
+    def find_cancellations(self, positions, default_check_offset=3):
+        ''' (has a cancellation check, cancelled) arrays with shape (rules, launches), for launches at the flat buffer
+        positions.
+        '''
+        positions = np.asarray(positions, dtype=np.int64)
+        has_check = np.zeros((len(self.rules), len(positions)), dtype=bool)
+        cancelled = np.zeros((len(self.rules), len(positions)), dtype=bool)
+        for r, rule in enumerate(self.rules):
+            values = self.channel(rule.channel).values
+            flare_ends, sample_index = self.flare_positions(rule.channel)
+            check_offset, lookback = rule.find_offsets(default_check_offset)
+            checks = positions + check_offset
+            has_check[r] = checks < flare_ends[positions]
+            checked = np.flatnonzero(has_check[r])
+            if rule.reference == 'point':
+                flare_starts = positions[checked] - sample_index[positions[checked]]
+                reference = values[np.maximum(checks[checked] - lookback, flare_starts)]
+            else:
+                reference = self.rolling(rule.channel, lookback, rule.reference)[checks[checked] - 1]
+            cancelled[r, checked] = (values[checks[checked]] - reference) < -rule.tolerance*np.abs(reference)
+        return has_check, cancelled
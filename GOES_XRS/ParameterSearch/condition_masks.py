@@ -0,0 +1,208 @@
+import numpy as np
+from collections import OrderedDict
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from flare_series import run_lengths
+from trigger_engines import flatten_flare_arrays
+
+#number of zero bits before the first set bit of a byte (np.packbits puts the first sample in the highest bit)
+LEADING_ZEROS = np.array([8 - b.bit_length() for b in range(256)], dtype=np.int64)
+#number of set bits in a byte
+BIT_COUNTS = np.array([bin(b).count('1') for b in range(256)], dtype=np.int64)
+#name of the grid column with the minutes a condition has to hold for (see find_persistence_columns)
+PERSISTENCE_SUFFIX = ' persistence'
+
+
+def persistence_name(name):
+    return f'{name}{PERSISTENCE_SUFFIX}'
+
+
+def find_persistence_columns(parameter_names):
+    ''' Splits the grid columns into conditions (parameter >= value) and persistences ('{name} persistence' = samples in 
+    a row the condition of name has to hold for before it counts).
+
+    Returns (names of the conditions, combination column of each condition's persistence, -1 if it has none).
+    '''
+    parameter_names = list(parameter_names)
+    condition_names = [name for name in parameter_names if not name.endswith(PERSISTENCE_SUFFIX)]
+    persistence_columns = np.full(len(condition_names), -1, dtype=np.int64)
+    for column, name in enumerate(parameter_names):
+        if name.endswith(PERSISTENCE_SUFFIX):
+            condition = name[:-len(PERSISTENCE_SUFFIX)]
+            if condition not in condition_names:
+                raise ValueError(f'{name} is the persistence of {condition}, which is not one of the parameters!')
+            persistence_columns[condition_names.index(condition)] = column
+    return condition_names, persistence_columns
+
+
+def first_set_bit_per_segment(packed, offsets):
+    ''' Finds the first set bit of each flare (segment) in a packed bitset over the flat time axis, without unpacking it.
+    Flares don't start on byte boundaries, so the bits before the flare start are masked off in its first byte, and
+    otherwise the next non-zero byte is looked up.
+
+    Returns:
+    array of the index (within the flare) of the first set bit. -1 if there is none.
+    '''
+    starts = offsets[:-1]
+    ends = offsets[1:]
+    first = np.full(len(starts), -1, dtype=np.int64)
+    nonzero_bytes = np.flatnonzero(packed)
+    if len(nonzero_bytes) == 0:
+        return first
+    first_byte = np.minimum(starts//8, len(packed) - 1)
+    first_byte_bits = packed[first_byte] & (0xFF >> (starts % 8))
+    next_nonzero = np.minimum(np.searchsorted(nonzero_bytes, first_byte + 1), len(nonzero_bytes) - 1)
+    next_byte = nonzero_bytes[next_nonzero]
+    next_position = np.where(next_byte > first_byte, 8*next_byte + LEADING_ZEROS[packed[next_byte]], ends)
+    position = np.where(first_byte_bits > 0, 8*first_byte + LEADING_ZEROS[first_byte_bits], next_position)
+    found = (position >= starts) & (position < ends)
+    first[found] = position[found] - starts[found]
+    return first
+
+
+class ConditionMaskCache:
+    ''' Keeps the packed bitset of each (parameter, value) condition (parameter column >= value over the flat time
+    axis), so that each condition is only checked once, no matter how many combinations it shows up in. The least
+    recently used masks are dropped once the cache goes over memory_budget bytes.
+
+    A condition can also have a persistence (it has to hold for that many samples in a row, within the flare). The run
+    lengths of a (parameter, value) condition are found once with a cumulative pass (flare_series.run_lengths) and 
+    cached too, so every persistence of it is only a comparison, not another pass over the samples.
+    '''
+
+    def __init__(self, columns, memory_budget=2**29, offsets=None):
+        self.columns = columns
+        self.offsets = offsets
+        self.memory_budget = memory_budget
+        self.masks = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get_mask(self, k, value, persistence=1):
+        key = (k, float(value)) if persistence <= 1 else (k, float(value), int(persistence))
+        if key in self.masks:
+            self.hits += 1
+            self.masks.move_to_end(key)
+            return self.masks[key]
+        self.misses += 1
+        if persistence <= 1:
+            mask = np.packbits(self.columns[k] >= value)
+        else:
+            mask = np.packbits(self.get_run_lengths(k, value) >= persistence)
+        self.remember(key, mask)
+        return mask
+
+    def get_run_lengths(self, k, value):
+        ''' Samples in a row (up to and including each sample) that parameter k has been >= value, capped at the int16
+        max so they take a quarter of the memory.
+        '''
+        key = ('run lengths', k, float(value))
+        if key in self.masks:
+            self.masks.move_to_end(key)
+            return self.masks[key]
+        runs = run_lengths(self.columns[k] >= value, self.offsets)[0]
+        runs = np.minimum(runs, np.iinfo(np.int16).max).astype(np.int16)
+        self.remember(key, runs)
+        return runs
+
+    def remember(self, key, mask):
+        self.masks[key] = mask
+        self.nbytes += mask.nbytes
+        while self.nbytes > self.memory_budget and len(self.masks) > 1:
+            _, evicted = self.masks.popitem(last=False)
+            self.nbytes -= evicted.nbytes
+            self.evictions += 1
+        return mask
+
+
+class BitsetTriggerEngine:
+    ''' Finds the first trigger index of every (combination, flare) pair by AND-ing the cached condition bitsets of the
+    combination, and finding the first set bit of each flare.
+
+    Input:
+    parameter_arrays = one FlareSeries per parameter (or per-flare tuples of arrays), same as used by ParameterSearch.
+    memory_budget = max bytes kept in the condition mask cache.
+    persistence_columns = combination column of the persistence of every parameter (-1 for none, see 
+        find_persistence_columns). None if the combinations are only the parameter values.
+    '''
+
+    def __init__(self, parameter_arrays, memory_budget=2**29, persistence_columns=None):
+        columns, self.offsets = flatten_flare_arrays(parameter_arrays)
+        self.n_flares = len(self.offsets) - 1
+        self.mask_cache = ConditionMaskCache(columns, memory_budget, self.offsets)
+        self.persistence_columns = np.full(len(columns), -1) if persistence_columns is None else np.asarray(persistence_columns)
+
+    def find_combination_trigger_indices(self, parameter):
+        persistences = np.where(self.persistence_columns >= 0, np.asarray(parameter)[self.persistence_columns], 1)
+        combined = self.mask_cache.get_mask(0, parameter[0], persistences[0]).copy()
+        for k in range(1, len(self.persistence_columns)):
+            combined &= self.mask_cache.get_mask(k, parameter[k], persistences[k])
+        return first_set_bit_per_segment(combined, self.offsets)
+
+    def find_trigger_indices(self, parameter_combinations):
+        ''' Returns a (combinations, flares) array of trigger indices, with -1 where the flare never triggers.
+        '''
+        combos = np.atleast_2d(parameter_combinations)
+        trigger_indices = np.empty((len(combos), self.n_flares), dtype=np.int64)
+        for j, parameter in enumerate(combos):
+            trigger_indices[j] = self.find_combination_trigger_indices(parameter)
+        return trigger_indices
+
+
+class TrieTriggerEngine:
+    ''' Walks the parameter combinations as a trie (one level per parameter), so the AND of the first k conditions is
+    done once and reused by every combination that starts with those values. Each full combination then only costs one
+    more AND.
+
+    The parameters are ordered so the most selective one (fewest samples meeting its values) is at the top, which makes
+    prefixes empty out early. Within a level the values go up, and since x >= a larger value is a subset of x >= a
+    smaller one, once a prefix mask is empty every combination below it and below every larger value of that level can
+    never trigger, so that whole part of the trie is skipped.
+    '''
+
+    def __init__(self, parameter_arrays, memory_budget=2**29):
+        columns, self.offsets = flatten_flare_arrays(parameter_arrays)
+        self.n_flares = len(self.offsets) - 1
+        self.mask_cache = ConditionMaskCache(columns, memory_budget)
+        self.no_trigger = np.full(self.n_flares, -1, dtype=np.int64)
+        self.skipped_combinations = 0
+
+    def order_by_selectivity(self, combos):
+        ''' Orders the parameters by the mean fraction of samples that meet their values, smallest first.
+        '''
+        n_samples = self.offsets[-1]
+        selectivity = []
+        for k in range(combos.shape[1]):
+            set_bits = [BIT_COUNTS[self.mask_cache.get_mask(k, value)].sum() for value in np.unique(combos[:, k])]
+            selectivity.append(np.mean(set_bits)/max(n_samples, 1))
+        return np.argsort(selectivity, kind='stable')
+
+    def iterate_trigger_indices(self, parameter_combinations):
+        ''' Yields (row of the combination, trigger indices of every flare) for every combination, in trie order.
+        '''
+        combos = np.atleast_2d(parameter_combinations)
+        self.order = self.order_by_selectivity(combos)
+        rows = np.lexsort([combos[:, k] for k in reversed(self.order)])
+        yield from self.walk(combos, rows, 0, None)
+
+    def walk(self, combos, rows, depth, prefix):
+        k = self.order[depth]
+        unique_values, value_starts = np.unique(combos[rows, k], return_index=True)
+        value_ends = np.append(value_starts[1:], len(rows))
+        for value, start, end in zip(unique_values, value_starts, value_ends):
+            mask = self.mask_cache.get_mask(k, value)
+            node = mask.copy() if prefix is None else prefix & mask
+            if not node.any():
+                self.skipped_combinations += len(rows) - start
+                for row in rows[start:]:
+                    yield row, self.no_trigger
+                return
+            if depth == len(self.order) - 1:
+                trigger_indices = first_set_bit_per_segment(node, self.offsets)
+                for row in rows[start:end]:
+                    yield row, trigger_indices
+            else:
+                yield from self.walk(combos, rows[start:end], depth + 1, node)
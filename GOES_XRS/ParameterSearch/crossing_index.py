@@ -0,0 +1,78 @@
+import numpy as np
+import os
+import re
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from flare_series import FlareSeries
+
+
+class CrossingIndex:
+    ''' Running maximum of every flare for one parameter column, so the first index where a flare crosses any threshold
+    comes from a binary search instead of a scan of the whole array. The running maximum only goes up, so the first
+    index where the array is >= threshold is the first index where the running maximum is >= threshold.
+
+    The index of a column that was loaded from the FitsCache or FeatureStore is saved next to the FITS file, in
+    crossing_indices/{FITS name}/{FITS sha1}/{column}.npz, so it is only built once per column. The FITS sha1 comes
+    from the cache manifest (FlareSeries.source), so the column never has to be hashed again, and a changed FITS file
+    gets new indices. Columns with no source (computed in the search) are only indexed in memory.
+    '''
+
+    def __init__(self, running_max, offsets, first_valid):
+        self.running_max = running_max
+        self.offsets = offsets
+        self.first_valid = first_valid
+        self.n_flares = len(offsets) - 1
+
+    @classmethod
+    def build(cls, values, offsets):
+        ''' Makes the index from a flat column and its flare offsets. The running maximum is NaN until the first real 
+        value of a flare, so the (flat) index of that first real value is saved too, and the search starts there.
+        '''
+        running_max = FlareSeries(values, offsets).cummax().values
+        nan_cumsum = np.concatenate([[0], np.cumsum(np.isnan(running_max))])
+        first_valid = offsets[:-1] + nan_cumsum[offsets[1:]] - nan_cumsum[offsets[:-1]]
+        return cls(running_max, offsets, first_valid)
+
+    @staticmethod
+    def index_file(source):
+        fits_file, sha1, column_name = source
+        fits_name = os.path.splitext(os.path.basename(fits_file))[0]
+        file_name = re.sub(r'[^\w.-]+', '_', column_name)
+        return os.path.join(os.path.dirname(fits_file), 'crossing_indices', fits_name, sha1[:16], f'{file_name}.npz')
+
+    @classmethod
+    def load_or_build(cls, feature_arrays):
+        ''' Loads the saved index of this column (a FlareSeries, or one array per flare) if there is one, otherwise
+        builds it, and saves it if the column has a source.
+        '''
+        feature_series = FlareSeries.from_arrays(feature_arrays)
+        index_file = None if feature_series.source is None else cls.index_file(feature_series.source)
+        if index_file is not None and os.path.exists(index_file):
+            saved = np.load(index_file)
+            return cls(saved['running_max'], saved['offsets'], saved['first_valid'])
+        crossing_index = cls.build(np.asarray(feature_series.values, dtype=float), feature_series.offsets)
+        if index_file is not None:
+            os.makedirs(os.path.dirname(index_file), exist_ok=True)
+            #written under a temporary name and swapped in, so other processes never load half a file
+            temp_file = f'{index_file}.{os.getpid()}.npz'
+            np.savez(temp_file, running_max=crossing_index.running_max, offsets=crossing_index.offsets, 
+                            first_valid=crossing_index.first_valid)
+            os.replace(temp_file, index_file)
+        return crossing_index
+
+    def first_crossing(self, threshold, strict=False):
+        ''' Returns the first index of every flare where the array is >= threshold (> threshold if strict), or -1 if it
+        never gets there. This is a binary search done for all flares at once.
+        '''
+        starts = self.offsets[:-1]
+        lo = self.first_valid.copy()
+        hi = self.offsets[1:].copy()
+        last = max(len(self.running_max) - 1, 0)
+        while np.any(lo < hi):
+            searching = lo < hi
+            mid = (lo + hi)//2
+            mid_value = self.running_max[np.minimum(mid, last)]
+            below = (mid_value <= threshold) if strict else (mid_value < threshold)
+            lo = np.where(searching & below, mid + 1, lo)
+            hi = np.where(searching & ~below, mid, hi)
+        return np.where(lo < self.offsets[1:], lo - starts, -1)
@@ -0,0 +1,23 @@
+import numpy as np
+
+#launch states of a flare, following what ParameterSearch saves and SaveScores counts (see
+#ObservationWindowTable.launch_states, which decides them)
+NO_TRIGGER = 0
+CANCELLED = 1
+LAUNCH_OBSERVED = 2
+LAUNCH_NOT_OBSERVED = 3
+
+#confusion matrix box for each (launch state + 4*above C5)
+CONFUSION_COLUMNS = ('TN', 'TN_canc', 'TP_noc5', 'FP_noc5', 'FN', 'FN_canc', 'TP', 'FP_c5')
+
+
+def confusion_category(states, above_c5):
+    ''' Index into CONFUSION_COLUMNS for each flare's launch state and above C5 truth.
+    '''
+    return np.asarray(states) + 4*np.asarray(above_c5, dtype=int)
+
+
+def confusion_counts(states, above_c5):
+    ''' Counts how many flares land in each confusion matrix box (in the order of CONFUSION_COLUMNS).
+    '''
+    return np.bincount(confusion_category(states, above_c5), minlength=len(CONFUSION_COLUMNS))
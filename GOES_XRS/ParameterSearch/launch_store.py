@@ -0,0 +1,123 @@
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pyarrow.dataset as ds
+import glob
+import os
+
+
+class LaunchStore:
+    ''' Columnar (Parquet) version of the Launches directory. Instead of one csv per parameter combination, every launch
+    row goes into a few large files with a combo_id column, and the combination values are saved once in a combo table.
+
+    Each ParameterSearch (core) writes its own pair of files, named by the first combo_id it has:
+    LaunchStore/launches_{first combo_id}.parquet = launch rows of every combination, buffered into row groups.
+    LaunchStore/combos_{first combo_id}.parquet = combo_id, parameter values and units, and Triggered (True if the
+        combination would have had a launch csv).
+
+    Reading uses a pyarrow dataset over all the files, so a combo_id filter only reads the row groups it needs.
+    '''
+
+    row_group_size = 100000
+
+    def __init__(self, out_dir):
+        self.store_dir = os.path.join(out_dir, 'LaunchStore')
+        self.writer = None
+        self.launch_tables = []
+        self.n_buffered = 0
+
+    def exists(self):
+        return len(glob.glob(os.path.join(self.store_dir, 'combos_*.parquet'))) > 0
+
+############### Writing ###########################################################################################
+
+    def open_writer(self, first_combo_id, param_names, param_units):
+        os.makedirs(self.store_dir, exist_ok=True)
+        self.first_combo_id = first_combo_id
+        self.param_names = param_names
+        self.param_units = param_units
+        self.launch_file = os.path.join(self.store_dir, f'launches_{first_combo_id}.parquet')
+
+    def append_launches(self, launches_df, combo_id):
+        ''' Buffers the launches of one combination, and writes a row group once there are row_group_size rows.
+        '''
+        if len(launches_df) == 0:
+            return
+        launches_df = launches_df.infer_objects()
+        launches_df['Cancelled?'] = launches_df['Cancelled?'].astype('boolean')
+        launches_df.insert(0, 'combo_id', combo_id)
+        self.launch_tables.append(pa.Table.from_pandas(launches_df, preserve_index=False))
+        self.n_buffered += len(launches_df)
+        if self.n_buffered >= self.row_group_size:
+            self.flush()
+
+    def flush(self):
+        if len(self.launch_tables) == 0:
+            return
+        if self.writer is None:
+            self.writer = pq.ParquetWriter(self.launch_file, self.launch_tables[0].schema)
+        table = pa.concat_tables([t.cast(self.writer.schema) for t in self.launch_tables])
+        self.writer.write_table(table, row_group_size=len(table))
+        self.launch_tables = []
+        self.n_buffered = 0
+
+    def close(self, parameter_combinations, triggered):
+        ''' Writes whatever launches are left, and the combo table of this writer's combinations (in combo_id order).
+        '''
+        self.flush()
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+        combos = np.asarray(parameter_combinations).reshape(len(triggered), len(self.param_names))
+        combo_df = pd.DataFrame({'combo_id': self.first_combo_id + np.arange(len(combos))})
+        for k, param_name in enumerate(self.param_names):
+            combo_df[param_name] = combos[:, k]
+            combo_df[f'{param_name}_units'] = self.param_units[k]
+        combo_df['Triggered'] = triggered
+        combo_df.to_parquet(os.path.join(self.store_dir, f'combos_{self.first_combo_id}.parquet'), index=False)
+
+############### Reading ###########################################################################################
+
+    def read_combos(self):
+        combo_files = sorted(glob.glob(os.path.join(self.store_dir, 'combos_*.parquet')))
+        combo_df = pd.concat([pd.read_parquet(f) for f in combo_files], ignore_index=True)
+        return combo_df.sort_values(by='combo_id').reset_index(drop=True)
+
+    def triggered_combo_ids(self):
+        combo_df = self.read_combos()
+        return np.array(combo_df.loc[combo_df['Triggered'], 'combo_id'])
+
+    def find_combo_id(self, combo_dict):
+        ''' combo_id of the combination with these {parameter name: value} values (compared with np.isclose, so there
+        is no need to match how a float was written in a file name).
+        '''
+        combo_df = self.read_combos()
+        match = np.ones(len(combo_df), dtype=bool)
+        for param_name, value in combo_dict.items():
+            match &= np.isclose(combo_df[param_name].astype(float), value, rtol=1e-9, atol=0)
+        if match.sum() != 1:
+            raise ValueError(f'{match.sum()} combinations match {combo_dict}! Double check you have all parameters.')
+        return combo_df.loc[match, 'combo_id'].iloc[0]
+
+    def read_launches(self, combo_ids=None, columns=None, with_params=False):
+        ''' Reads the launch rows of the combo_ids (all if None), only with the given columns (all if None). The combo_id
+        filter is pushed down to the Parquet files. with_params=True adds the parameter value and unit columns, so the
+        rows look like the old launch csvs.
+        '''
+        launch_files = sorted(glob.glob(os.path.join(self.store_dir, 'launches_*.parquet')))
+        if columns is not None and 'combo_id' not in columns:
+            columns = ['combo_id', *columns]
+        if len(launch_files) == 0: #no combination triggered, so no launch file was written
+            launch_df = pd.DataFrame({column: pd.Series(dtype=np.int64 if column == 'combo_id' else object)
+                            for column in (columns if columns is not None else ['combo_id'])})
+        else:
+            dataset = ds.dataset(launch_files, format='parquet')
+            combo_filter = None if combo_ids is None else ds.field('combo_id').isin(np.asarray(combo_ids).tolist())
+            launch_df = dataset.to_table(columns=columns, filter=combo_filter).to_pandas()
+        if with_params:
+            launch_df = launch_df.merge(self.read_combos().drop(columns='Triggered'), on='combo_id', how='left')
+        return launch_df
+
+    def read_combo_launches(self, combo_dict):
+        return self.read_launches([self.find_combo_id(combo_dict)], with_params=True)
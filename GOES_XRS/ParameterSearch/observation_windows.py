@@ -0,0 +1,222 @@
+import numpy as np
+import math
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from flare_series import FlareSeries
+import launch_outcomes as lo
+from cancellation_rules import CancellationTable
+
+
+class LaunchTiming:
+    ''' When a launch happens and what it sees, in samples (minutes) after the trigger:
+    latency + prep_time + launch_time = start of the FOXSI observation window, which is foxsi_window samples long.
+    hic_delay = samples from the FOXSI start to the HiC start, and the HiC window is hic_window samples long.
+    cancellation_offset = samples after the trigger where the xrsa flux is checked for cancellation. It has to be
+        before the HiC start, so a launch with HiC data always has a cancellation check (Cancelled? is only NaN for
+        launches that are dropped anyway).
+
+    The defaults are the timing the search has always used.
+    '''
+
+    timing_names = ('latency', 'prep_time', 'launch_time', 'hic_delay', 'foxsi_window', 'hic_window', 'cancellation_offset')
+
+    def __init__(self, latency=3, prep_time=4, launch_time=2, hic_delay=2, foxsi_window=6, hic_window=6, cancellation_offset=3):
+        self.latency = latency
+        self.prep_time = prep_time
+        self.launch_time = launch_time
+        self.hic_delay = hic_delay
+        self.foxsi_window = foxsi_window
+        self.hic_window = hic_window
+        self.cancellation_offset = cancellation_offset
+        if self.cancellation_offset >= self.hic_offset:
+            raise ValueError(f'The cancellation check ({cancellation_offset} samples after the trigger) has to be before the HiC '
+                        f'start ({self.hic_offset} samples after the trigger)!')
+
+    @property
+    def foxsi_offset(self):
+        return self.latency + self.prep_time + self.launch_time
+
+    @property
+    def hic_offset(self):
+        return self.foxsi_offset + self.hic_delay
+
+    def check_cancellation_rule(self, rule):
+        ''' Makes sure a CancellationRule (see cancellation_rules.py) checks before the HiC start with this timing, the
+        same as cancellation_offset has to.
+        '''
+        check_offset, _ = rule.find_offsets(self.cancellation_offset)
+        if check_offset >= self.hic_offset:
+            raise ValueError(f'{rule} checks {check_offset} samples after the trigger, but it has to be before the HiC start '
+                        f'({self.hic_offset} samples after the trigger)!')
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.timing_names}
+
+    def __repr__(self):
+        return f"LaunchTiming({', '.join(f'{name}={value}' for name, value in self.as_dict().items())})"
+
+    @classmethod
+    def make_grid(cls, timing_values):
+        ''' List of LaunchTiming for every combination of timing values, like {'latency': [1, 2, 3], 'foxsi_window':
+        [6, 8]} (timings that are not given keep their default), in the same order as the parameter combinations.
+        Combinations that are not a valid timing (the cancellation check after the HiC start) are skipped and printed.
+        '''
+        names = list(timing_values.keys())
+        unknown = [name for name in names if name not in cls.timing_names]
+        if len(unknown) > 0:
+            raise ValueError(f'Unknown launch timings {unknown}! They can be {cls.timing_names}.')
+        grid = np.array(np.meshgrid(*[timing_values[name] for name in names])).T.reshape(-1, len(names))
+        timings = []
+        skipped = []
+        for row in grid:
+            timing_values = {name: int(value) for name, value in zip(names, row)}
+            try:
+                timings.append(cls(**timing_values))
+            except ValueError as e:
+                skipped.append(f'{timing_values}: {e}')
+        if len(skipped) > 0:
+            print(f'Skipped {len(skipped)} of {len(grid)} launch timings:')
+            for reason in skipped:
+                print('   ', reason)
+        if len(timings) == 0:
+            raise ValueError('None of the launch timings are valid!')
+        return timings
+
+
+class ObservationWindowTable:
+    ''' What a launch at any (flare, trigger index) would see, for every sample of every flare at once. The FOXSI and
+    HiC max/mean observed xrsb fluxes and the cancellation bool only depend on the flare and the trigger index, never on
+    the parameter combination, so they are found once here and every launch record is then a gather.
+
+    The flares are kept end to end in a flat buffer (FlareSeries), and the windows are cut off at the end of their flare (the same as
+    slicing each flare array), with NaN for windows that are completely past the end. The windows are only
+    window_length samples long, so the max and mean are done with window_length shifted passes over the whole buffer.
+    The max is exactly the same as the slicing. The mean adds the samples up in order, which is what np.mean does for
+    windows under 8 samples (like the usual 6), so it is exact there too. The sums are done in the light curve's own
+    float dtype (float32 light curves are added up in float32, like np.mean of a float32 slice). For 8 or more samples np.mean uses pairwise
+    summation, so the means can differ from the slicing in the last bit (floating-point rounding).
+
+    A window that starts offset samples after a sample is the window starting at that later sample, so the window
+    max/mean of each window length are only made once (starting at every sample), and any offset is a gather from them.
+    That is how launch_states scores other launch timings (see LaunchTiming) from the same table.
+
+    Input:
+    xrsb_arrays, xrsa_arrays = FlareSeries or one array per flare (like data['xrsb'] and data['xrsa']).
+    times = FlareSeries or one array per flare of the sample times (like data['time']), only needed for launch_records.
+    foxsi_offset = samples from the trigger to the FOXSI observation start (latency + launch prep + launch time).
+    hic_offset = samples from the trigger to the HiC observation start.
+    window_length = samples in each observation window (the FOXSI one, if hic_window_length is given too).
+    cancellation_offset = samples after the trigger where the xrsa flux is checked for cancellation.
+    '''
+
+    def __init__(self, xrsb_arrays, xrsa_arrays, times=None, foxsi_offset=9, hic_offset=11, window_length=6,
+                        cancellation_offset=3, hic_window_length=None):
+        xrsb_series = FlareSeries.from_arrays(xrsb_arrays)
+        if xrsb_series.values.dtype.kind != 'f':
+            xrsb_series = xrsb_series.astype(float) #float light curves keep their dtype, so the means add up like np.mean
+        self.offsets = xrsb_series.offsets
+        self.xrsb = xrsb_series.values
+        self.xrsa = FlareSeries.from_arrays(xrsa_arrays).astype(float).values
+        self.times = np.asarray(FlareSeries.from_arrays(times).values) if times is not None else None
+        self.flare_ends = xrsb_series.flare_ends
+        self.window_stats = {}
+        self.cancellation_offset = cancellation_offset
+        self.foxsi_max, self.foxsi_mean = self.find_offset_window(foxsi_offset, window_length)
+        self.hic_max, self.hic_mean = self.find_offset_window(hic_offset, window_length if hic_window_length is None else hic_window_length)
+        self.has_cancellation_check, self.cancelled = self.find_cancellations(np.arange(len(self.xrsa)), cancellation_offset)
+
+    @classmethod
+    def from_timing(cls, xrsb_arrays, xrsa_arrays, times=None, timing=None):
+        ''' Table for the windows of a LaunchTiming (the usual timing if None).
+        '''
+        timing = LaunchTiming() if timing is None else timing
+        return cls(xrsb_arrays, xrsa_arrays, times, foxsi_offset=timing.foxsi_offset, hic_offset=timing.hic_offset, 
+                        window_length=timing.foxsi_window, cancellation_offset=timing.cancellation_offset, hic_window_length=timing.hic_window)
+
+    @staticmethod
+    def find_window_max_and_mean(values, flare_ends, offset, window_length):
+        starts = np.arange(len(values)) + offset
+        window_max = np.full(len(values), -np.inf, dtype=values.dtype)
+        window_sum = np.zeros(len(values), dtype=values.dtype)
+        n_samples = np.zeros(len(values), dtype=np.int64)
+        for k in range(window_length):
+            inside = np.flatnonzero(starts + k < flare_ends)
+            window_max[inside] = np.maximum(window_max[inside], values[starts[inside] + k])
+            window_sum[inside] += values[starts[inside] + k]
+            n_samples[inside] += 1
+        empty = n_samples == 0
+        window_max[empty] = np.nan
+        window_sum[empty] = np.nan
+        return window_max, window_sum/np.maximum(n_samples, 1).astype(values.dtype)
+
+    def find_window_stats(self, window_length):
+        ''' Max and mean of the window_length window starting at every sample (made once per window length).
+        '''
+        if window_length not in self.window_stats:
+            self.window_stats[window_length] = self.find_window_max_and_mean(self.xrsb, self.flare_ends, 0, window_length)
+        return self.window_stats[window_length]
+
+    def find_offset_window(self, offset, window_length, positions=None):
+        ''' Max and mean of the windows that start offset samples after the positions (every sample if None), NaN if
+        the window starts past the end of its flare.
+        '''
+        window_max, window_mean = self.find_window_stats(window_length)
+        positions = np.arange(len(self.xrsb)) if positions is None else positions
+        starts = positions + offset
+        inside = starts < self.flare_ends[positions]
+        found_max = np.full(len(positions), np.nan)
+        found_mean = np.full(len(positions), np.nan)
+        found_max[inside] = window_max[starts[inside]]
+        found_mean[inside] = window_mean[starts[inside]]
+        return found_max, found_mean
+
+    def find_cancellations(self, positions, cancellation_offset):
+        ''' (has a cancellation check, cancelled) for launches at the positions: cancelled if the xrsa flux is lower
+        cancellation_offset samples later, and not checked if the flare ends before then.
+        '''
+        later = positions + cancellation_offset
+        has_check = later < self.flare_ends[positions]
+        cancelled = np.zeros(len(positions), dtype=bool)
+        cancelled[has_check] = (self.xrsa[later[has_check]] - self.xrsa[positions[has_check]]) < 0
+        return has_check, cancelled
+
+    def use_cancellation_rule(self, rule, flare_data):
+        ''' Cancels the launches with a CancellationRule (see cancellation_rules.py) instead of the usual xrsa check.
+        '''
+        cancellation_table = CancellationTable(flare_data, [rule])
+        has_check, cancelled = cancellation_table.find_cancellations(np.arange(len(self.xrsa)), self.cancellation_offset)
+        self.has_cancellation_check, self.cancelled = has_check[0], cancelled[0]
+
+    def find_positions(self, flares, trigger_indices):
+        return self.offsets[flares] + trigger_indices
+
+    def launch_records(self, flares, trigger_indices, flare_ids):
+        ''' Launch records in the ParameterSearch calculated_flarelist format: [flare #, flare ID, cancellation bool,
+        trigger time, foxsi max, foxsi mean, hic max, hic mean] (cancellation is NaN if the flare ends too soon to check).
+        '''
+        positions = self.find_positions(flares, trigger_indices)
+        cancelled = [bool(c) if has_check else math.nan for c, has_check in
+                        zip(self.cancelled[positions], self.has_cancellation_check[positions])]
+        return list(zip(flares, np.asarray(flare_ids)[flares], cancelled, self.times[positions], self.foxsi_max[positions],
+                        self.foxsi_mean[positions], self.hic_max[positions], self.hic_mean[positions]))
+
+    def launch_states(self, flares, trigger_indices, timing=None, cancelled=None):
+        ''' Launch state (see launch_outcomes.py) of many (flare, trigger index) pairs at once. With a LaunchTiming,
+        the states are for that timing instead of the one the table was made with. cancelled = bool of every launch
+        from another cancellation rule (see CancellationTable), instead of the table's own.
+        '''
+        positions = self.find_positions(flares, trigger_indices)
+        if timing is None:
+            foxsi_max, hic_max = self.foxsi_max[positions], self.hic_max[positions]
+            cancelled = self.cancelled[positions] if cancelled is None else cancelled
+        else:
+            foxsi_max, _ = self.find_offset_window(timing.foxsi_offset, timing.foxsi_window, positions)
+            hic_max, _ = self.find_offset_window(timing.hic_offset, timing.hic_window, positions)
+            if cancelled is None:
+                _, cancelled = self.find_cancellations(positions, timing.cancellation_offset)
+        states = np.full(len(positions), lo.LAUNCH_NOT_OBSERVED)
+        states[(foxsi_max > 5e-6) & (hic_max > 5e-6)] = lo.LAUNCH_OBSERVED
+        states[cancelled] = lo.CANCELLED
+        states[np.isnan(hic_max)] = lo.NO_TRIGGER
+        return states
@@ -0,0 +1,100 @@
+import numpy as np
+
+
+class ParameterGrid:
+    ''' The parameter combinations of a grid, without making the (combinations, parameters) array. Every combination
+    has a combo_id, which is its row in np.array(np.meshgrid(*param_values)).T.reshape(-1, K) (the order the search
+    has always used), and its values are decoded from the combo_id like the digits of a mixed radix number: the digit
+    of each parameter is the index into its value list. So the whole grid is only the value lists, a core's share of
+    it is a (start, stop) range of combo_ids, and the combinations are decoded a block at a time while looping.
+
+    It is indexed like the combination array: grid[j] is one combination, grid[a:b], grid[bool mask] and grid[array of
+    rows] are arrays of combinations, iterating gives every combination, and np.asarray(grid) makes the array (of this
+    range only).
+
+    Input:
+    param_values = one list of values per parameter (like make_param_values gives).
+    start, stop = combo_id range of this grid (the whole grid if stop is None).
+    '''
+
+    ndim = 2
+
+    def __init__(self, param_values, start=0, stop=None, block_size=4096):
+        self.param_values = [np.asarray(values) for values in param_values]
+        self.dtype = np.result_type(*self.param_values)
+        self.lengths = [len(values) for values in self.param_values]
+        self.n_total = int(np.prod(self.lengths, dtype=object))
+        self.start = start
+        self.stop = self.n_total if stop is None else stop
+        if not 0 <= self.start <= self.stop <= self.n_total:
+            raise ValueError(f'combo_id range {self.start}:{self.stop} is not inside the {self.n_total} combinations!')
+        self.block_size = block_size
+        self.strides = self.find_strides(self.lengths)
+
+    @staticmethod
+    def find_strides(lengths):
+        ''' combo_id step of each parameter's digit. meshgrid swaps the first two axes and .T reverses them all, so the
+        last parameter is the slowest digit, then the one before it and so on down to the third, then the first, and the
+        second parameter is the fastest.
+        '''
+        digit_order = list(range(len(lengths)))
+        if len(lengths) > 1:
+            digit_order[0], digit_order[1] = 1, 0
+        strides = [0]*len(lengths)
+        stride = 1
+        for k in digit_order: #fastest digit first
+            strides[k] = stride
+            stride *= lengths[k]
+        return strides
+
+    def __len__(self):
+        return self.stop - self.start
+
+    @property
+    def shape(self):
+        return (len(self), len(self.param_values))
+
+    def __repr__(self):
+        return f'ParameterGrid({self.lengths}, combo_ids {self.start}:{self.stop})'
+
+    def decode(self, combo_ids):
+        ''' (len(combo_ids), parameters) array of the combinations with those combo_ids (of the whole grid).
+        '''
+        combo_ids = np.asarray(combo_ids, dtype=np.int64)
+        combos = np.empty((len(combo_ids), len(self.param_values)), dtype=self.dtype)
+        for k, values in enumerate(self.param_values):
+            combos[:, k] = values[(combo_ids // self.strides[k]) % self.lengths[k]]
+        return combos
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, np.integer)):
+            if not -len(self) <= key < len(self):
+                raise IndexError(f'combination {key} is out of range for {len(self)} combinations')
+            return self.decode([self.start + key % len(self)])[0]
+        if isinstance(key, slice):
+            rows = range(self.start, self.stop)[key]
+            return self.decode(np.arange(rows.start, rows.stop, rows.step))
+        key = np.asarray(key)
+        if key.dtype == bool:
+            return self.decode(self.start + np.flatnonzero(key))
+        return self.decode(self.start + key % len(self))
+
+    def __iter__(self):
+        for block_start in range(self.start, self.stop, self.block_size):
+            yield from self.decode(np.arange(block_start, min(block_start + self.block_size, self.stop)))
+
+    def __array__(self, dtype=None, copy=None):
+        combos = self.decode(np.arange(self.start, self.stop))
+        return combos if dtype is None else combos.astype(dtype)
+
+    def subgrid(self, start, stop):
+        ''' The rows start:stop of this grid, as another ParameterGrid (nothing is decoded).
+        '''
+        return ParameterGrid(self.param_values, self.start + start, self.start + stop, self.block_size)
+
+    def split(self, n_splits):
+        ''' Splits the grid into n_splits combo_id ranges, the same sizes as np.array_split of the combination array.
+        '''
+        size, extra = divmod(len(self), n_splits)
+        bounds = np.cumsum([0] + [size + 1]*extra + [size]*(n_splits - extra))
+        return [self.subgrid(a, b) for a, b in zip(bounds[:-1], bounds[1:])]
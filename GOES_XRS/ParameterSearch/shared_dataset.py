@@ -0,0 +1,99 @@
+import numpy as np
+from multiprocessing import shared_memory
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from flare_series import FlareSeries
+
+
+class SharedDataset:
+    ''' Puts the flare columns (light curves, computed parameters and the per-flare catalog columns) in shared memory
+    once, so every core can look at the same arrays instead of each one opening the FITS files or getting its own
+    pickled copy of the parameter arrays.
+
+    Per-flare (variable length) columns are saved as one flat values buffer and an offsets array, and are given back
+    as a FlareSeries over the shared buffer (with the source of the column it was made from). Catalog columns (one value per flare) are saved as they are. Strings
+    are saved as fixed width unicode arrays.
+
+    The parent makes it with SharedDataset.create(columns), sends self.descriptor (only names, dtypes and shapes) to
+    the workers, which call SharedDataset.attach(descriptor), and the parent calls unlink() once the workers are done.
+    '''
+
+    def __init__(self, descriptor, blocks):
+        self.descriptor = descriptor
+        self.blocks = blocks #the SharedMemory objects have to be kept around for the views to stay valid
+        self.columns = {}
+        for name, (values_info, offsets_info, source) in descriptor.items():
+            values = self.view(values_info)
+            if offsets_info is None:
+                self.columns[name] = values
+            else:
+                offsets = self.view(offsets_info)
+                self.columns[name] = FlareSeries(values, offsets, source)
+
+    def view(self, block_info):
+        block_name, dtype, shape = block_info
+        return np.ndarray(shape, dtype=np.dtype(dtype), buffer=self.blocks[block_name].buf)
+
+    @staticmethod
+    def native(arr):
+        arr = np.asarray(arr)
+        if arr.dtype.kind == 'S':
+            return np.char.decode(arr)
+        return arr.astype(arr.dtype.newbyteorder('='))
+
+    @staticmethod
+    def copy_to_shared_memory(arr, blocks):
+        block = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+        np.ndarray(arr.shape, dtype=arr.dtype, buffer=block.buf)[...] = arr
+        blocks[block.name] = block
+        return block.name, arr.dtype.str, arr.shape
+
+    @classmethod
+    def create(cls, columns):
+        ''' columns = {name: per-flare column}, where a column is either a FlareSeries or one array per flare (like the 
+        FITS light curves), or one value per flare.
+        '''
+        descriptor = {}
+        blocks = {}
+        for name, column in columns.items():
+            if not isinstance(column, (list, FlareSeries)):
+                column = np.asarray(column)
+            if isinstance(column, (list, FlareSeries)) or column.dtype == object:
+                series = FlareSeries.from_arrays(column)
+                descriptor[name] = (cls.copy_to_shared_memory(cls.native(series.values), blocks), 
+                                cls.copy_to_shared_memory(series.offsets, blocks), series.source)
+            else:
+                descriptor[name] = (cls.copy_to_shared_memory(cls.native(column), blocks), None, None)
+        return cls(descriptor, blocks)
+
+    @classmethod
+    def attach(cls, descriptor):
+        blocks = {}
+        for values_info, offsets_info, _ in descriptor.values():
+            for block_info in (values_info, offsets_info):
+                if block_info is not None:
+                    blocks[block_info[0]] = shared_memory.SharedMemory(name=block_info[0])
+        return cls(descriptor, blocks)
+
+    def flare_table(self, names=None):
+        ''' Dictionary of columns that can be used in place of the FITS Table (data[name][flare #]).
+        '''
+        if names is None:
+            names = self.columns.keys()
+        return {name: self.columns[name] for name in names}
+
+    def param_arrays(self, names):
+        ''' List of the named FlareSeries columns, like make_param_info's param_arrays.
+        '''
+        return [self.columns[name] for name in names]
+
+    def close(self):
+        self.columns = {}
+        for block in self.blocks.values():
+            block.close()
+
+    def unlink(self):
+        self.close()
+        for block in self.blocks.values():
+            block.unlink()
@@ -0,0 +1,75 @@
+import numpy as np
+import pandas as pd
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from fits_cache import FitsCache
+from flare_series import FlareSeries
+import launch_outcomes as lo
+from observation_windows import ObservationWindowTable
+import updated_save_scores as ss
+
+
+class ThresholdSweep:
+    ''' Exact single parameter search over every threshold that changes the result, instead of a hand-picked list.
+
+    For one parameter, the first index where a flare's array is >= a threshold is the first index where its running
+    maximum reaches that threshold. So each flare only changes its trigger index at the "record" values of its running
+    maximum: for thresholds in (previous record, record] it triggers at the record's index, and above its last record it
+    never triggers. Every (flare, record) interval is given its confusion matrix box, and the counts at every distinct
+    threshold come from sorting the interval edges (O(N log N) for N records).
+
+    Output:
+    DataFrame with a row for every distinct threshold, with the same count and score columns as SaveScores.
+    '''
+
+    flare_fits = '../GOES_XRS_historical_finalversion.fits'
+
+    def __init__(self):
+        self.data = FitsCache(self.flare_fits).load()
+        self.above_c5 = np.array(self.data['above C5'], dtype=bool)
+        self.n_flares = len(self.data['flare ID'])
+        self.observation_table = ObservationWindowTable(self.data['xrsb'], self.data['xrsa'])
+
+    def find_flare_intervals(self, feature_arrays):
+        ''' Saves the threshold interval (low, high] of every launch state of every flare. Each running maximum record
+        gives one interval, and the last one (above the flare's max) is the no trigger state. The record values are 
+        saved as well, since those are the thresholds where anything can change. Every flare is done at once on the 
+        flat FlareSeries buffer.
+        '''
+        feature_series = FlareSeries.from_arrays(feature_arrays).astype(float)
+        running_max = feature_series.cummax()
+        previous_max = running_max.lag(1).values
+        is_record = ~np.isnan(running_max.values) & (np.isnan(previous_max) | (running_max.values > previous_max))
+        records = np.flatnonzero(is_record)
+        record_flares = feature_series.flare_index[records]
+        self.record_values = running_max.values[records]
+        record_states = self.observation_table.launch_states(record_flares, feature_series.sample_index[records])
+        #each record's interval starts at the flare's previous record, and the no trigger interval at its last record
+        first_record = np.concatenate([[True], record_flares[1:] != record_flares[:-1]])
+        record_lows = np.where(first_record, -np.inf, np.concatenate([[np.nan], self.record_values[:-1]]))
+        n_records = np.bincount(record_flares, minlength=feature_series.n_flares)
+        flare_max = np.full(feature_series.n_flares, -np.inf)
+        flare_max[n_records > 0] = self.record_values[np.cumsum(n_records)[n_records > 0] - 1]
+        flares = np.concatenate([record_flares, np.arange(feature_series.n_flares)])
+        lows = np.concatenate([record_lows, flare_max])
+        highs = np.concatenate([self.record_values, np.full(feature_series.n_flares, np.inf)])
+        states = np.concatenate([record_states, np.full(feature_series.n_flares, lo.NO_TRIGGER)]).astype(int)
+        return flares, lows, highs, states
+
+    def sweep_feature(self, feature_arrays):
+        ''' Finds the confusion matrix counts and scores at every distinct threshold of the feature (one array per flare).
+        A flare is in an interval's state at threshold v when low < v <= high, so the count of a box at v is
+        #(low < v) - #(high < v) over that box's intervals.
+        '''
+        flares, lows, highs, states = self.find_flare_intervals(feature_arrays)
+        thresholds = np.unique(self.record_values)
+        categories = lo.confusion_category(states, self.above_c5[flares])
+        sweep_df = pd.DataFrame({'Threshold': thresholds})
+        for c, column in enumerate(lo.CONFUSION_COLUMNS):
+            box = categories == c
+            sweep_df[column] = (np.searchsorted(np.sort(lows[box]), thresholds, side='left') -
+                        np.searchsorted(np.sort(highs[box]), thresholds, side='left'))
+        sweep_df = ss.calculate_scores(sweep_df, self.n_flares)
+        return sweep_df[['Threshold', 'Precision', 'Recall', 'Gordon', 'LaunchTriggerRatio', 'Fbeta', 'Accuracy', 'TN',
+                        'TN_canc', 'FN', 'FN_canc', 'FP_c5', 'FP_noc5', 'TP_noc5', 'TP']]
@@ -0,0 +1,231 @@
+import numpy as np
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from flare_series import flare_series_columns, first_true_per_segment, ragged_arange
+import launch_outcomes as lo
+from observation_windows import ObservationWindowTable
+
+
+def flatten_flare_arrays(parameter_arrays):
+    ''' Takes the parameter arrays ParameterSearch uses (a FlareSeries per parameter, or the older per-flare tuples) 
+    and gives back one long array per parameter, so a condition can be checked for every flare at once.
+
+    Returns:
+    columns = list of flat arrays, one for each parameter (in the same order as the keys list).
+    offsets = array of where each flare starts in the flat arrays. offsets[-1] is the total number of samples.
+    '''
+    series = flare_series_columns(parameter_arrays)
+    return [np.asarray(column.values) for column in series], series[0].offsets
+
+
+class BatchedTriggerEngine:
+    ''' Finds the first trigger index of every (combination, flare) pair for a whole block of parameter combinations
+    at once. This gives the same trigger_index as ParameterSearch.flareloop_check_if_value_surpassed (every parameter
+    array >= its value at the same time), but without making a DataFrame for every flare.
+
+    Input:
+    parameter_arrays = one FlareSeries per parameter (or per-flare tuples of arrays), same as used by ParameterSearch.
+    block_size = number of combinations checked together. The memory used is about block_size * (total samples) * 5 bytes.
+    '''
+
+    def __init__(self, parameter_arrays, block_size=64):
+        self.columns, self.offsets = flatten_flare_arrays(parameter_arrays)
+        self.n_flares = len(self.offsets) - 1
+        self.n_samples = self.offsets[-1]
+        self.block_size = block_size
+
+    def find_trigger_indices(self, parameter_combinations):
+        ''' Returns a (combinations, flares) array of trigger indices, with -1 where the flare never triggers.
+        '''
+        combos = np.atleast_2d(parameter_combinations)
+        trigger_indices = np.empty((len(combos), self.n_flares), dtype=np.int64)
+        for start in range(0, len(combos), self.block_size):
+            block = combos[start:start+self.block_size]
+            trigger_indices[start:start+len(block)] = self.find_block_trigger_indices(block)
+        return trigger_indices
+
+    def find_block_trigger_indices(self, block):
+        ''' Checks every parameter against its values for the whole block of combinations (broadcast over the flat time
+        axis), and keeps only the times where all of them are met.
+        '''
+        triggered = np.ones((len(block), self.n_samples), dtype=bool)
+        for k, column in enumerate(self.columns):
+            triggered &= column >= block[:, k, None]
+        return first_true_per_segment(triggered, self.offsets)
+
+
+def rank_encode(column, thresholds):
+    ''' Encodes each sample as the number of (sorted) thresholds it meets, i.e. how many values v have sample >= v.
+    NaN samples meet none of them.
+    '''
+    ranks = np.searchsorted(thresholds, column, side='right')
+    ranks[np.isnan(column)] = 0
+    return ranks
+
+
+class DominanceCubeEngine:
+    ''' Finds the first trigger index of every combination on the parameter grid at once, one flare at a time.
+
+    Each sample is encoded by how many of each parameter's values it meets (its rank). A combination (j_1, ..., j_K) 
+    triggers at time t when every rank at t is at least j_k + 1, so if the earliest time of each rank tuple is written 
+    into an N-D cube, a reversed cumulative minimum along every axis gives the first trigger index of every combination.
+    This costs (flare length + grid size) per flare, instead of (flare length * number of combinations).
+
+    Input:
+    parameter_arrays = one FlareSeries per parameter (or per-flare tuples of arrays), same as used by ParameterSearch.
+    parameter_values = list of the values tried for each parameter (the first entry of each params dict value). 
+    '''
+
+    no_trigger = np.iinfo(np.int32).max
+
+    def __init__(self, parameter_arrays, parameter_values):
+        self.columns, self.offsets = flatten_flare_arrays(parameter_arrays)
+        self.n_flares = len(self.offsets) - 1
+        self.axis_values = [np.unique(values) for values in parameter_values]
+        self.grid_shape = tuple(len(values) for values in self.axis_values)
+        self.save_cells()
+
+    def save_cells(self):
+        ''' Saves the flat cube cell of every sample. Samples that do not meet at least the lowest value of every 
+        parameter can never trigger, so they get -1.
+        '''
+        ranks = [rank_encode(column, values) for column, values in zip(self.columns, self.axis_values)]
+        can_trigger = np.all([rank > 0 for rank in ranks], axis=0)
+        self.cells = np.full(self.offsets[-1], -1, dtype=np.int64)
+        self.cells[can_trigger] = np.ravel_multi_index([rank[can_trigger] - 1 for rank in ranks], self.grid_shape)
+
+    def find_flare_cube(self, i):
+        ''' Returns the grid-shaped cube of first trigger indices for flare i (no_trigger where it never triggers).
+        '''
+        cells = self.cells[self.offsets[i]:self.offsets[i+1]]
+        can_trigger = np.flatnonzero(cells >= 0)
+        cube = np.full(np.prod(self.grid_shape), self.no_trigger, dtype=np.int32)
+        unique_cells, first = np.unique(cells[can_trigger], return_index=True)
+        cube[unique_cells] = can_trigger[first]
+        cube = cube.reshape(self.grid_shape)
+        for axis in range(cube.ndim):
+            cube = np.flip(np.minimum.accumulate(np.flip(cube, axis=axis), axis=axis), axis=axis)
+        return cube
+
+    def find_combination_cells(self, parameter_combinations, block_size=4096):
+        ''' Finds the flat grid cell of each combination. Every value has to be one of the parameter values the engine
+        was made with. The combinations are looked up a block at a time, so a ParameterGrid (see parameter_grid.py) is
+        never decoded all at once.
+        '''
+        if np.ndim(parameter_combinations) < 2: #a single combination
+            return self.find_block_cells(np.atleast_2d(parameter_combinations))
+        return np.concatenate([np.zeros(0, dtype=np.int64)] + [self.find_block_cells(parameter_combinations[start:start+block_size]) 
+                        for start in range(0, len(parameter_combinations), block_size)])
+
+    def find_block_cells(self, combos):
+        grid_index = []
+        for k, values in enumerate(self.axis_values):
+            index = np.clip(np.searchsorted(values, combos[:, k]), 0, len(values) - 1)
+            if not np.all(values[index] == combos[:, k]):
+                raise ValueError(f'Parameter {k} has combination values that are not in the grid values {values}.')
+            grid_index.append(index)
+        return np.ravel_multi_index(grid_index, self.grid_shape)
+
+    def find_trigger_indices(self, parameter_combinations):
+        ''' Returns a (combinations, flares) int32 array of trigger indices, with -1 where the flare never triggers.
+        '''
+        combo_cells = self.find_combination_cells(parameter_combinations)
+        trigger_indices = np.empty((len(combo_cells), self.n_flares), dtype=np.int32)
+        for i in range(self.n_flares):
+            trigger_indices[:, i] = self.find_flare_cube(i).ravel()[combo_cells]
+        trigger_indices[trigger_indices == self.no_trigger] = -1
+        return trigger_indices
+
+
+class MonotoneTriggerEngine:
+    ''' Goes along one parameter axis in ascending order for every combination of the other parameters. Raising a value
+    can only delay or remove a trigger, so after the first value only flares that still trigger are checked again, and 
+    only from their previous trigger index onward. Once a flare stops triggering it is skipped for every larger value.
+    The axis swept is the one that leaves the fewest combinations of the other parameters (the longest sweeps), since 
+    a core's share of the grid does not always vary the last parameter.
+
+    If flare_data (the ParameterSearch FITS table) is given, the confusion matrix counts of each combination are kept as 
+    well (against the truth label, above C5 if None), and only the flares whose trigger index changed get their launch state recomputed (delta updates).
+    observation_table = ObservationWindowTable of the launch timing to count with (the usual one if None).
+
+    evaluated/skipped count the (combination, flare) pairs that were checked or skipped.
+    '''
+
+    def __init__(self, parameter_arrays, flare_data=None, truth=None, observation_table=None):
+        self.columns, self.offsets = flatten_flare_arrays(parameter_arrays)
+        self.n_flares = len(self.offsets) - 1
+        self.flare_data = flare_data
+        if flare_data is not None:
+            self.above_c5 = np.array(flare_data['above C5'] if truth is None else truth, dtype=bool)
+            if observation_table is None:
+                observation_table = ObservationWindowTable(flare_data['xrsb'], flare_data['xrsa'])
+            self.observation_table = observation_table
+        self.evaluated = 0
+        self.skipped = 0
+
+    def choose_sweep_axis(self, combos):
+        n_groups = [len(np.unique(np.delete(combos, k, axis=1), axis=0)) for k in range(combos.shape[1])]
+        return int(np.argmin(n_groups))
+
+    def iterate_trigger_indices(self, parameter_combinations):
+        ''' Yields (row of the combination, trigger indices of every flare, confusion counts or None) for every 
+        combination, grouped by the values of all the parameters except the sweep axis.
+        '''
+        combos = np.atleast_2d(parameter_combinations)
+        self.sweep_axis = self.choose_sweep_axis(combos)
+        outer_axes = [k for k in range(combos.shape[1]) if k != self.sweep_axis]
+        rows = np.lexsort([combos[:, self.sweep_axis]] + [combos[:, k] for k in reversed(outer_axes)])
+        outer_values = combos[rows][:, outer_axes]
+        group_starts = np.concatenate([[0], np.flatnonzero(np.any(outer_values[1:] != outer_values[:-1], axis=1)) + 1])
+        group_ends = np.append(group_starts[1:], len(rows))
+        for start, end in zip(group_starts, group_ends):
+            outer_mask = np.ones(self.offsets[-1], dtype=bool)
+            for k, value in zip(outer_axes, outer_values[start]):
+                outer_mask &= self.columns[k] >= value
+            trigger_indices = None
+            for row in rows[start:end]:
+                trigger_indices = self.update_trigger_indices(outer_mask, combos[row, self.sweep_axis], trigger_indices)
+                yield row, trigger_indices, self.counts if self.flare_data is not None else None
+
+    def update_trigger_indices(self, outer_mask, value, previous):
+        ''' Finds the new trigger indices for the next (larger) value of the sweep axis parameter, starting from the 
+        previous ones. With no previous trigger indices, every flare is checked from the start.
+        '''
+        sweep_column = self.columns[self.sweep_axis]
+        if previous is None:
+            trigger_indices = first_true_per_segment(outer_mask & (sweep_column >= value), self.offsets)[0]
+            self.evaluated += self.n_flares
+            if self.flare_data is not None:
+                self.states = self.find_launch_states(trigger_indices, np.arange(self.n_flares))
+                self.counts = lo.confusion_counts(self.states, self.above_c5)
+            return trigger_indices
+        still_triggered = np.flatnonzero(previous >= 0)
+        self.evaluated += len(still_triggered)
+        self.skipped += self.n_flares - len(still_triggered)
+        starts = self.offsets[still_triggered] + previous[still_triggered]
+        lengths = self.offsets[still_triggered + 1] - starts
+        samples = ragged_arange(starts, lengths)
+        first = first_true_per_segment(outer_mask[samples] & (sweep_column[samples] >= value), 
+                        np.concatenate([[0], np.cumsum(lengths)]))[0]
+        trigger_indices = previous.copy()
+        trigger_indices[still_triggered] = np.where(first >= 0, previous[still_triggered] + first, -1)
+        if self.flare_data is not None:
+            self.update_counts(np.flatnonzero(trigger_indices != previous), trigger_indices)
+        return trigger_indices
+
+    def find_launch_states(self, trigger_indices, flares):
+        states = np.full(len(flares), lo.NO_TRIGGER)
+        triggered = trigger_indices[flares] >= 0
+        states[triggered] = self.observation_table.launch_states(flares[triggered], trigger_indices[flares[triggered]])
+        return states
+
+    def update_counts(self, changed, trigger_indices):
+        ''' Moves only the flares whose trigger index changed to their new confusion matrix box.
+        '''
+        if len(changed) == 0:
+            return
+        self.counts = self.counts.copy()
+        np.subtract.at(self.counts, lo.confusion_category(self.states[changed], self.above_c5[changed]), 1)
+        self.states[changed] = self.find_launch_states(trigger_indices, changed)
+        np.add.at(self.counts, lo.confusion_category(self.states[changed], self.above_c5[changed]), 1)
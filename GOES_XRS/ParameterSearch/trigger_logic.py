@@ -0,0 +1,180 @@
+import numpy as np
+import ast
+from functools import lru_cache
+from condition_masks import ConditionMaskCache, first_set_bit_per_segment
+from trigger_engines import flatten_flare_arrays
+
+
+class TriggerLogicError(ValueError):
+    pass
+
+
+def parse_trigger_logic(text, parameter_names):
+    ''' Parses a trigger expression over the parameter names into a tree of tuples. Each name is that parameter's
+    condition (parameter >= the combination's value, held for its persistence). The expression can use & / and,
+    | / or, ~ / not, brackets, and atleast(k, a, b, ...) for k-of-n voting, like
+    'xrsb | (temp & em)' or 'atleast(3, xrsa, xrsb, 3minxrsa, temp, em)'. Names that are not Python names (like
+    3minxrsa) are fine, they are swapped for placeholders before parsing.
+    '''
+    placeholders = {}
+    replaced = text
+    for k, name in sorted(enumerate(parameter_names), key=lambda item: -len(item[1])):
+        placeholder = f'__param{k}__'
+        placeholders[placeholder] = k
+        replaced = replace_name(replaced, name, placeholder)
+    try:
+        tree = ast.parse(replaced.strip(), mode='eval').body
+    except SyntaxError as e:
+        raise TriggerLogicError(f'Could not parse the trigger logic {text!r}: {e.msg}') from None
+    return make_logic_node(tree, placeholders)
+
+
+def replace_name(text, name, placeholder):
+    ''' Replaces name where it is a whole word (not part of a longer name). '''
+    pieces = text.split(name)
+    joined = pieces[0]
+    for piece in pieces[1:]:
+        before, after = joined[-1:], piece[:1]
+        whole_word = not (before.isalnum() or before == '_') and not (after.isalnum() or after == '_')
+        joined += (placeholder if whole_word else name) + piece
+    return joined
+
+
+def make_logic_node(tree, placeholders):
+    if isinstance(tree, ast.Name):
+        if tree.id not in placeholders:
+            raise TriggerLogicError(f'{tree.id} is not one of the parameters.')
+        return ('condition', placeholders[tree.id])
+    if isinstance(tree, ast.BinOp) and isinstance(tree.op, (ast.BitAnd, ast.BitOr)):
+        op = 'and' if isinstance(tree.op, ast.BitAnd) else 'or'
+        return (op, make_logic_node(tree.left, placeholders), make_logic_node(tree.right, placeholders))
+    if isinstance(tree, ast.BoolOp):
+        op = 'and' if isinstance(tree.op, ast.And) else 'or'
+        node = make_logic_node(tree.values[0], placeholders)
+        for value in tree.values[1:]:
+            node = (op, node, make_logic_node(value, placeholders))
+        return node
+    if isinstance(tree, ast.UnaryOp) and isinstance(tree.op, (ast.Invert, ast.Not)):
+        return ('not', make_logic_node(tree.operand, placeholders))
+    if isinstance(tree, ast.Call) and isinstance(tree.func, ast.Name) and tree.func.id == 'atleast':
+        if len(tree.args) < 2 or not isinstance(tree.args[0], ast.Constant) or not isinstance(tree.args[0].value, int):
+            raise TriggerLogicError('atleast needs a whole number and then the conditions, like atleast(3, a, b, c, d).')
+        return ('atleast', tree.args[0].value, tuple(make_logic_node(arg, placeholders) for arg in tree.args[1:]))
+    raise TriggerLogicError(f'{ast.unparse(tree)!r} is not allowed in trigger logic.')
+
+
+@lru_cache(maxsize=None)
+def compile_trigger_logic(text, parameter_names):
+    ''' TriggerLogic of an expression shape, compiled once and reused by every combination (and every search in the
+    same process) with that shape.
+    '''
+    return TriggerLogic(text, parameter_names)
+
+
+class TriggerLogic:
+    ''' A trigger expression compiled into a list of steps on packed condition bitsets (see condition_masks.py), so a
+    combination is evaluated for every flare at once with a few byte-wise operations. & and | are np.bitwise_and/or
+    of the bitsets, and atleast(k, ...) is done without unpacking: the conditions are added up into bit planes of a
+    counter (like a ripple carry adder, one plane per bit of the count), and the count >= k test is a comparison of
+    the planes against the bits of k.
+
+    Input:
+    text = trigger expression (see parse_trigger_logic).
+    parameter_names = tuple of the parameter names, in the order of the condition columns.
+    '''
+
+    def __init__(self, text, parameter_names):
+        self.text = text
+        self.parameter_names = tuple(parameter_names)
+        self.tree = parse_trigger_logic(text, self.parameter_names)
+        self.steps = []
+        self.output = self.add_steps(self.tree)
+        self.conditions = sorted({step[1] for step in self.steps if step[0] == 'condition'})
+
+    def add_steps(self, node):
+        ''' Adds the steps of node after its children, and returns the step # of its result.
+        '''
+        kind = node[0]
+        if kind == 'condition':
+            self.steps.append(node)
+        elif kind == 'not':
+            self.steps.append(('not', self.add_steps(node[1])))
+        elif kind in ('and', 'or'):
+            self.steps.append((kind, self.add_steps(node[1]), self.add_steps(node[2])))
+        else:
+            _, k, children = node
+            self.steps.append(('atleast', k, tuple(self.add_steps(child) for child in children)))
+        return len(self.steps) - 1
+
+    def evaluate(self, get_mask):
+        ''' Packed bitset of the whole expression.
+
+        Input:
+        get_mask = function giving the packed bitset of condition k (for the combination being checked).
+        '''
+        results = []
+        for step in self.steps:
+            kind = step[0]
+            if kind == 'condition':
+                results.append(get_mask(step[1]))
+            elif kind == 'not':
+                results.append(np.invert(results[step[1]]))
+            elif kind == 'and':
+                results.append(np.bitwise_and(results[step[1]], results[step[2]]))
+            elif kind == 'or':
+                results.append(np.bitwise_or(results[step[1]], results[step[2]]))
+            else:
+                _, k, children = step
+                results.append(self.at_least(k, [results[child] for child in children]))
+        return results[self.output]
+
+    @staticmethod
+    def at_least(k, masks):
+        if k <= 0:
+            return np.full_like(masks[0], 0xFF)
+        if k > len(masks):
+            return np.zeros_like(masks[0])
+        planes = []
+        for mask in masks:
+            carry = mask
+            for b in range(len(planes)):
+                planes[b], carry = planes[b] ^ carry, planes[b] & carry
+            if len(planes) < len(masks).bit_length():
+                planes.append(carry)
+        #count >= k, going down from the highest bit of the count
+        greater = np.zeros_like(masks[0])
+        equal = np.full_like(masks[0], 0xFF)
+        for b in reversed(range(len(planes))):
+            if (k >> b) & 1:
+                equal &= planes[b]
+            else:
+                greater |= equal & planes[b]
+                equal &= ~planes[b]
+        return greater | equal
+
+
+class LogicTriggerEngine:
+    ''' Finds the first trigger index of every (combination, flare) pair for a trigger expression (OR, NOT, k-of-n
+    voting, not just AND of every condition). The condition bitsets come from the ConditionMaskCache, so each
+    (parameter, value, persistence) condition is made once no matter how many combinations use it.
+
+    Input:
+    parameter_arrays = one FlareSeries per parameter, same as used by ParameterSearch.
+    trigger_logic = trigger expression (see parse_trigger_logic).
+    condition_names = the parameter names of the parameter_arrays.
+    memory_budget = max bytes kept in the condition mask cache.
+    persistence_columns = combination column of the persistence of every parameter (-1 for none, see
+        condition_masks.find_persistence_columns). None if the combinations are only the parameter values.
+    '''
+
+    def __init__(self, parameter_arrays, trigger_logic, condition_names, memory_budget=2**29, persistence_columns=None):
+        columns, self.offsets = flatten_flare_arrays(parameter_arrays)
+        self.n_flares = len(self.offsets) - 1
+        self.mask_cache = ConditionMaskCache(columns, memory_budget, self.offsets)
+        self.logic = compile_trigger_logic(trigger_logic, tuple(condition_names))
+        self.persistence_columns = np.full(len(columns), -1) if persistence_columns is None else np.asarray(persistence_columns)
+
+    def find_combination_trigger_indices(self, parameter):
+        persistences = np.where(self.persistence_columns >= 0, np.asarray(parameter)[self.persistence_columns], 1)
+        combined = self.logic.evaluate(lambda k: self.mask_cache.get_mask(k, parameter[k], persistences[k]))
+        return first_set_bit_per_segment(combined, self.offsets)
@@ -0,0 +1,130 @@
+import numpy as np
+import json
+import glob
+import os
+import launch_outcomes as lo
+from parameter_grid import ParameterGrid
+
+
+class TriggerMatrixStore:
+    ''' Saves the first trigger index of every (combination, flare) from the search, so the combinations can be scored
+    again (other labels, metrics or launch windows) without searching again. Everything after the trigger index is only
+    gathers from the observation window table, so rescoring a whole grid takes seconds.
+
+    TriggerMatrix/grid.json = parameter names, units and values, the number of flares, the no trigger value and the
+        trigger logic the search used (None for the usual AND).
+    TriggerMatrix/triggers_{first combo_id}.npy = (combinations, flares) trigger indices of one ParameterSearch (core),
+        -1 (no_trigger) for flares that never trigger. int16, unless a flare is too long for it (then int32). Row r is
+        combo_id first combo_id + r of the grid.json grid, so the combinations are decoded from the parameter values
+        with a ParameterGrid (see parameter_grid.py) instead of being saved.
+    '''
+
+    no_trigger = -1
+
+    def __init__(self, out_dir):
+        self.store_dir = os.path.join(out_dir, 'TriggerMatrix')
+        self.triggers = None
+
+    def exists(self):
+        return os.path.exists(os.path.join(self.store_dir, 'grid.json'))
+
+    @staticmethod
+    def index_dtype(max_flare_length):
+        return np.int16 if max_flare_length <= np.iinfo(np.int16).max else np.int32
+
+############### Writing ###########################################################################################
+
+    def write_grid(self, param_names, param_units, param_values, n_flares, trigger_logic=None):
+        os.makedirs(self.store_dir, exist_ok=True)
+        grid = {'param_names': list(param_names), 'param_units': list(param_units),
+                'param_values': [np.asarray(values).tolist() for values in param_values], 'n_flares': int(n_flares),
+                'no_trigger': self.no_trigger, 'trigger_logic': trigger_logic}
+        with open(os.path.join(self.store_dir, 'grid.json'), 'w') as grid_file:
+            json.dump(grid, grid_file, indent=1)
+
+    def open_writer(self, first_combo_id, n_combinations, n_flares, max_flare_length):
+        ''' Makes this core's trigger file (memory mapped, every entry no_trigger to start with) for the combo_ids 
+        first_combo_id to first_combo_id + n_combinations, so rows can be written in any order (the trie engine goes in
+        trie order).
+        '''
+        os.makedirs(self.store_dir, exist_ok=True)
+        self.trigger_file = os.path.join(self.store_dir, f'triggers_{first_combo_id}.npy')
+        self.temp_file = f'{self.trigger_file}.{os.getpid()}.npy'
+        self.triggers = np.lib.format.open_memmap(self.temp_file, mode='w+', dtype=self.index_dtype(max_flare_length),
+                        shape=(n_combinations, n_flares))
+        self.triggers[:] = self.no_trigger
+
+    def write_row(self, j, trigger_indices):
+        self.triggers[j] = trigger_indices
+
+    def close(self):
+        self.triggers.flush()
+        self.triggers = None
+        os.replace(self.temp_file, self.trigger_file)
+
+############### Reading ###########################################################################################
+
+    def read_grid(self):
+        with open(os.path.join(self.store_dir, 'grid.json')) as grid_file:
+            return json.load(grid_file)
+
+    def iterate_chunks(self):
+        ''' Yields (first combo_id, combinations, memory mapped trigger indices) of every core's file, in combo_id order.
+        The combinations are a ParameterGrid of the file's combo_id range, so they are only decoded when indexed.
+        '''
+        param_values = self.read_grid()['param_values']
+        file_ids = [os.path.basename(f)[len('triggers_'):-len('.npy')] for f in glob.glob(os.path.join(self.store_dir, 'triggers_*.npy'))]
+        first_combo_ids = sorted(int(file_id) for file_id in file_ids if file_id.isdigit()) #skips unfinished temp files
+        for first_combo_id in first_combo_ids:
+            triggers = np.load(os.path.join(self.store_dir, f'triggers_{first_combo_id}.npy'), mmap_mode='r')
+            combos = ParameterGrid(param_values, first_combo_id, first_combo_id + len(triggers))
+            yield first_combo_id, combos, triggers
+
+    @staticmethod
+    def count_outcomes(trigger_indices, observation_table, truths, timings=(None,), cancellation_table=None, block_size=4096):
+        ''' Confusion matrix counts of every row (combination) of a trigger index matrix, against every truth label, for
+        every launch timing and every cancellation rule. The triggered (flare, trigger index) pairs are found once per 
+        block, and each timing and rule is then only a gather of its window values and cancellations and a bincount.
+
+        Input:
+        trigger_indices = (combinations, flares) trigger indices, with -1 for no trigger.
+        observation_table = ObservationWindowTable that decides the launch state of each (flare, trigger index).
+        truths = {label: bool array over the flares}.
+        timings = list of LaunchTiming (see observation_windows.py), None for the table's own timing.
+        cancellation_table = CancellationTable of the rules to count with (see cancellation_rules.py), None for the 
+            table's own cancellation.
+
+        Returns (triggered, {label: (timings, rules, combinations, CONFUSION_COLUMNS) counts}), where triggered is True for every
+        combination with at least one trigger (the ones the usual pipeline gives a score).
+        '''
+        n_combos, n_flares = trigger_indices.shape
+        n_columns = len(lo.CONFUSION_COLUMNS)
+        triggered = np.zeros(n_combos, dtype=bool)
+        n_rules = 1 if cancellation_table is None else len(cancellation_table.rules)
+        counts = {}
+        for label, truth in truths.items():
+            truth = np.asarray(truth, dtype=bool)
+            #every flare starts as no trigger, and the triggered ones are moved to their launch state's box
+            counts[label] = np.zeros((len(timings), n_rules, n_combos, n_columns), dtype=np.int64)
+            counts[label][..., lo.confusion_category(lo.NO_TRIGGER, False)] = n_flares - truth.sum()
+            counts[label][..., lo.confusion_category(lo.NO_TRIGGER, True)] = truth.sum()
+        for start in range(0, n_combos, block_size):
+            block = np.asarray(trigger_indices[start:start+block_size])
+            rows, flares = np.nonzero(block >= 0)
+            triggered[start:start+len(block)] = np.bincount(rows, minlength=len(block)) > 0
+            block_indices = block[rows, flares].astype(np.int64)
+            flare_truths = {label: np.asarray(truth, dtype=bool)[flares] for label, truth in truths.items()}
+            positions = observation_table.find_positions(flares, block_indices)
+            for t, timing in enumerate(timings):
+                rule_cancellations = [None]
+                if cancellation_table is not None:
+                    check_offset = observation_table.cancellation_offset if timing is None else timing.cancellation_offset
+                    _, rule_cancellations = cancellation_table.find_cancellations(positions, check_offset)
+                for r, cancelled in enumerate(rule_cancellations):
+                    states = observation_table.launch_states(flares, block_indices, timing, cancelled)
+                    for label, truth in flare_truths.items():
+                        moved_to = rows*n_columns + lo.confusion_category(states, truth)
+                        moved_from = rows*n_columns + lo.confusion_category(lo.NO_TRIGGER, truth)
+                        change = np.bincount(moved_to, minlength=len(block)*n_columns) - np.bincount(moved_from, minlength=len(block)*n_columns)
+                        counts[label][t, r, start:start+len(block)] += change.reshape(len(block), n_columns)
+        return triggered, counts
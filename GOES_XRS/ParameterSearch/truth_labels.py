@@ -0,0 +1,102 @@
+import numpy as np
+import pandas as pd
+import re
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from flare_series import FlareSeries, run_lengths
+
+#GOES class letters and the flux of a 1.0 flare of that class
+flux_classes = {'A': 1e-8, 'B': 1e-7, 'C': 1e-6, 'M': 1e-5, 'X': 1e-4}
+DEFAULT_LABEL = 'above C5'
+
+
+def flux_class_name(flux):
+    ''' GOES class name of a flux, like 5e-6 -> 'C5' or 1e-5 -> 'M1'.
+    '''
+    letter = [letter for letter, class_flux in flux_classes.items() if flux >= class_flux or letter == 'A'][-1]
+    return f'{letter}{float(f"{flux/flux_classes[letter]:.6g}"):g}'
+
+
+def class_flux(class_name):
+    ''' Flux of a GOES class name, like 'C5' -> 5e-6. Made from the decimal string, so 'C5' is exactly 5e-6.
+    '''
+    letter, number = class_name[0].upper(), class_name[1:]
+    return float(f'{number}e{int(np.log10(flux_classes[letter]))}')
+
+
+def label_name(flux_threshold, min_duration):
+    return f'above {flux_class_name(flux_threshold)} {min_duration}min'
+
+
+def label_suffix(label):
+    ''' File name suffix of the score files for a label (nothing for the usual above C5 label).
+    '''
+    return '' if label == DEFAULT_LABEL else '_' + label.replace(' ', '_')
+
+
+class TruthLabels:
+    ''' Ground truth labels ("was this a flare we wanted to observe?") for scoring, for any flux threshold and minimum
+    duration: a flare is True if its xrsb flux is above the threshold for at least min_duration samples (minutes) in a
+    row. This is the same check as the above C5 10min FITS column (np.convolve in add_c5_10min_bool_and_em), but for
+    a whole grid of thresholds and durations at once: the run lengths of every threshold's mask are found in one 2D
+    pass over the flat xrsb buffer, and the longest run of each flare then answers every duration.
+
+    Labels are asked for by name, 'above {GOES class} {n}min' (like 'above M1 20min'), or by the name of any bool FITS
+    column (like 'above C5'), which is used as it is.
+
+    Input:
+    flare_data = the flare FITS columns (FitsCache, SharedDataset.flare_table() or similar).
+    '''
+
+    label_pattern = re.compile(r'^above ([ABCMX][\d.]+) (\d+)min$', re.IGNORECASE)
+
+    def __init__(self, flare_data):
+        self.data = flare_data
+        self.xrsb = None
+
+    def find_longest_runs(self, flux_thresholds):
+        ''' (thresholds, flares) array of the longest run of samples above each threshold in each flare.
+        '''
+        if self.xrsb is None:
+            self.xrsb = FlareSeries.from_arrays(self.data['xrsb']).astype(float)
+        offsets = self.xrsb.offsets
+        runs = run_lengths(self.xrsb.values[None, :] > np.asarray(flux_thresholds, dtype=float)[:, None], offsets)
+        longest = np.zeros((len(flux_thresholds), self.xrsb.n_flares), dtype=np.int64)
+        nonempty = np.flatnonzero(self.xrsb.lengths > 0)
+        if len(nonempty) > 0:
+            longest[:, nonempty] = np.maximum.reduceat(runs, offsets[nonempty], axis=1)
+        return longest
+
+    def make_label_grid(self, flux_thresholds, min_durations):
+        ''' DataFrame of every (flux threshold, min duration) label, one row per flare and one column per label.
+        '''
+        longest = self.find_longest_runs(flux_thresholds)
+        label_df = pd.DataFrame(index=np.arange(longest.shape[1]))
+        for t, flux_threshold in enumerate(flux_thresholds):
+            for min_duration in min_durations:
+                label_df[label_name(flux_threshold, min_duration)] = longest[t] >= min_duration
+        return label_df
+
+    def parse_label(self, name):
+        match = self.label_pattern.match(name)
+        if match is None:
+            raise ValueError(f'{name} is not a FITS column or a label like "above C5 10min"!')
+        return class_flux(match.group(1)), int(match.group(2))
+
+    def labels(self, names):
+        ''' {name: bool array over the flares} for every label name. The generated labels are all made in one pass.
+        '''
+        #the column names are matched without case like the FITS table, also for dict columns (SharedDataset.flare_table())
+        fits_names = {name.lower(): name for name in self.data.keys()}
+        made = {name: np.array(self.data[fits_names[name.lower()]], dtype=bool) for name in names if name.lower() in fits_names}
+        parsed = {name: self.parse_label(name) for name in names if name not in made}
+        if len(parsed) > 0:
+            flux_thresholds = sorted({flux_threshold for flux_threshold, _ in parsed.values()})
+            longest = self.find_longest_runs(flux_thresholds)
+            for name, (flux_threshold, min_duration) in parsed.items():
+                made[name] = longest[flux_thresholds.index(flux_threshold)] >= min_duration
+        return {name: made[name] for name in names}
+
+    def label(self, name):
+        return self.labels([name])[name]
@@ -1,49 +1,229 @@
 import pandas as pd
 import numpy as np
-from astropy.io import fits
-from astropy.table import Table
 from matplotlib import pyplot as plt
 from scipy import stats as st
 import math
 import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from fits_cache import FitsCache
+from flare_series import flare_series_columns
+from trigger_engines import BatchedTriggerEngine, DominanceCubeEngine, MonotoneTriggerEngine
+from crossing_index import CrossingIndex
+from condition_masks import BitsetTriggerEngine, TrieTriggerEngine, find_persistence_columns
+from trigger_logic import LogicTriggerEngine
+from launch_store import LaunchStore
+from trigger_matrix import TriggerMatrixStore
+from observation_windows import ObservationWindowTable, LaunchTiming
+from parameter_grid import ParameterGrid
+import launch_outcomes as lo
+from truth_labels import TruthLabels, DEFAULT_LABEL
 
 
 class ParameterSearch:
     
     flare_fits = '../GOES_XRS_historical_finalversion.fits'
     
-    def __init__(self, parameter_names, parameter_units, parameter_arrays, parameter_combinations, directory):
-        '''Saves .fits file data to Astropy Table structure (works similarly to regular .fits, but also lets you
-        parse the data by rows.)
-        '''
-        fitsfile = fits.open(self.flare_fits)
-        self.data = Table(fitsfile[1].data)[:]
-        self.header = fitsfile[1].header
-        self.param_grid = np.array(parameter_combinations)
-        self.param_arrays = parameter_arrays
+    def __init__(self, parameter_names, parameter_units, parameter_arrays, parameter_combinations, directory, engine='batched', block_size=64, trigger_indices=None, 
+                        mask_memory_budget=2**29, save_launches=True, 
+                        launch_backend='csv', combo_offset=0, flare_data=None, label=DEFAULT_LABEL, save_trigger_matrix=False, 
+                        launch_timing=None, cancellation_rule=None, trigger_logic=None, keep_counts=None):
+        '''Loads the .fits file data from the FITS cache (works similarly to regular .fits, but the light curve columns 
+        don't have to be decoded again every time).
+        
+        engine = 'batched' finds the trigger indices for a block of block_size combinations at once (see trigger_engines.py).
+        'cube' finds them for every combination at once with the dominance cube, one flare at a time.
+        'bitset' checks each (parameter, value) condition once, and keeps it as a packed bitset (up to mask_memory_budget
+        bytes, see condition_masks.py) that is AND-ed for every combination it is in.
+        'trie' uses the same condition masks, but walks the combinations as a trie so shared prefixes are only AND-ed
+        once, and skips everything below an empty prefix. The combinations are done in trie order.
+        'monotone' goes up the last parameter's values for every combination of the others, only rechecking flares that
+        still trigger (from their last trigger index). It also keeps the confusion matrix counts of every combination in 
+        self.confusion_counts (CONFUSION_COLUMNS order, see launch_outcomes.py) with delta updates.
+        'pandas' is the original flare-by-flare loop, which is kept to check against.
+        For a single parameter search, the 'batched' engine uses the saved running maximum of the parameter column 
+        instead (see crossing_index.py), so each value is a binary search per flare.
+        parameter_combinations = (combinations, parameters) array, or a ParameterGrid combo_id range (see 
+        parameter_grid.py), which is decoded a block at a time so the combinations are never all in memory.
+        trigger_indices = (combinations, flares) array of trigger indices that were already found (for example by the 
+        cube engine run on separate cores). If given, no trigger search is done here.
+        save_launches = False skips making and saving the launch DataFrames (and the Launches directory). The confusion 
+        matrix counts of every combination are kept in self.confusion_counts instead, and self.triggered_combinations says
+        which combinations triggered at all (only those get a launch file, and so a score, in the usual pipeline).
+        keep_counts = True keeps self.confusion_counts even with save_launches (the fused search saving its launches too).
+        None is not save_launches: SaveScores counts the launch files later, so confusion_counts is None (and so is 
+        triggered_combinations, unless the LaunchStore needs it for its Triggered column).
+        launch_backend = 'csv' saves a launch csv per combination in Launches, 'parquet' saves every launch in the 
+        LaunchStore instead (see launch_store.py), keyed by combo_id = combo_offset + row of the combination.
+        flare_data = columns to use instead of opening the FITS file (for example SharedDataset.flare_table(), see 
+        shared_dataset.py).
+        label = truth label the confusion matrix counts are made with (see truth_labels.py).
+        save_trigger_matrix = True also saves the trigger index of every (combination, flare) in the TriggerMatrix 
+        directory (see trigger_matrix.py), so the combinations can be rescored later without searching again. Not for 
+        the pandas engine, which never has the trigger indices of a whole combination.
+        launch_timing = LaunchTiming of the latency, prep, launch, observation windows and cancellation check (see 
+        observation_windows.py). The usual 3 + 4 + 2 minutes with 6 minute windows if None.
+        cancellation_rule = CancellationRule that decides Cancelled? (see cancellation_rules.py). The usual xrsa check
+        at launch_timing.cancellation_offset if None.
+        
+        Persistence: a parameter name like 'xrsb persistence' (made by make_param_info) is a grid column of how many 
+        samples in a row the xrsb condition has to hold before it counts. Those searches always use the bitset engine, 
+        which keeps the run lengths of each condition (see condition_masks.py); the other engines only know x >= value.
+        trigger_logic = expression of how the conditions are combined, like 'xrsb | (temp & em)' or 
+        'atleast(3, xrsa, xrsb, 3minxrsa, temp, em)' (see trigger_logic.py). None is the usual AND of every condition.
+        It always uses the logic engine, which evaluates the expression on the cached condition bitsets.
+        '''
+        if flare_data is None:
+            flare_data = FitsCache(self.flare_fits).load() #memory mapped copy of the FITS columns (see fits_cache.py)
+        self.data = flare_data
+        #a ParameterGrid (combo_id range, see parameter_grid.py) is kept as is, so it is decoded while looping
+        self.param_grid = parameter_combinations if isinstance(parameter_combinations, ParameterGrid) else np.array(parameter_combinations)
+        self.param_arrays = flare_series_columns(parameter_arrays) #one FlareSeries per parameter
+        self.n_flares = self.param_arrays[0].n_flares
         self.param_names = parameter_names
+        self.condition_names, self.persistence_columns = find_persistence_columns(parameter_names)
+        self.trigger_logic = trigger_logic
+        self.has_persistence = bool((self.persistence_columns >= 0).any())
         self.param_units = parameter_units
         self.directory = directory
+        self.engine = engine
+        self.block_size = block_size
+        self.trigger_indices = trigger_indices
+        self.mask_memory_budget = mask_memory_budget
+        self.save_launches = save_launches
+        keep_counts = not save_launches if keep_counts is None else keep_counts
+        self.confusion_counts = np.zeros((len(self.param_grid), len(lo.CONFUSION_COLUMNS)), dtype=np.int64) if keep_counts else None
+        self.triggered_combinations = None
+        if keep_counts or (save_launches and launch_backend == 'parquet'):
+            self.triggered_combinations = np.zeros(len(self.param_grid), dtype=bool)
+        self.counts_from_engine = False
+        self.combo_offset = combo_offset
+        self.launch_store = None
+        self.trigger_matrix = None
+        self.truth = TruthLabels(self.data).label(label)
+        self.flare_catalog = self.make_flare_catalog()
+        self.launch_timing = LaunchTiming() if launch_timing is None else launch_timing
+        self.observation_table = ObservationWindowTable.from_timing(self.data['xrsb'], self.data['xrsa'], self.data['time'], self.launch_timing)
+        self.cancellation_rule = cancellation_rule
+        if self.cancellation_rule is not None:
+            self.launch_timing.check_cancellation_rule(self.cancellation_rule)
+            self.observation_table.use_cancellation_rule(self.cancellation_rule, self.data)
         self.calculated_flarelist = [] #has format of [flare #, flare ID, max foxsi, mean foxsi, max hic, mean hic] for each tuple
         self.launches_df = pd.DataFrame(columns=('Flare_Number', 'Flare_ID', 'Trigger_Time', 'Cancelled?', 'Max_FOXSI', 'Mean_FOXSI', 'Max_HiC', 'Mean_HiC', 'Max_FOXSI_and_HiC_C5', 'Max_FOXSI_C5', 
                         'Mean_FOXSI_C5', 'Max_HiC_C5', 'Mean_HiC_C5', 'Flare_C5', 'Flare_C5_10min', 'Flare_Class', 'Flare_Max_Flux', 'Peak_Time', 'Start_to_Peak', 'Background_Flux'))
                         
-        os.makedirs(f'{self.directory}/Launches', exist_ok=True)
+        if self.save_launches and launch_backend == 'parquet':
+            self.launch_store = LaunchStore(self.directory)
+            self.launch_store.open_writer(combo_offset, parameter_names, parameter_units)
+        elif self.save_launches:
+            os.makedirs(f'{self.directory}/Launches', exist_ok=True)
+        if save_trigger_matrix:
+            if (self.engine == 'pandas' or self.param_grid.ndim != 2) and self.trigger_indices is None:
+                raise ValueError('The pandas engine does not find trigger indices, so it cannot save a trigger matrix!')
+            self.trigger_matrix = TriggerMatrixStore(self.directory)
+            self.trigger_matrix.open_writer(combo_offset, len(self.param_grid), self.n_flares, self.param_arrays[0].lengths.max(initial=0))
         
     def loop_through_parameters(self):
         ''' Loops through each parameter, and performes launch analysis on each flare. This is the function you will
         call for each runthrough!!
         '''
-        for j, parameter in enumerate(self.param_grid):
+        for j, parameter, trigger_indices in self.iterate_parameters():
             print(f'starting parameter search for {parameter}')
             parameter_savestring = "_".join([str(param) for param in parameter])
-            self.loop_through_flares(parameter)
+            if self.trigger_matrix is not None:
+                self.trigger_matrix.write_row(j, trigger_indices)
+            if trigger_indices is None:
+                self.loop_through_flares(parameter)
+            elif self.save_launches:
+                self.loop_through_trigger_indices(trigger_indices)
+            else:
+                self.count_trigger_indices(trigger_indices, j)
+                continue
             if len(self.calculated_flarelist)>0:
-                self.perform_postloop_functions(parameter, j)
-                self.save_param_combo_info(parameter)
-                self.save_launch_DataFrame(parameter_savestring)
+                self.count_flarelist(j)
+                if self.save_launches:
+                    self.perform_postloop_functions(parameter, j)
+                    self.save_launch_DataFrame(parameter, parameter_savestring, j)
+                    self.launches_df = self.launches_df.iloc[0:0]
                 self.calculated_flarelist = []
-                self.launches_df = self.launches_df.iloc[0:0]
+        if self.launch_store is not None:
+            self.launch_store.close(self.param_grid, self.triggered_combinations)
+        if self.trigger_matrix is not None:
+            self.trigger_matrix.close()
+            
+
+    def iterate_parameters(self):
+        ''' Returns an iterator of each parameter combination with its index and the trigger index for every flare, 
+        from the chosen engine. With the pandas engine (or a 1D parameter grid) the trigger indices are None, and the 
+        flares are looped through instead.
+        '''
+        if self.trigger_indices is None and self.trigger_logic is not None:
+            return self.iterate_logic_engine()
+        if self.trigger_indices is None and self.has_persistence:
+            return self.iterate_bitset_engine()
+        if self.trigger_indices is None and self.engine == 'cube':
+            #a ParameterGrid already has the values of each parameter, and is only decoded a block at a time for the cells
+            param_values = self.param_grid.param_values if isinstance(self.param_grid, ParameterGrid) else self.param_grid.T
+            cube_engine = DominanceCubeEngine(self.param_arrays, param_values)
+            self.trigger_indices = cube_engine.find_trigger_indices(self.param_grid)
+        if self.trigger_indices is not None:
+            return zip(range(len(self.param_grid)), self.param_grid, self.trigger_indices)
+        if self.engine == 'pandas' or self.param_grid.ndim != 2:
+            return ((j, parameter, None) for j, parameter in enumerate(self.param_grid))
+        if self.engine == 'bitset':
+            return self.iterate_bitset_engine()
+        if self.engine == 'trie':
+            return self.iterate_trie_engine()
+        if self.engine == 'monotone':
+            return self.iterate_monotone_engine()
+        if self.param_grid.shape[1] == 1:
+            return self.iterate_crossing_index()
+        return self.iterate_batched_engine()
+        
+    def iterate_batched_engine(self):
+        trigger_engine = BatchedTriggerEngine(self.param_arrays, self.block_size)
+        for start in range(0, len(self.param_grid), self.block_size):
+            block = self.param_grid[start:start+self.block_size]
+            block_trigger_indices = trigger_engine.find_block_trigger_indices(block)
+            for b, parameter in enumerate(block):
+                yield start + b, parameter, block_trigger_indices[b]
+                
+    def iterate_crossing_index(self):
+        crossing_index = CrossingIndex.load_or_build(self.param_arrays[0])
+        for j, parameter in enumerate(self.param_grid):
+            yield j, parameter, crossing_index.first_crossing(parameter[0])
+            
+    def iterate_bitset_engine(self):
+        bitset_engine = BitsetTriggerEngine(self.param_arrays, self.mask_memory_budget, self.persistence_columns)
+        for j, parameter in enumerate(self.param_grid):
+            yield j, parameter, bitset_engine.find_combination_trigger_indices(parameter)
+        mask_cache = bitset_engine.mask_cache
+        print(f'condition masks: {mask_cache.misses} made, {mask_cache.hits} reused, {mask_cache.evictions} evicted')
+        
+    def iterate_logic_engine(self):
+        logic_engine = LogicTriggerEngine(self.param_arrays, self.trigger_logic, self.condition_names, self.mask_memory_budget, 
+                        self.persistence_columns)
+        for j, parameter in enumerate(self.param_grid):
+            yield j, parameter, logic_engine.find_combination_trigger_indices(parameter)
+        mask_cache = logic_engine.mask_cache
+        print(f'condition masks: {mask_cache.misses} made, {mask_cache.hits} reused, {mask_cache.evictions} evicted')
+        
+    def iterate_trie_engine(self):
+        trie_engine = TrieTriggerEngine(self.param_arrays, self.mask_memory_budget)
+        for j, trigger_indices in trie_engine.iterate_trigger_indices(self.param_grid):
+            yield j, self.param_grid[j], trigger_indices
+        print(f'trie order: {[self.param_names[k] for k in trie_engine.order]}, {trie_engine.skipped_combinations} combinations skipped')
+        
+    def iterate_monotone_engine(self):
+        #the engine only keeps counts if it gets the flare data, so it only gets it when the counts are kept here
+        counts_data = None if self.confusion_counts is None else self.data
+        monotone_engine = MonotoneTriggerEngine(self.param_arrays, counts_data, truth=self.truth, observation_table=self.observation_table)
+        self.counts_from_engine = counts_data is not None
+        for j, trigger_indices, counts in monotone_engine.iterate_trigger_indices(self.param_grid):
+            if counts is not None:
+                self.confusion_counts[j] = counts
+            yield j, self.param_grid[j], trigger_indices
+        print(f'{monotone_engine.skipped} (combination, flare) evaluations skipped, {monotone_engine.evaluated} done')
             
 
 ################ Flare Loop Functions ############################################################################   
@@ -64,10 +244,49 @@ class ParameterSearch:
            this is self.data['xrsb])
        parameter: the parameter currently being used (in simple example, this is xrsb flux level)
        '''
-       for i, flare in enumerate(self.param_arrays):
+       for i, flare in enumerate(zip(*self.param_arrays)):
            self.flareloop_check_if_value_surpassed(flare, parameter, i)
            if self.triggered_bool: 
                self.calculate_observed_xrsb_and_cancellation(i)         
+               
+    def loop_through_trigger_indices(self, trigger_indices):
+        ''' Same as loop_through_flares, but using trigger indices that were already found for every flare (-1 means 
+        the flare did not trigger). The launch records are gathered from the observation window table, so no 
+        observation windows are sliced here.
+        '''
+        triggered = np.flatnonzero(trigger_indices >= 0)
+        self.calculated_flarelist = self.observation_table.launch_records(triggered, trigger_indices[triggered], self.data['flare ID'])
+
+    def count_trigger_indices(self, trigger_indices, j):
+        ''' Fused search and score: saves the confusion matrix counts of combination j straight from its trigger 
+        indices, without making the launch DataFrame. (The monotone engine already keeps the counts.)
+        '''
+        triggered = np.flatnonzero(trigger_indices >= 0)
+        if len(triggered) == 0:
+            return
+        self.triggered_combinations[j] = True
+        if self.counts_from_engine:
+            return
+        states = np.full(self.n_flares, lo.NO_TRIGGER)
+        states[triggered] = self.observation_table.launch_states(triggered, trigger_indices[triggered])
+        self.confusion_counts[j] = lo.confusion_counts(states, self.truth)
+        
+    def count_flarelist(self, j):
+        ''' Saves the confusion matrix counts of combination j from the calculated flarelist, the same way SaveScores
+        would count the saved launch file (NaN HiC observations are dropped, so they count as no trigger). Only the 
+        triggered flag is saved when the counts are not kept (save_launches).
+        '''
+        if self.triggered_combinations is not None:
+            self.triggered_combinations[j] = True
+        if self.confusion_counts is None or self.counts_from_engine:
+            return
+        flares, _, cancellation_bools, _, foxsi_max, _, hic_max, _ = [np.asarray(column) for column in zip(*self.calculated_flarelist)]
+        flare_states = np.where((foxsi_max > 5e-6) & (hic_max > 5e-6), lo.LAUNCH_OBSERVED, lo.LAUNCH_NOT_OBSERVED)
+        flare_states[np.asarray(cancellation_bools, dtype=float) == 1] = lo.CANCELLED
+        flare_states[np.isnan(np.asarray(hic_max, dtype=float))] = lo.NO_TRIGGER
+        states = np.full(self.n_flares, lo.NO_TRIGGER)
+        states[flares.astype(int)] = flare_states
+        self.confusion_counts[j] = lo.confusion_counts(states, self.truth)
 
     def flareloop_check_if_value_surpassed(self, arrays, parameters, i):
         ''' Process used to loop through flares when there is only a value being checked, and whether the curve
@@ -95,17 +314,22 @@ class ParameterSearch:
         elif isinstance(parameters, np.int64):
             triggered_check = np.where(arrays > parameters)[0]
         else:
-            for arr, p in zip(arrays, parameters):
-                df[f'param {p}'] = np.array(arr) >= p
+            for k, (arr, p) in enumerate(zip(arrays, parameters)):
+                df[f'param {k}'] = np.array(arr) >= p
             truth_df = df.all(1)
             triggered_check = np.where(truth_df == True)[0]
         if not len(triggered_check)==0:
             self.triggered_bool = True
-            self.trigger_index = triggered_check[0]
-            self.foxsi_obs_start = self.trigger_index + 3 + 4 + 2 #latency + launch prep + launch time
-            self.foxsi_obs_end = self.foxsi_obs_start + 6
-            self.hic_obs_start = self.foxsi_obs_start + 2
-            self.hic_obs_end = self.hic_obs_start + 6
+            self.save_observation_windows(triggered_check[0])
+            
+    def save_observation_windows(self, trigger_index):
+        ''' Saves the trigger index, and the FOXSI and HiC observation start/end indices that come from it.
+        '''
+        self.trigger_index = trigger_index
+        self.foxsi_obs_start = self.trigger_index + self.launch_timing.foxsi_offset #latency + launch prep + launch time
+        self.foxsi_obs_end = self.foxsi_obs_start + self.launch_timing.foxsi_window
+        self.hic_obs_start = self.foxsi_obs_start + self.launch_timing.hic_delay
+        self.hic_obs_end = self.hic_obs_start + self.launch_timing.hic_window
             
 
     def calculate_observed_xrsb_and_cancellation(self, i):
@@ -131,8 +355,13 @@ class ParameterSearch:
             hic_mean_observed = np.mean(hic_obs_xrsb)
         flare_ID = self.data['flare ID'][i]
         trigger_time = self.data['time'][i][self.trigger_index]
-        if (self.trigger_index + 3) < len(self.data['xrsa'][i]):
-            cancellation_bool = (self.data['xrsa'][i][self.trigger_index + 3] - self.data['xrsa'][i][self.trigger_index]) < 0
+        cancellation_index = self.trigger_index + self.launch_timing.cancellation_offset
+        if self.cancellation_rule is not None: #other rules are looked up in the observation table
+            position = self.observation_table.find_positions(i, self.trigger_index)
+            has_check = self.observation_table.has_cancellation_check[position]
+            cancellation_bool = bool(self.observation_table.cancelled[position]) if has_check else math.nan
+        elif cancellation_index < len(self.data['xrsa'][i]):
+            cancellation_bool = (self.data['xrsa'][i][cancellation_index] - self.data['xrsa'][i][self.trigger_index]) < 0
         else:
             cancellation_bool = math.nan
         self.calculated_flarelist.append([i, flare_ID, cancellation_bool, trigger_time, foxsi_max_observed, foxsi_mean_observed, hic_max_observed, hic_mean_observed])
@@ -151,19 +380,26 @@ class ParameterSearch:
         '''
         self.launches_df[['Flare_Number', 'Flare_ID', 'Cancelled?', 'Trigger_Time', 'Max_FOXSI', 'Mean_FOXSI', 'Max_HiC', 'Mean_HiC']] = self.calculated_flarelist  
     
+    def make_flare_catalog(self):
+        ''' Typed DataFrame of the FITS info that gets saved with every launch, with one row per flare (so the row is the 
+        flare number).
+        '''
+        catalog_columns = {'Flare_Class': 'class', 'Flare_Max_Flux': 'peak flux', 'Start_to_Peak': 'start to peak time', 
+                        'Flare_C5': 'above C5', 'Flare_C5_10min': 'above C5 10min', 'Background_Flux': 'background flux', 
+                        'Peak_Time': 'UTC peak time'}
+        flare_catalog = pd.DataFrame()
+        for launch_column, fits_column in catalog_columns.items():
+            column = np.asarray(self.data[fits_column])
+            flare_catalog[launch_column] = column.astype(column.dtype.newbyteorder('='))
+        return flare_catalog
+    
     def save_fitsinfo_to_df(self):
         ''' Saves the flare class, peak flux, start to peak time, and if flare is above C5 bool info from the FITS file
-        using the flare number. 
-        '''
-        for f, flare_id in enumerate(self.launches_df['Flare_ID']):
-            launched_flare = np.where(flare_id == self.data['flare ID'])[0][0]
-            self.launches_df.loc[f, 'Flare_Class'] = self.data['class'][launched_flare]
-            self.launches_df.loc[f, 'Flare_Max_Flux'] = self.data['peak flux'][launched_flare]
-            self.launches_df.loc[f, 'Start_to_Peak'] = self.data['start to peak time'][launched_flare]
-            self.launches_df.loc[f, 'Flare_C5'] = self.data['above C5'][launched_flare]
-            self.launches_df.loc[f, 'Flare_C5_10min'] = self.data['above C5 10min'][launched_flare]
-            self.launches_df.loc[f, 'Background_Flux'] = self.data['background flux'][launched_flare]
-            self.launches_df.loc[f, 'Peak_Time'] = self.data['UTC peak time'][launched_flare]
+        using the flare number. All launches are joined to the flare catalog at once.
+        '''
+        launched_flares = np.array(self.launches_df['Flare_Number'], dtype=int)
+        for column in self.flare_catalog.columns:
+            self.launches_df[column] = self.flare_catalog[column].values[launched_flares]
     
     def calculate_c5_bool(self):
         ''' Saves True/False boolean results, for if the Flare and the observed flux is above C5. (Done for the flare 
@@ -186,6 +422,13 @@ class ParameterSearch:
         print(len(self.launches_df['Flare_ID']))
         
         
-    def save_launch_DataFrame(self, parameter_savestring):
+    def save_launch_DataFrame(self, parameter, parameter_savestring, j):
+        ''' Saves the launches of combination j, to the LaunchStore (the combination values go in its combo table) or
+        to its own csv in Launches.
+        '''
+        if self.launch_store is not None:
+            self.launch_store.append_launches(self.launches_df, self.combo_offset + j)
+            return
+        self.save_param_combo_info(parameter)
         self.launches_df.to_csv(f'{self.directory}/Launches/{parameter_savestring}_results.csv')
         print('launch dataframe saved!')
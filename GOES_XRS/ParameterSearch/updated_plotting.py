@@ -4,6 +4,7 @@ import numpy as np
 import pandas as pd
 import os
 from astropy.io import fits
+from launch_store import LaunchStore
 
 
 class PlottingResults:
@@ -146,12 +147,20 @@ class LaunchPlotting:
     def __init__(self, combo_dict, nice_keys_list, flare_fits, out_dir, savestring):
         self.combo_dict = combo_dict
         self.nice_keys_list = nice_keys_list
-        self.launch_combo_list = os.listdir(os.path.join(out_dir, 'Launches'))
+        self.launch_store = LaunchStore(out_dir)
+        if not self.launch_store.exists():
+            self.launch_combo_list = os.listdir(os.path.join(out_dir, 'Launches'))
         fitsfile = fits.open(flare_fits)
         self.all_flare_data = fitsfile[1].data
         self.savestring = savestring
 
     def find_correct_launch_file(self):
+        ''' Reads the launches of combo_dict. From the LaunchStore, the combination is looked up by value in the combo 
+        table, otherwise the launch csv name is made from the values.
+        '''
+        if self.launch_store.exists():
+            self.launch_combo_df = self.launch_store.read_combo_launches(self.combo_dict)
+            return
         param_combo_string = "_".join([str(val) for val in self.combo_dict.values()])
         launch_csv_str = "_".join([param_combo_string, 'results.csv'])
         self.launch_combo_df = pd.read_csv(os.path.join(out_dir, 'Launches', launch_csv_str))
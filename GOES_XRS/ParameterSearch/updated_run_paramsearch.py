@@ -1,22 +1,36 @@
 import updated_paramsearch as ps
 import updated_save_scores as ss
+import trigger_engines as te
+import threshold_sweep as tsw
+import launch_outcomes as lo
+from launch_store import LaunchStore
+from trigger_matrix import TriggerMatrixStore
+from parameter_grid import ParameterGrid
+from observation_windows import ObservationWindowTable, LaunchTiming
+from cancellation_rules import CancellationTable
+from condition_masks import persistence_name, find_persistence_columns
+from truth_labels import TruthLabels
+from truth_labels import DEFAULT_LABEL, label_suffix
+from shared_dataset import SharedDataset
 import os
-from astropy.io import fits
 import numpy as np
 import pandas as pd
 import functools
+import re
 import warnings
 import sys
 import multiprocessing as mp
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from fits_cache import FitsCache
+from feature_store import FeatureStore, load_column, load_columns
 warnings.filterwarnings("ignore")
 
 calculated_params = '../GOES_computed_parameters.fits' #change depending on if you put your fits file somewhere else!
-cparam_hdu = fits.open(calculated_params)
-cparam = cparam_hdu[1].data
+cparam = FitsCache(calculated_params).load() #memory mapped, only decoded from the FITS file once (see fits_cache.py)
 
 flare_fits = '../GOES_XRS_historical_finalversion.fits'
-fitsfile = fits.open(flare_fits)
-flare_data = fitsfile[1].data
+flare_data = FitsCache(flare_fits).load()
+features = FeatureStore(flare_fits) #derived columns made on first use and cached (see feature_store.py)
 
 
 ################# Dictionary of all Parameters ################################################################        
@@ -40,11 +54,11 @@ params = {
     '3minpctxrsb': [[5, 10, 20, 30, 40, 50], cparam['XRSB 3-min Differences %'], '%'],
     '4minpctxrsb': [[5, 10, 20, 30, 40, 50], cparam['XRSB 4-min Differences %'], '%'],
     '5minpctxrsb': [[5, 10, 20, 30, 40, 50], cparam['XRSB 5-min Differences %'], '%'],
-    '1minpctxrsa': [[5, 10, 20, 30, 40, 50], cparam['XRSB 1-min Differences %'], '%'],
-    '2minpctxrsa': [[5, 10, 20, 30, 40, 50], cparam['XRSB 2-min Differences %'], '%'],
-    '3minpctxrsa': [[5, 10, 20, 30, 40, 50], cparam['XRSB 3-min Differences %'], '%'],
-    '4minpctxrsa': [[5, 10, 20, 30, 40, 50], cparam['XRSB 4-min Differences %'], '%'],
-    '5minpctxrsa': [[5, 10, 20, 30, 40, 50], cparam['XRSB 5-min Differences %'], '%'],
+    '1minpctxrsa': [[5, 10, 20, 30, 40, 50], cparam['XRSA 1-min Differences %'], '%'],
+    '2minpctxrsa': [[5, 10, 20, 30, 40, 50], cparam['XRSA 2-min Differences %'], '%'],
+    '3minpctxrsa': [[5, 10, 20, 30, 40, 50], cparam['XRSA 3-min Differences %'], '%'],
+    '4minpctxrsa': [[5, 10, 20, 30, 40, 50], cparam['XRSA 4-min Differences %'], '%'],
+    '5minpctxrsa': [[5, 10, 20, 30, 40, 50], cparam['XRSA 5-min Differences %'], '%'],
     '1mintemp': [[.05, .1, .25, .5, 1], cparam['Temp 1-min Differences'], ''],
     '2mintemp': [[.05, .1, .25, .5, 1], cparam['Temp 2-min Differences'], ''],
     '3mintemp': [[.05, .1, .25, .5, 1], cparam['Temp 3-min Differences'], ''],
@@ -57,25 +71,131 @@ params = {
     '3minem': [[1e47, 3e47, 5e47, 7e47], flare_data['3-min em diff'], 'cm^-3'], 
     '4minem': [[1e47, 3e47, 5e47, 7e47, 1e48], flare_data['4-min em diff'], 'cm^-3'], 
     '5minem': [[0, 1e47, 5e47, 7e47, 1e48, 3e48], flare_data['5-min em diff'], 'cm^-3'], 
+    #these are not in the FITS files, the feature store makes them the first time they are used:
+    '7minxrsb': [[1e-8, 5e-8, 1e-7, 5e-7, 1e-6, 5e-6], features.diff('xrsb', 7), 'W/m^2'],
+    '10minxrsb': [[1e-8, 5e-8, 1e-7, 5e-7, 1e-6, 5e-6], features.diff('xrsb', 10), 'W/m^2'],
+    '7minxrsa': [[1e-8, 5e-8, 1e-7, 5e-7, 1e-6, 5e-6], features.diff('xrsa', 7), 'W/m^2'],
+    '10minxrsa': [[1e-8, 5e-8, 1e-7, 5e-7, 1e-6, 5e-6], features.diff('xrsa', 10), 'W/m^2'],
+    '7mintemp': [[.05, .1, .25, .5, 1], features.temp_diff(7), ''],
+    '1minpctem': [[5, 10, 20, 30, 40, 50], features.pct_diff('em', 1), '%'],
+    '2minpctem': [[5, 10, 20, 30, 40, 50], features.pct_diff('em', 2), '%'],
+    '3minpctem': [[5, 10, 20, 30, 40, 50], features.pct_diff('em', 3), '%'],
+    #any feature can be written as an expression over the light curves (see feature_expressions.py):
+    '3minxrsarise': [[.01, .05, .1, .2, .5], features.expression('(xrsa - lag(xrsa,3)) / xrsb'), ''],
+    '3minemmean': [[0, 5e47, 1e48, 2e48, 3e48, 4e48, 5e48], features.expression('rolling_mean(em,3)'), 'cm^-3'],
+    '3minxrsbmean': [[0, 1e-6, 2.5e-6, 5e-6, 7.5e-6], features.expression('rolling_mean(xrsb,3)'), 'W/m^2'],
+    '3minpctxrsbmean': [[5, 10, 20, 30, 40, 50], features.expression('pct_diff(rolling_mean(xrsb,3),3)'), '%'],
     
     }
     
-def make_param_info(keys_list):
-    param_combinations = np.array(np.meshgrid(*[params[key][0] for key in keys_list])).T.reshape(-1, len(keys_list))
-    param_arrays = list(zip(*[params[key][1] for key in keys_list]))
-    param_units = [params[key][2] for key in keys_list]
-    return keys_list, param_combinations, param_arrays, param_units  
+def make_param_values(keys_list, persistence=None):
+    ''' Names, values and units of every grid column: the keys_list parameters, and then a '{key} persistence' column
+    for every key of persistence ({key: list of minutes the condition has to hold for in a row}).
+    '''
+    persistence = {} if persistence is None else persistence
+    unknown = [key for key in persistence if key not in keys_list]
+    if len(unknown) > 0:
+        raise ValueError(f'{unknown} have a persistence but are not in the keys list!')
+    persistence_keys = [key for key in keys_list if key in persistence]
+    param_names = list(keys_list) + [persistence_name(key) for key in persistence_keys]
+    param_values = [params[key][0] for key in keys_list] + [persistence[key] for key in persistence_keys]
+    param_units = [params[key][2] for key in keys_list] + ['min']*len(persistence_keys)
+    return param_names, param_values, param_units
+
+def make_param_info(keys_list, persistence=None):
+    param_names, param_values, param_units = make_param_values(keys_list, persistence)
+    param_combinations = ParameterGrid(param_values) #decoded from the combo_id when needed (see parameter_grid.py)
+    param_arrays = load_columns([params[key][1] for key in keys_list]) #one FlareSeries per parameter
+    return param_names, param_combinations, param_arrays, param_units  
 
 ################################################################################################################
     
-def run_paramsearch(param_directory, param_names, param_units, param_array_list, param_combo_list):
-    #tag, param_combo_list = param_combo_list #keep this saved so I can remember it for the param combos stuff
-    param_search = ps.ParameterSearch(param_names, param_units, param_array_list, param_combo_list, param_directory)
+def triggered_counts(param_search):
+    ''' Compact result sent back to the parent process: the combinations that triggered and their confusion counts.
+    None if the search did not keep counts (it saved launches for SaveScores instead).
+    '''
+    if param_search.confusion_counts is None:
+        return None
+    triggered = param_search.triggered_combinations
+    return param_search.param_grid[triggered], param_search.confusion_counts[triggered]
+    
+def make_shared_dataset(keys_list, flare_columns=None):
+    ''' Puts the flare data columns (all of them, or just flare_columns) and the keys_list parameter columns in shared
+    memory (see shared_dataset.py). The parameter columns are named 'param {key}'.
+    '''
+    if flare_columns is None:
+        flare_columns = flare_data.names
+    columns = {name: flare_data[name] for name in flare_columns}
+    columns.update(zip([f'param {key}' for key in keys_list], load_columns([params[key][1] for key in keys_list])))
+    return SharedDataset.create(columns)
+    
+def attach_shared_dataset(param_names, dataset):
+    ''' Zero-copy param_arrays and flare data columns for a worker, from the shared dataset descriptor.
+    '''
+    shared = SharedDataset.attach(dataset)
+    condition_names, _ = find_persistence_columns(param_names)
+    return shared, shared.param_arrays([f'param {key}' for key in condition_names]), shared.flare_table()
+    
+def run_paramsearch(param_directory, param_names, param_units, param_array_list, param_combo_list, engine='batched', save_launches=True, 
+                        launch_backend='csv', dataset=None, label=DEFAULT_LABEL, save_trigger_matrix=False, trigger_logic=None, cancellation_rule=None, 
+                        keep_counts=None):
+    combo_offset, param_combo_list = param_combo_list #first combo_id of this core's combinations (for the LaunchStore)
+    shared_flare_data = None
+    if dataset is not None:
+        shared, param_array_list, shared_flare_data = attach_shared_dataset(param_names, dataset)
+    param_search = ps.ParameterSearch(param_names, param_units, param_array_list, param_combo_list, param_directory, engine=engine, 
+                        save_launches=save_launches, launch_backend=launch_backend, combo_offset=combo_offset, flare_data=shared_flare_data, 
+                        label=label, save_trigger_matrix=save_trigger_matrix, trigger_logic=trigger_logic, cancellation_rule=cancellation_rule, 
+                        keep_counts=keep_counts)
     param_search.loop_through_parameters()
+    return triggered_counts(param_search)
+    
+def run_paramsearch_from_triggers(param_directory, param_names, param_units, param_array_list, combos_and_triggers, save_launches=True, 
+                        launch_backend='csv', dataset=None, label=DEFAULT_LABEL, save_trigger_matrix=False, cancellation_rule=None, keep_counts=None):
+    combo_offset, param_combo_list, trigger_indices = combos_and_triggers
+    shared_flare_data = None
+    if dataset is not None:
+        shared, param_array_list, shared_flare_data = attach_shared_dataset(param_names, dataset)
+    param_search = ps.ParameterSearch(param_names, param_units, param_array_list, param_combo_list, param_directory, trigger_indices=trigger_indices, 
+                        save_launches=save_launches, launch_backend=launch_backend, combo_offset=combo_offset, flare_data=shared_flare_data, 
+                        label=label, save_trigger_matrix=save_trigger_matrix, cancellation_rule=cancellation_rule, keep_counts=keep_counts)
+    param_search.loop_through_parameters()
+    return triggered_counts(param_search)
+    
+def run_dominance_cube(param_values, param_combinations, flare_arrays):
+    cube_engine = te.DominanceCubeEngine(flare_arrays, param_values)
+    return cube_engine.find_trigger_indices(param_combinations)
+    
+def run_multiprocessing_paramsearch(keys_list, out_dir, engine='batched', save_launches=True, launch_backend='csv', use_shared_memory=True, 
+                        label=DEFAULT_LABEL, save_trigger_matrix=False, persistence=None, trigger_logic=None, cancellation_rule=None, 
+                        keep_counts=None):
+    ''' Runs the parameter search for every combination of the keys_list values, split up over all the cores.
+    
+    engine = 'batched' or 'pandas' split the combinations over the cores, and each core searches its own combinations.
+    'cube' first splits the flares over the cores to find the trigger indices of every combination with the dominance
+    cube, and then splits the combinations (with their trigger indices) over the cores to save the launches.
+    save_launches = False doesn't write the Launches directory (see run_multiprocessing_fused_search).
+    launch_backend = 'csv' for the Launches directory, or 'parquet' for the LaunchStore (combo_id = row of the 
+    combination in param_combinations).
+    use_shared_memory = True puts the flare data and parameter columns in shared memory once, and only sends the cores
+    a descriptor of it, instead of every core opening the FITS file and getting its own copy of param_arrays.
+    label = truth label of the confusion counts that are sent back (see truth_labels.py).
+    save_trigger_matrix = True also saves every trigger index in out_dir/TriggerMatrix, for rescore.
+    persistence = {key: list of minutes} to also sweep how long the key's condition has to hold in a row (see 
+    make_param_values). These searches use the bitset engine on every core, and can't use the cube.
+    trigger_logic = expression of how the keys' conditions are combined (see trigger_logic.py), like 
+    'xrsb | (temp & em)'. None is the usual AND. Also done with the condition bitsets, so not with the cube.
+    cancellation_rule = CancellationRule that decides Cancelled? (see cancellation_rules.py), None for the usual one.
+    keep_counts = True counts the confusion matrices even when the launches are saved (see run_multiprocessing_fused_search).
+    None only counts them when they are not saved.
     
-def run_multiprocessing_paramsearch(keys_list, out_dir):
+    Returns a list (one per core) of (triggered combinations, their confusion counts), or of None if the counts were 
+    not kept (the launches are scored with run_multiprocessing_savescores instead).
+    '''
     os.makedirs(out_dir, exist_ok=True)
-    param_names, param_combinations, param_arrays, param_units = make_param_info(keys_list)
+    param_names, param_combinations, param_arrays, param_units = make_param_info(keys_list, persistence)
+    if (persistence or trigger_logic is not None) and engine == 'cube':
+        raise ValueError('The dominance cube does not do persistence or trigger logic, use another engine!')
     #getting the number of cores for the slurm job
     try:
         num_cores = int(sys.argv[1])
@@ -83,24 +203,86 @@ def run_multiprocessing_paramsearch(keys_list, out_dir):
         num_cores = os.cpu_count()
     print('num cores used:', num_cores)
     print('Total Params:', len(param_combinations))
-    #splitting the array so all available cores are used
-    splitup = np.array_split(param_combinations, num_cores) 
+    #splitting the combo_ids so all available cores are used (each core only gets its range, see parameter_grid.py)
+    splitup = param_combinations.split(num_cores)
+    combo_offsets = [split.start for split in splitup]
     #splitup = [[i, s] for (i, s) in enumerate(splitup)] #dont need this rn since I will be doing the other stuff later!
+    if save_trigger_matrix:
+        TriggerMatrixStore(out_dir).write_grid(param_names, param_units, make_param_values(keys_list, persistence)[1], len(flare_data), 
+                        trigger_logic=trigger_logic)
     #doing the multiple run!
-    call_me = functools.partial(run_paramsearch, out_dir, param_names, param_units, param_arrays)
-    with mp.Pool(num_cores) as p:
-        p.map(call_me, splitup)
+    if engine == 'cube':
+        param_values = [params[key][0] for key in keys_list]
+        flare_splitup = [[series[flares] for series in param_arrays] for flares in np.array_split(np.arange(len(flare_data)), num_cores)]
+        call_cube = functools.partial(run_dominance_cube, param_values, param_combinations)
+        with mp.Pool(num_cores) as p:
+            trigger_indices = np.hstack(p.map(call_cube, flare_splitup))
+        splitup = list(zip(combo_offsets, splitup, np.array_split(trigger_indices, num_cores)))
+        run_search = functools.partial(run_paramsearch_from_triggers, save_launches=save_launches, launch_backend=launch_backend, label=label, 
+                        save_trigger_matrix=save_trigger_matrix, cancellation_rule=cancellation_rule, keep_counts=keep_counts)
+    else:
+        splitup = list(zip(combo_offsets, splitup))
+        run_search = functools.partial(run_paramsearch, engine=engine, save_launches=save_launches, launch_backend=launch_backend, label=label, 
+                        save_trigger_matrix=save_trigger_matrix, trigger_logic=trigger_logic, cancellation_rule=cancellation_rule, 
+                        keep_counts=keep_counts)
+    shared = make_shared_dataset(keys_list) if use_shared_memory else None
+    try:
+        if shared is not None:
+            call_me = functools.partial(run_search, out_dir, param_names, param_units, None, dataset=shared.descriptor)
+        else:
+            call_me = functools.partial(run_search, out_dir, param_names, param_units, param_arrays)
+        with mp.Pool(num_cores) as p:
+            return p.map(call_me, splitup)
+    finally:
+        if shared is not None:
+            shared.unlink()
+        
+def run_multiprocessing_fused_search(keys_list, out_dir, engine='batched', save_launches=False, label=DEFAULT_LABEL, save_trigger_matrix=False, 
+                        persistence=None, trigger_logic=None, cancellation_rule=None):
+    ''' Parameter search and scores in one pass. Each core counts the confusion matrix of every combination as soon as
+    it is searched, and only sends those counts back, so there is no Launches directory (unless save_launches) and no
+    second pass with SaveScores. Saves the same AllParameterScores{label suffix}.csv as run_multiprocessing_savescores.
+    '''
+    param_names, _, param_units = make_param_values(keys_list, persistence)
+    results = run_multiprocessing_paramsearch(keys_list, out_dir, engine=engine, save_launches=save_launches, label=label, 
+                        save_trigger_matrix=save_trigger_matrix, persistence=persistence, trigger_logic=trigger_logic, 
+                        cancellation_rule=cancellation_rule, keep_counts=True)
+    combos = np.concatenate([combo_split for combo_split, _ in results])
+    counts = np.concatenate([count_split for _, count_split in results])
+    total_score_df = ss.make_score_df(combos, counts, param_names, param_units, len(flare_data))
+    total_score_df = total_score_df.sort_values(by=param_names)
+    total_score_df = total_score_df.reset_index(drop=True)
+    total_score_df.to_csv(os.path.join(out_dir, f'AllParameterScores{label_suffix(label)}.csv'))
+    print('All parameter scores saved.')
         
 ##################################################################################################################
 
-def run_savescores(out_dir, param_names, param_units, launches_and_tag):
+def run_savescores(out_dir, param_names, param_units, launches_and_tag, launch_store=None, dataset=None, labels=DEFAULT_LABEL):
     tag, launch_df_list = launches_and_tag
-    save_scores = ss.SaveScores(out_dir, launch_df_list, tag, param_names, param_units)
+    shared_flare_data = None
+    if dataset is not None:
+        shared = SharedDataset.attach(dataset)
+        shared_flare_data = shared.flare_table()
+    save_scores = ss.SaveScores(out_dir, launch_df_list, tag, param_names, param_units, launch_store=launch_store, flare_data=shared_flare_data, 
+                        labels=labels)
     save_scores.loop_through_param_combos() 
     
-def run_multiprocessing_savescores(keys_list, out_dir):
-    param_names, _, _, param_units = make_param_info(keys_list)
-    launches_list = np.array(os.listdir(os.path.join(out_dir, 'Launches')))
+def run_multiprocessing_savescores(keys_list, out_dir, labels=DEFAULT_LABEL, persistence=None):
+    ''' Scores every combination with launches, from the LaunchStore if the search saved one, otherwise from the 
+    Launches csvs.
+    
+    labels = truth label name, or list of names to score the same launches against all of them (see truth_labels.py).
+    Each label gets its own AllParameterScores{label suffix}.csv (just AllParameterScores.csv for 'above C5').
+    persistence = the same persistence the search was run with.
+    '''
+    labels = [labels] if isinstance(labels, str) else list(labels)
+    param_names, _, param_units = make_param_values(keys_list, persistence)
+    launch_store = LaunchStore(out_dir)
+    if launch_store.exists():
+        launches_list = launch_store.triggered_combo_ids()
+    else:
+        launch_store = None
+        launches_list = np.array(os.listdir(os.path.join(out_dir, 'Launches')))
     print(launches_list)
     try:
         num_cores = int(sys.argv[1])
@@ -110,22 +292,148 @@ def run_multiprocessing_savescores(keys_list, out_dir):
     print('Number of combinations:', len(launches_list))  
     splitup = np.array_split(launches_list, num_cores)
     splitup = [[i, s] for (i, s) in enumerate(splitup)]
-    call_me = functools.partial(run_savescores, out_dir, param_names, param_units)
-    with mp.Pool(num_cores) as p:
-        p.map(call_me, splitup)
-    make_large_df(keys_list, out_dir)
+    #the FITS label columns, and the light curve for the labels that are made from it
+    label_columns = [name for name in flare_data.names if name.lower() in [label.lower() for label in labels]]
+    shared = make_shared_dataset([], flare_columns=['flare ID', 'xrsb'] + label_columns)
+    try:
+        call_me = functools.partial(run_savescores, out_dir, param_names, param_units, launch_store=launch_store, dataset=shared.descriptor, 
+                        labels=labels)
+        with mp.Pool(num_cores) as p:
+            p.map(call_me, splitup)
+    finally:
+        shared.unlink()
+    for label in labels:
+        make_large_df(param_names, out_dir, label)
 
-def make_large_df(keys_list, out_dir):
-    if os.path.exists(os.path.join(out_dir, 'AllParameterScores.csv')):
-        os.remove(os.path.join(out_dir, 'AllParameterScores.csv'))
-    score_files = [f for f in os.listdir(out_dir) if f.endswith('.csv')]
+def make_large_df(keys_list, out_dir, label=DEFAULT_LABEL):
+    suffix = label_suffix(label)
+    if os.path.exists(os.path.join(out_dir, f'AllParameterScores{suffix}.csv')):
+        os.remove(os.path.join(out_dir, f'AllParameterScores{suffix}.csv'))
+    score_files = [f for f in os.listdir(out_dir) if re.fullmatch(rf'parameter_scores\d+{re.escape(suffix)}\.csv', f)]
     total_score_df = pd.concat([pd.read_csv(os.path.join(out_dir, file), index_col=0) for file in score_files], ignore_index=True)
     total_score_df = total_score_df.sort_values(by=keys_list)
     total_score_df = total_score_df.reset_index(drop=True)
-    total_score_df.to_csv(os.path.join(out_dir, 'AllParameterScores.csv'))
+    total_score_df.to_csv(os.path.join(out_dir, f'AllParameterScores{suffix}.csv'))
     print('All parameter scores saved.')
     for score_file in score_files:
         os.remove(os.path.join(out_dir, score_file))
+
+def check_fused_against_savescores(keys_list, out_dir, launch_backend='csv', cancellation_rule=None):
+    ''' Scores the keys_list grid both ways, with the fused search (in out_dir/Fused) and with the saved launches and
+    SaveScores (in out_dir/SaveScores), and makes sure every combination gets the same confusion matrix counts. Good
+    to run after changing how launches are decided (like a new CancellationRule), since the two paths count the
+    launches separately.
+
+    Returns the number of flares in each box of each combination from both paths (_fused and _savescores columns).
+    '''
+    fused_dir, savescores_dir = os.path.join(out_dir, 'Fused'), os.path.join(out_dir, 'SaveScores')
+    run_multiprocessing_fused_search(keys_list, fused_dir, cancellation_rule=cancellation_rule)
+    run_multiprocessing_paramsearch(keys_list, savescores_dir, launch_backend=launch_backend, cancellation_rule=cancellation_rule)
+    run_multiprocessing_savescores(keys_list, savescores_dir)
+    count_columns = list(lo.CONFUSION_COLUMNS)
+    fused_df = pd.read_csv(os.path.join(fused_dir, 'AllParameterScores.csv'), index_col=0)
+    savescores_df = pd.read_csv(os.path.join(savescores_dir, 'AllParameterScores.csv'), index_col=0)
+    compare_df = fused_df[keys_list + count_columns].merge(savescores_df[keys_list + count_columns], on=keys_list, how='outer',
+                        suffixes=('_fused', '_savescores'))
+    different = np.zeros(len(compare_df), dtype=bool)
+    for column in count_columns:
+        different |= np.array(compare_df[f'{column}_fused'] != compare_df[f'{column}_savescores'])
+    if different.any():
+        raise ValueError(f'{different.sum()} of {len(compare_df)} combinations have different counts from the fused search and SaveScores!')
+    print(f'Fused search and SaveScores counts match for all {len(compare_df)} combinations.')
+    return compare_df
+
+##################################################################################################################
+
+def rescore(out_dir, labels=DEFAULT_LABEL, score_function=ss.calculate_scores, timings=None, cancellation_rules=None):
+    ''' Scores every combination again from the trigger matrix a search saved (save_trigger_matrix=True), without 
+    running ParameterSearch or SaveScores. Only the launch states and counts are redone, so it takes seconds.
+    
+    labels = truth label name, or list of names (see truth_labels.py).
+    score_function = function(counts DataFrame, n_flares) making the score columns, like 
+    functools.partial(ss.calculate_scores, beta=1) for F1 instead of F0.5.
+    timings = launch timings to sweep, like {'latency': [1, 2, 3], 'foxsi_window': [6, 8]} (see LaunchTiming for the
+    names, the ones not given keep their usual value). Every combination is scored for every timing, and the swept 
+    timings get their own columns (in minutes) after the parameters. The trigger indices don't depend on the timing,
+    so this costs about one rescore per timing, not one search.
+    cancellation_rules = list of CancellationRule to score with (see cancellation_rules.py), like
+    [CancellationRule(), CancellationRule('xrsb', tolerance=.05), CancellationRule('temp', lookback=2)]. Every 
+    combination is scored with every rule, and the rule name goes in a Cancellation_Rule column.
+    
+    Saves the same AllParameterScores{label suffix}.csv as run_multiprocessing_savescores for every label.
+    '''
+    labels = [labels] if isinstance(labels, str) else list(labels)
+    trigger_matrix = TriggerMatrixStore(out_dir)
+    grid = trigger_matrix.read_grid()
+    if grid['n_flares'] != len(flare_data):
+        raise ValueError(f"The trigger matrix has {grid['n_flares']} flares, but the flare FITS file has {len(flare_data)}!")
+    observation_table = ObservationWindowTable(flare_data['xrsb'], flare_data['xrsa'])
+    truths = TruthLabels(flare_data).labels(labels)
+    timing_names = [] if timings is None else list(timings.keys())
+    timing_list = [None] if timings is None else LaunchTiming.make_grid(timings)
+    timing_values = np.array([[getattr(timing, name) for name in timing_names] for timing in timing_list]).reshape(len(timing_list), -1)
+    if cancellation_rules is not None:
+        for timing in timing_list:
+            for rule in cancellation_rules:
+                (LaunchTiming() if timing is None else timing).check_cancellation_rule(rule)
+    cancellation_table = None if cancellation_rules is None else CancellationTable(flare_data, cancellation_rules)
+    n_rules = 1 if cancellation_rules is None else len(cancellation_rules)
+    #every (timing, rule) pair is scored, and the rule # goes in as one more parameter column until the names are put in
+    model_values = np.hstack([np.repeat(timing_values, n_rules, axis=0), np.tile(np.arange(n_rules), len(timing_list))[:, None]])
+    if cancellation_rules is None:
+        model_values = model_values[:, :-1]
+    combo_splits = []
+    count_splits = {label: [] for label in labels}
+    for _, combos, trigger_indices in trigger_matrix.iterate_chunks():
+        triggered, counts = TriggerMatrixStore.count_outcomes(trigger_indices, observation_table, truths, timing_list, cancellation_table)
+        combos = combos[triggered] #only combinations with launches get a score, like SaveScores
+        combo_splits.append(np.hstack([np.tile(combos, (len(model_values), 1)), np.repeat(model_values, len(combos), axis=0)]))
+        for label in labels:
+            count_splits[label].append(counts[label][:, :, triggered].reshape(-1, counts[label].shape[-1]))
+    combos = np.concatenate(combo_splits)
+    param_names = grid['param_names'] + timing_names
+    param_units = grid['param_units'] + ['min']*len(timing_names)
+    if cancellation_rules is not None:
+        param_names, param_units = param_names + ['Cancellation_Rule'], param_units + ['']
+    for label in labels:
+        total_score_df = ss.make_score_df(combos, np.concatenate(count_splits[label]), param_names, param_units, 
+                        len(flare_data), score_function=score_function)
+        total_score_df = total_score_df.sort_values(by=param_names)
+        if cancellation_rules is not None:
+            rule_names = np.array([rule.name for rule in cancellation_rules])
+            total_score_df['Cancellation_Rule'] = rule_names[total_score_df['Cancellation_Rule'].astype(int)]
+            total_score_df = total_score_df.drop(columns='Cancellation_Rule_units')
+        total_score_df = total_score_df.reset_index(drop=True)
+        total_score_df.to_csv(os.path.join(out_dir, f'AllParameterScores{label_suffix(label)}.csv'))
+    print('All parameter scores saved.')
+        
+##################################################################################################################
+
+def run_threshold_sweep(key):
+    sweep = tsw.ThresholdSweep()
+    sweep_df = sweep.sweep_feature(load_column(params[key][1]))
+    sweep_df.insert(0, 'Parameter', key)
+    sweep_df.insert(2, 'Threshold_units', params[key][2])
+    return sweep_df
+    
+def run_multiprocessing_threshold_sweep(out_dir, keys_list=None):
+    ''' Exact single parameter precision/recall curves at every distinct threshold, for every key of the params dict 
+    (or just keys_list). Each core sweeps one key at a time, and all curves are saved to ThresholdSweepScores.csv.
+    '''
+    if keys_list is None:
+        keys_list = list(params.keys())
+    os.makedirs(out_dir, exist_ok=True)
+    try:
+        num_cores = int(sys.argv[1])
+    except IndexError:
+        num_cores = os.cpu_count()
+    print('num cores used:', num_cores)
+    print('Number of parameters:', len(keys_list))
+    with mp.Pool(num_cores) as p:
+        sweep_dfs = p.map(run_threshold_sweep, keys_list)
+    total_sweep_df = pd.concat(sweep_dfs, ignore_index=True)
+    total_sweep_df.to_csv(os.path.join(out_dir, 'ThresholdSweepScores.csv'))
+    print('Threshold sweep scores saved.')
     
 ##################################################################################################################  
 
@@ -1,8 +1,54 @@
 import pandas as pd
 import numpy as np
-from astropy.io import fits
-from astropy.table import Table
 import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from fits_cache import FitsCache
+import launch_outcomes as lo
+from truth_labels import TruthLabels, DEFAULT_LABEL, label_suffix
+
+#bits of the outcome matrix made by SaveScores.save_triggers_launches_obs_cancellations
+TRIGGER_BIT = 1
+LAUNCH_BIT = 2
+OBS_BIT = 4
+CANC_BIT = 8
+
+
+def calculate_scores(score_df, n_flares, beta=0.5):
+    ''' Precision, recall, Gordon, launch/trigger ratio, Fbeta (beta=0.5 unless given) and accuracy scores for every row of a 
+    DataFrame that already has the confusion matrix columns (TN, TN_canc, TP, TP_noc5, FN, FN_canc, FP_c5, FP_noc5). Divisions by zero give inf/NaN instead of an error.
+    '''
+    TN, TN_canc, TP, TP_noc5, FN, FN_canc, FP_c5, FP_noc5 = [score_df[col].astype(float) for col in
+                        ('TN', 'TN_canc', 'TP', 'TP_noc5', 'FN', 'FN_canc', 'FP_c5', 'FP_noc5')]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        precision = (TP + TP_noc5)/(TP + TP_noc5 + FP_c5 + FP_noc5)
+        recall = TP/(TP + FN + FN_canc + FP_c5)
+        score_df['Precision'] = precision
+        score_df['Recall'] = recall
+        score_df['Gordon'] = (FP_c5 + FP_noc5)/(FN_canc + FN)
+        score_df['LaunchTriggerRatio'] = (TP + TP_noc5 + FP_c5 + FP_noc5)/(TP + TP_noc5 + FP_c5 + FP_noc5 + TN_canc + FN_canc)
+        score_df['Fbeta'] = ((1 + beta**2)*precision*recall)/((beta**2*precision) + recall)
+        score_df['Accuracy'] = (TP + TP_noc5 + TN + TN_canc)/n_flares
+    return score_df
+    
+    
+def make_score_df(parameter_combinations, confusion_counts, param_names, param_units, n_flares, score_function=calculate_scores):
+    ''' Makes the same score DataFrame as SaveScores (same columns, one row per combination) from confusion matrix
+    counts that were kept in memory (CONFUSION_COLUMNS order, see launch_outcomes.py) instead of from launch files.
+    score_function = function(counts DataFrame, n_flares) that adds the score columns (like calculate_scores with 
+    another beta). Score columns it adds on top of the usual ones go after them.
+    '''
+    counts_df = pd.DataFrame(np.asarray(confusion_counts).reshape(-1, len(lo.CONFUSION_COLUMNS)), columns=lo.CONFUSION_COLUMNS)
+    score_df = score_function(counts_df, n_flares)
+    score_columns = ['Precision', 'Recall', 'Gordon', 'LaunchTriggerRatio', 'Fbeta', 'Accuracy', 'TN', 'TN_canc', 'FN',
+                        'FN_canc', 'FP_c5', 'FP_noc5', 'TP_noc5', 'TP']
+    score_df = score_df[score_columns + [column for column in score_df.columns if column not in score_columns + list(lo.CONFUSION_COLUMNS)]]
+    combos = np.asarray(parameter_combinations).reshape(len(score_df), len(param_names))
+    for k, param in enumerate(param_names):
+        score_df[param] = combos[:, k]
+        score_df[f'{param}_units'] = param_units[k]
+    return score_df
+    
 
 class SaveScores:
     ''' Class for a multiprocess approach to saving the scores of every Launch file for every parameter combination.
@@ -13,137 +59,137 @@ class SaveScores:
     Launch_df_list = list of launch csv files to be looped over. The scores from each will be appended to a scores dataframe, 
     which will then be saved.
     Tag = number to tag the score csv file when naming it. The number of tags is the number of cores running the script.
+    Launch_store = LaunchStore to read the launches from instead of the Launches csvs (see launch_store.py). Then 
+    Launch_df_list is a list of combo_ids.
+    Batch_size = number of combinations scored at once.
+    Flare_data = columns to use instead of opening the FITS file (see shared_dataset.py).
+    Labels = name of the truth label to score against, or a list of names to score the same launches against all of 
+    them (see truth_labels.py, e.g. 'above C5', 'above M1 20min'). 
     
     Output:
     -----------------------------------------------------------------
-    Score_df = .csv file with this thread's launch scores saved. After the multiprocess is run, a function will combine all of 
+    Score_df = .csv file with this thread's launch scores saved (one per label, see truth_labels.label_suffix). After the multiprocess is run, a function will combine all of 
     these separate scores into one large .csv file.
     '''
     
     flare_fits = '../GOES_XRS_historical_finalversion.fits'
     
-    def __init__(self, out_dir, launch_df_list, tag, param_names, param_units):
-        fitsfile = fits.open(self.flare_fits)
-        self.data = Table(fitsfile[1].data)[:]
-        self.header = fitsfile[1].header
+    def __init__(self, out_dir, launch_df_list, tag, param_names, param_units, launch_store=None, batch_size=1024, flare_data=None, 
+                        labels=DEFAULT_LABEL):
+        if flare_data is None:
+            flare_data = FitsCache(self.flare_fits).load()
+        self.data = flare_data
         self.out_dir = out_dir
         self.launch_dir = os.path.join(out_dir, 'Launches')
         self.launch_df_list = launch_df_list
         self.tag = tag
         self.param_names = param_names
         self.param_units = param_units
+        self.launch_store = launch_store
+        self.batch_size = batch_size
+        self.labels = [labels] if isinstance(labels, str) else list(labels)
+        self.label_truths = TruthLabels(self.data).labels(self.labels)
+        self.all_abovec5 = self.label_truths[self.labels[0]] #all flares above C5- this is the baseline "truth"
+        self.flare_rows = pd.Index(np.array(self.data['flare ID']).tolist()) #flare ID -> row of the flare, made once
         
     def loop_through_param_combos(self):
-        self.score_df = pd.DataFrame(columns=('Precision', 'Recall', 'Gordon', 'LaunchTriggerRatio', 'Fbeta', 'Accuracy', 'TN', 'TN_canc', 'FN', 'FN_canc', 
-                        'FP_c5', 'FP_noc5', 'TP_noc5', 'TP'))
-        self.append_param_names_and_units()
-        for i, param_combo in enumerate(self.launch_df_list):
-            param_df = pd.read_csv(os.path.join(self.launch_dir, param_combo))
-            self.save_triggers_launches_obs_cancellations(param_df)
-            self.save_cf_input(i)
-            self.save_scores(i)
-            self.save_param_combo_values(param_df, i)
-        self.save_score_df()
-            
-    def append_param_names_and_units(self):
-        ''' Using the parameter names and parameter units, make new columns with those values. The parameter name column
-        will be empty, and later will be populated with the specific parameter combination.
+        ''' Scores batch_size combinations at a time: their launch outcomes are packed into one (combinations, flares)
+        matrix, and the confusion matrix boxes and scores of the whole batch are counted at once.
         '''
-        for i, param in enumerate(self.param_names):
-            self.score_df[param] = ''
-            self.score_df[f'{param}_units'] = [self.param_units[i]]*len(self.launch_df_list)
+        if self.launch_store is not None:
+            self.read_launch_store()
+        score_dfs = {label: [] for label in self.labels}
+        for start in range(0, len(self.launch_df_list), self.batch_size):
+            batch = self.launch_df_list[start:start+self.batch_size]
+            param_dfs = [self.read_launch_df(param_combo) for param_combo in batch]
+            outcomes = self.save_triggers_launches_obs_cancellations(param_dfs)
+            for label in self.labels:
+                batch_score_df = self.save_cf_input(outcomes, self.label_truths[label])
+                self.save_param_combo_values(batch_score_df, batch, param_dfs)
+                score_dfs[label].append(batch_score_df)
+        for label in self.labels:
+            if len(score_dfs[label]) > 0:
+                self.score_df = pd.concat(score_dfs[label], ignore_index=True)
+            else:
+                self.score_df = self.save_cf_input(np.zeros((0, len(self.all_abovec5)), dtype=np.uint8))
+                self.save_param_combo_values(self.score_df, [], [])
+            self.score_df = calculate_scores(self.score_df, len(self.data['flare ID']))
+            self.score_df = self.score_df[['Precision', 'Recall', 'Gordon', 'LaunchTriggerRatio', 'Fbeta', 'Accuracy', 'TN', 'TN_canc', 
+                            'FN', 'FN_canc', 'FP_c5', 'FP_noc5', 'TP_noc5', 'TP'] + 
+                            [col for param in self.param_names for col in (param, f'{param}_units')]]
+            self.save_score_df(label)
             
-    def save_triggers_launches_obs_cancellations(self, param_df):
-        '''This saves arrays of true/false for the baseline truth (was the flare above C5), the trigger prediction
-        (there was a trigger), the launch prediction (was there a launch) and the launch/obs prediction 
-        (launch and obs) and cancellation. From this, we can save the scores needed
-        for the confusion matrices. 
+    def read_launch_store(self):
+        ''' Reads only the columns that get scored, for only this core's combinations, from the LaunchStore in one go.
         '''
-        #defining the array that determines if a flare is above C5
-        self.all_abovec5 = self.data['above C5'] #all flares above C5- this is the baseline "truth"
-        
-        #make an array that determines whether there was a trigger
-        all_flareID = self.data['flare ID']
-        flareID_triggers = np.array(param_df['Flare_ID'])
-        trigger_indx = []
-        for flare in flareID_triggers:
-            indx = np.where(flare==all_flareID)[0][0]
-            trigger_indx.append(indx)
-        self.trigger_array = np.array([False]*len(all_flareID))
-        np.put(self.trigger_array, trigger_indx, True)   
-        
-        #make an array that determines whether there was a launch
-        flareID_launches = np.array(param_df['Flare_ID'][param_df['Cancelled?']==False])
-        launch_indx = []
-        for flare in flareID_launches:
-            indx = np.where(flare==all_flareID)[0][0]
-            launch_indx.append(indx)
-        self.launch_array = np.array([False]*len(all_flareID))
-        np.put(self.launch_array, launch_indx, True)
-        
-        #make an array that defines where flux above C5 was observed by both FOXSI and HIC
-        flareID_observations = np.array(param_df['Flare_ID'][(param_df['Cancelled?']==False) & (param_df['Max_FOXSI_and_HiC_C5']==True)])
-        obs_indx = []
-        for flare in flareID_observations:
-            indx = np.where(flare==all_flareID)[0][0]
-            obs_indx.append(indx)
-        self.obs_array = np.array([False]*len(all_flareID))
-        np.put(self.obs_array, obs_indx, True)
-        
-        #make an array that defines where the launch was cancelled
-        flareID_cancellations = np.array(param_df['Flare_ID'][param_df['Cancelled?']==True])
-        canc_indx = []
-        for flare in flareID_cancellations:
-            indx = np.where(flare==all_flareID)[0][0]
-            canc_indx.append(indx)
-        self.canc_array = np.array([False]*len(all_flareID))
-        np.put(self.canc_array, canc_indx, True)
-        
-    def save_cf_input(self, i):
-        ''' This is where we save the values for each box of the 4x2 confusion matrix. I'll now save all of this as
-        columns in the launch dataframe. More work on the front end, but plotting will be easier!
+        store_launches = self.launch_store.read_launches(self.launch_df_list, columns=['Flare_ID', 'Cancelled?', 'Max_FOXSI_and_HiC_C5'])
+        self.store_launches = dict(list(store_launches.groupby('combo_id')))
+        combo_df = self.launch_store.read_combos().set_index('combo_id')
+        self.store_combos = combo_df.loc[list(self.launch_df_list), self.param_names]
+            
+    def read_launch_df(self, param_combo):
+        if self.launch_store is None:
+            return pd.read_csv(os.path.join(self.launch_dir, param_combo))
+        empty_df = pd.DataFrame(columns=['Flare_ID', 'Cancelled?', 'Max_FOXSI_and_HiC_C5'])
+        return self.store_launches.get(param_combo, empty_df).reset_index(drop=True)
+            
+    def save_triggers_launches_obs_cancellations(self, param_dfs):
+        '''Packs the trigger, launch, launch and obs and cancellation booleans of every flare for every combination in 
+        param_dfs into the bits of a (combinations, flares) uint8 matrix. The launch rows are matched to flares with the 
+        flare ID -> row map, so there is no search through the flare IDs.
         '''
-        self.score_df.loc[i, 'TN'] = len(np.where((self.all_abovec5==False) & (self.trigger_array==False))[0])
-        self.score_df.loc[i, 'TN_canc'] = len(np.where((self.all_abovec5==False) & (self.canc_array==True))[0])
-        self.score_df.loc[i, 'TP'] = len(np.where((self.all_abovec5==True) & (self.launch_array==True) & (self.obs_array==True))[0])
-        self.score_df.loc[i, 'TP_noc5'] = len(np.where((self.all_abovec5==False) & (self.launch_array==True) & (self.obs_array==True))[0])
-        self.score_df.loc[i, 'FN'] = len(np.where((self.all_abovec5==True) & (self.trigger_array==False))[0])
-        self.score_df.loc[i, 'FN_canc'] = len(np.where((self.all_abovec5==True) & (self.canc_array==True))[0])
-        self.score_df.loc[i, 'FP_c5'] = len(np.where((self.all_abovec5==True) & (self.launch_array==True) & (self.obs_array==False))[0])
-        self.score_df.loc[i, 'FP_noc5'] = len(np.where((self.all_abovec5==False) & (self.launch_array==True) & (self.obs_array==False))[0])
+        outcomes = np.zeros((len(param_dfs), len(self.all_abovec5)), dtype=np.uint8)
+        if len(param_dfs) == 0:
+            return outcomes
+        combo_rows = np.repeat(np.arange(len(param_dfs)), [len(param_df) for param_df in param_dfs])
+        launches = pd.concat(param_dfs, ignore_index=True)
+        if len(launches) == 0:
+            return outcomes
+        flare_rows = self.flare_rows.get_indexer(launches['Flare_ID'])
+        #the LaunchStore's Cancelled? is a nullable boolean, so NA (no check) is filled in before it is used as a mask
+        cancelled = np.array((launches['Cancelled?']==True).fillna(False), dtype=bool)
+        not_cancelled = np.array((launches['Cancelled?']==False).fillna(False), dtype=bool)
+        observed = np.array((launches['Max_FOXSI_and_HiC_C5']==True).fillna(False), dtype=bool)
+        outcomes[combo_rows, flare_rows] |= TRIGGER_BIT
+        np.bitwise_or.at(outcomes, (combo_rows[not_cancelled], flare_rows[not_cancelled]), LAUNCH_BIT)
+        np.bitwise_or.at(outcomes, (combo_rows[not_cancelled & observed], flare_rows[not_cancelled & observed]), OBS_BIT)
+        np.bitwise_or.at(outcomes, (combo_rows[cancelled], flare_rows[cancelled]), CANC_BIT)
+        return outcomes
         
-    def save_scores(self, i):
-        ''' Saves the precision, recal and "trigger-to-launch" and gordon scores from the cf input.
+    def save_cf_input(self, outcomes, c5=None):
+        ''' Counts the values for each box of the 4x2 confusion matrix, for every combination (row) of the outcomes
+        matrix at once. c5 = truth label of every flare (the first label if None).
         '''
-        precision = (self.score_df.loc[i, 'TP'] + self.score_df.loc[i, 'TP_noc5'])/(self.score_df.loc[i, 'TP'] + self.score_df.loc[i, 'TP_noc5'] +  self.score_df.loc[i, 'FP_c5'] + self.score_df.loc[i, 'FP_noc5'])
-        recall = (self.score_df.loc[i, 'TP'])/(self.score_df.loc[i, 'TP']  + self.score_df.loc[i, 'FN'] + self.score_df.loc[i, 'FN_canc'] + self.score_df.loc[i, 'FP_c5'])
-        ttl_score = (self.score_df.loc[i, 'TP'] + self.score_df.loc[i, 'TP_noc5'] + 
-                        self.score_df.loc[i, 'FP_c5'] + self.score_df.loc[i, 'FP_noc5'])/(
-                        self.score_df.loc[i, 'TP'] + self.score_df.loc[i, 'TP_noc5'] +
-                        self.score_df.loc[i, 'FP_c5'] + self.score_df.loc[i, 'FP_noc5'] +
-                        self.score_df.loc[i, 'TN_canc'] + self.score_df.loc[i, 'FN_canc'])
-        gordon_score = (self.score_df.loc[i, 'FP_c5'] + self.score_df.loc[i, 'FP_noc5']) / (self.score_df.loc[i, 'FN_canc']
-                         + self.score_df.loc[i, 'FN'])
-        fbeta = (1.25*precision*recall)/((0.25*precision)+recall) 
-        accuracy = (self.score_df.loc[i, 'TP'] + self.score_df.loc[i, 'TP_noc5'] + self.score_df.loc[i, 'TN'] + self.score_df.loc[i, 'TN_canc'])/len(self.data['flare ID'])
-        self.score_df.loc[i, 'Fbeta'] = fbeta
-        self.score_df.loc[i, 'Precision'] = precision
-        self.score_df.loc[i, 'Recall'] = recall
-        self.score_df.loc[i, 'LaunchTriggerRatio'] = ttl_score
-        self.score_df.loc[i, 'Gordon'] = gordon_score
-        self.score_df.loc[i, 'Accuracy'] = accuracy
+        if c5 is None:
+            c5 = self.all_abovec5
+        trigger = (outcomes & TRIGGER_BIT) > 0
+        launch = (outcomes & LAUNCH_BIT) > 0
+        obs = (outcomes & OBS_BIT) > 0
+        canc = (outcomes & CANC_BIT) > 0
+        return pd.DataFrame({
+                        'TN': np.sum(~c5 & ~trigger, axis=1),
+                        'TN_canc': np.sum(~c5 & canc, axis=1),
+                        'TP': np.sum(c5 & launch & obs, axis=1),
+                        'TP_noc5': np.sum(~c5 & launch & obs, axis=1),
+                        'FN': np.sum(c5 & ~trigger, axis=1),
+                        'FN_canc': np.sum(c5 & canc, axis=1),
+                        'FP_c5': np.sum(c5 & launch & ~obs, axis=1),
+                        'FP_noc5': np.sum(~c5 & launch & ~obs, axis=1)})
         
-    def save_param_combo_values(self, param_df, i):
-        ''' Saves the parameter value for each combination under the correct column name.
+    def save_param_combo_values(self, score_df, batch, param_dfs):
+        ''' Saves the parameter value and units for each combination under the correct column names.
         '''
-        for param_name in self.param_names:
-            param_value = param_df.loc[0, param_name]
-            self.score_df.loc[i, param_name] = param_value
+        for k, param_name in enumerate(self.param_names):
+            if self.launch_store is not None:
+                score_df[param_name] = np.array(self.store_combos.loc[list(batch), param_name])
+            else:
+                score_df[param_name] = [param_df.loc[0, param_name] for param_df in param_dfs]
+            score_df[f'{param_name}_units'] = self.param_units[k]
             
-    def save_score_df(self):
+    def save_score_df(self, label=DEFAULT_LABEL):
         ''' Saves the score_df as a .csv file, with the tag defining which core is being used.
         '''
-        self.score_df.to_csv(os.path.join(self.out_dir, f'parameter_scores{self.tag}.csv'))
+        self.score_df.to_csv(os.path.join(self.out_dir, f'parameter_scores{self.tag}{label_suffix(label)}.csv'))
         print(f'saved dataframe for core {self.tag}')
         
         
@@ -0,0 +1,203 @@
+import numpy as np
+import ast
+import hashlib
+from flare_series import FlareSeries
+
+
+class FeatureExpressionError(ValueError):
+    pass
+
+
+binary_ops = {ast.Add: 'add', ast.Sub: 'sub', ast.Mult: 'mul', ast.Div: 'div', ast.Pow: 'pow'}
+ufuncs = {'add': np.add, 'sub': np.subtract, 'mul': np.multiply, 'div': np.true_divide, 'pow': np.power, 'neg': np.negative,
+            'abs': np.abs, 'log10': np.log10}
+rolling_funcs = {'rolling_mean': 'mean', 'rolling_sum': 'sum', 'rolling_max': 'max', 'rolling_min': 'min'}
+
+
+def parse_expression(text):
+    ''' Parses a feature expression, like '(xrsa - lag(xrsa,3)) / xrsb' or 'rolling_mean(em,3)', into a tree of
+    tuples. Names are light curve channels (FITS columns), and the functions are lag(x,n), lead(x,n), diff(x,n)
+    (= x - lag(x,n)), pct_diff(x,n) (= diff(x,n)/x*100), rolling_mean/sum/max/min(x,n), abs(x) and log10(x).
+
+    The trees are canonical, so the same subexpression is the same tuple wherever it is written: diff and pct_diff are
+    written out in terms of lag, numbers are folded, and the operands of + and * are put in a fixed order.
+    '''
+    try:
+        tree = ast.parse(text.strip(), mode='eval').body
+    except SyntaxError as e:
+        raise FeatureExpressionError(f'Could not parse {text!r}: {e.msg}') from None
+    return make_node(tree, text)
+
+
+def make_node(tree, text):
+    if isinstance(tree, ast.Constant) and isinstance(tree.value, (int, float)) and not isinstance(tree.value, bool):
+        return ('number', float(tree.value))
+    if isinstance(tree, ast.Name):
+        return ('channel', tree.id)
+    if isinstance(tree, ast.UnaryOp) and isinstance(tree.op, (ast.USub, ast.UAdd)):
+        operand = make_node(tree.operand, text)
+        if isinstance(tree.op, ast.UAdd):
+            return operand
+        return ('number', -operand[1]) if operand[0] == 'number' else ('neg', operand)
+    if isinstance(tree, ast.BinOp) and type(tree.op) in binary_ops:
+        return combine(binary_ops[type(tree.op)], make_node(tree.left, text), make_node(tree.right, text))
+    if isinstance(tree, ast.Call) and isinstance(tree.func, ast.Name) and len(tree.keywords) == 0:
+        return make_call(tree.func.id, [make_node(arg, text) for arg in tree.args], text)
+    raise FeatureExpressionError(f'{ast.unparse(tree)!r} is not allowed in a feature expression ({text!r}).')
+
+
+def combine(op, left, right):
+    if left[0] == 'number' and right[0] == 'number':
+        return ('number', float(ufuncs[op](left[1], right[1])))
+    if op in ('add', 'mul') and repr(right) < repr(left): #x*y and y*x are the same subexpression (and the same floats)
+        left, right = right, left
+    return (op, left, right)
+
+
+def window_length(node, func, text):
+    if node[0] != 'number' or node[1] != int(node[1]) or node[1] < 0:
+        raise FeatureExpressionError(f'{func} needs a whole number of samples ({text!r}).')
+    return int(node[1])
+
+
+def make_call(func, args, text):
+    n_args = {'lag': 2, 'lead': 2, 'diff': 2, 'pct_diff': 2, 'abs': 1, 'log10': 1, **{f: 2 for f in rolling_funcs}}
+    if func not in n_args:
+        raise FeatureExpressionError(f'Unknown function {func} in {text!r}.')
+    if len(args) != n_args[func]:
+        raise FeatureExpressionError(f'{func} takes {n_args[func]} arguments ({text!r}).')
+    if func in ('abs', 'log10'):
+        return (func, args[0])
+    x, n = args[0], window_length(args[1], func, text)
+    if func == 'lag':
+        return ('lag', x, n) if n != 0 else x
+    if func == 'lead':
+        return ('lag', x, -n) if n != 0 else x
+    if func == 'diff':
+        return combine('sub', x, ('lag', x, n))
+    if func == 'pct_diff':
+        return combine('mul', combine('div', combine('sub', x, ('lag', x, n)), x), ('number', 100.0))
+    return ('rolling', rolling_funcs[func], x, max(n, 1))
+
+
+def children(node):
+    return [child for child in node[1:] if isinstance(child, tuple)]
+
+
+def node_text(node):
+    ''' Canonical text of a tree, which is the same for any way of writing the same expression. '''
+    kind = node[0]
+    if kind == 'number':
+        return repr(node[1])
+    if kind == 'channel':
+        return node[1]
+    if kind in ('neg', 'abs', 'log10'):
+        return f'{kind}({node_text(node[1])})'
+    if kind == 'lag':
+        return f'lag({node_text(node[1])},{node[2]})'
+    if kind == 'rolling':
+        return f'rolling_{node[1]}({node_text(node[2])},{node[3]})'
+    symbols = {'add': '+', 'sub': '-', 'mul': '*', 'div': '/', 'pow': '**'}
+    return f'({node_text(node[1])}{symbols[kind]}{node_text(node[2])})'
+
+
+def expression_key(text):
+    ''' Short name of an expression for cache files, from a hash of its canonical text. '''
+    return hashlib.sha1(node_text(parse_expression(text)).encode()).hexdigest()[:16]
+
+
+class ExpressionProgram:
+    ''' A set of feature expressions compiled together. Every distinct subexpression (over all the features) is one
+    step, done once in dependency order on the flat FlareSeries buffers, so e.g. lag(xrsa,3) is only made once for
+    every feature that uses it. A step's array is let go as soon as its last user is done, and arithmetic writes into
+    the buffer of an operand that is not needed anymore, so a chain like (a - b)/c*100 only makes one new array.
+
+    Input:
+    expressions = list of expression strings (see parse_expression).
+    '''
+
+    def __init__(self, expressions):
+        self.expressions = list(expressions)
+        self.outputs = [parse_expression(text) for text in self.expressions]
+        self.steps = []
+        self.uses = {}
+        seen = set()
+        for output in self.outputs:
+            self.add_steps(output, seen)
+        for step in self.steps:
+            for child in children(step):
+                self.uses[child] = self.uses.get(child, 0) + 1
+
+    def add_steps(self, node, seen):
+        if node in seen:
+            return
+        for child in children(node):
+            self.add_steps(child, seen)
+        seen.add(node)
+        self.steps.append(node)
+
+    @property
+    def channels(self):
+        return sorted({step[1] for step in self.steps if step[0] == 'channel'})
+
+    def evaluate(self, sources):
+        ''' Returns a FlareSeries for every expression.
+
+        Input:
+        sources = function giving the FlareSeries of a channel name (like FeatureStore.source).
+        '''
+        channel_series = {name: FlareSeries.from_arrays(sources(name)).astype(float) for name in self.channels}
+        if len(channel_series) == 0:
+            raise FeatureExpressionError('A feature expression has to use at least one channel.')
+        template = next(iter(channel_series.values()))
+        for name, series in channel_series.items():
+            if not np.array_equal(series.lengths, template.lengths):
+                raise FeatureExpressionError(f'Channel {name} does not have the same flare lengths as the others.')
+        self.template = template
+        self.shift_indices = {}
+        results = {}
+        owned = set() #steps whose arrays were made here, so they can be written over
+        remaining_uses = dict(self.uses)
+        keep = set(self.outputs)
+        for step in self.steps:
+            kind = step[0]
+            if kind == 'channel':
+                results[step] = channel_series[step[1]].values
+            elif kind == 'number':
+                results[step] = step[1]
+            else:
+                reusable = [child for child in children(step) if child in owned and remaining_uses[child] == 1
+                                and child not in keep]
+                results[step] = self.evaluate_step(step, results, reusable[0] if reusable else None)
+                owned.add(step)
+            for child in children(step):
+                remaining_uses[child] -= 1
+                if remaining_uses[child] == 0 and child not in keep:
+                    del results[child]
+        return [template.with_values(np.broadcast_to(results[output], template.values.shape).copy()
+                        if np.ndim(results[output]) == 0 else results[output]) for output in self.outputs]
+
+    def shift(self, values, n):
+        if n not in self.shift_indices:
+            if n >= 0:
+                self.shift_indices[n] = np.flatnonzero(self.template.sample_index >= n)
+            else:
+                self.shift_indices[n] = np.flatnonzero(np.arange(self.template.n_samples) - n < self.template.flare_ends)
+        keep = self.shift_indices[n]
+        shifted = np.full(len(values), np.nan)
+        shifted[keep] = values[keep - n]
+        return shifted
+
+    def evaluate_step(self, step, results, reusable):
+        kind = step[0]
+        out = results[reusable] if reusable is not None else None
+        if kind in ('add', 'sub', 'mul', 'div', 'pow'):
+            return ufuncs[kind](results[step[1]], results[step[2]], out=out)
+        if kind in ('neg', 'abs', 'log10'):
+            return ufuncs[kind](results[step[1]], out=out)
+        if kind == 'lag':
+            return self.shift(results[step[1]], step[2])
+        if kind == 'rolling':
+            _, func, x, n = step
+            return self.template.with_values(results[x]).rolling(n, func).values
+        raise FeatureExpressionError(f'Unknown step {kind}.')
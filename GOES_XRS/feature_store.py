@@ -0,0 +1,246 @@
+import numpy as np
+from collections import OrderedDict
+import glob
+import os
+from fits_cache import FitsCache
+from flare_series import FlareSeries
+from feature_expressions import ExpressionProgram, expression_key
+
+
+class DerivedFeature:
+    ''' Stand-in for a derived parameter column in the params dict (like features.diff('xrsa', 7)). Nothing is computed
+    until load() is called, and then the FeatureStore gives back the cached column if it was ever made before.
+    '''
+
+    def __init__(self, store, kind, args):
+        self.store = store
+        self.kind = kind
+        self.args = args
+
+    def load(self):
+        return self.store.feature(self.kind, *self.args)
+
+    def __repr__(self):
+        return f"{self.kind}({', '.join(repr(arg) for arg in self.args)})"
+
+
+def load_column(column):
+    ''' FlareSeries of a params dict column, which is either a DerivedFeature or the column itself.
+    '''
+    if isinstance(column, DerivedFeature):
+        return column.load()
+    return FlareSeries.from_arrays(column)
+
+
+def load_columns(columns):
+    ''' load_column for a list of params dict columns. The expression features that are not cached yet are compiled
+    into one ExpressionProgram per store, so subexpressions they have in common are only done once.
+    '''
+    stores = {id(column.store): column.store for column in columns if isinstance(column, DerivedFeature)}
+    for store in stores.values():
+        store.prepare_expressions([column.args[0] for column in columns if isinstance(column, DerivedFeature) 
+                        and column.store is store and column.kind == 'expression'])
+    return [load_column(column) for column in columns]
+
+
+class FeatureStore:
+    ''' Makes derived parameter columns from the flare FITS light curves when they are first asked for, instead of
+    having every lag precomputed into GOES_computed_parameters.fits. The params dict asks for a column with
+    features.diff('xrsa', 7), features.pct_diff('em', 2), features.temp_diff(3), features.temp(), or
+    features.increase() / features.increase_fraction(), which all give a DerivedFeature that is only loaded when the
+    search needs it. features.expression('(xrsa - lag(xrsa,3)) / xrsb') gives any feature written as an expression
+    over the light curve channels (see feature_expressions.py).
+
+    Made columns are kept in two least recently used caches:
+    memory = FlareSeries that were loaded in this process, up to memory_budget bytes.
+    disk = .npy files in cache_dir (by default feature_cache/{FITS file name}/{FITS sha1} next to the FITS file), up to
+        disk_budget bytes. They are memory mapped when loaded, so other runs and worker processes reuse the same files.
+        Every load touches the file, and the files that were not used for the longest are removed first. Since the
+        directory has the FITS file hash in it, a changed FITS file never uses old columns.
+    '''
+
+    def __init__(self, flare_fits, cache_dir=None, memory_budget=2**30, disk_budget=2**34):
+        self.flare_fits = flare_fits
+        self.base_cache_dir = cache_dir
+        self.memory_budget = memory_budget
+        self.disk_budget = disk_budget
+        self.memory = OrderedDict()
+        self.flare_data = None
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def __getstate__(self):
+        #the memory cache and the flare data are not sent to worker processes, they reload from the disk cache
+        state = self.__dict__.copy()
+        state['memory'] = OrderedDict()
+        state['flare_data'] = None
+        return state
+
+    @property
+    def cache_dir(self):
+        fits_cache = FitsCache(self.flare_fits)
+        sha1 = fits_cache.current_manifest()['sha1']
+        base_cache_dir = self.base_cache_dir
+        if base_cache_dir is None:
+            fits_name = os.path.splitext(os.path.basename(self.flare_fits))[0]
+            base_cache_dir = os.path.join(os.path.dirname(self.flare_fits), 'feature_cache', fits_name)
+        return os.path.join(base_cache_dir, sha1[:16])
+
+############### Asking for features ###############################################################################
+
+    def diff(self, name, n):
+        return DerivedFeature(self, 'diff', (name, n))
+
+    def pct_diff(self, name, n):
+        return DerivedFeature(self, 'pct_diff', (name, n))
+
+    def ratio(self, numerator, denominator):
+        return DerivedFeature(self, 'ratio', (numerator, denominator))
+
+    def temp(self):
+        return self.ratio('xrsa', 'xrsb')
+
+    def temp_diff(self, n):
+        return DerivedFeature(self, 'temp_diff', (n,))
+
+    def increase(self):
+        return DerivedFeature(self, 'increase', ())
+
+    def increase_fraction(self):
+        return DerivedFeature(self, 'increase_fraction', ())
+
+    def expression(self, text):
+        expression_key(text) #checks the expression right away, so a typo shows up when the params dict is made
+        return DerivedFeature(self, 'expression', (text,))
+
+############### Making features ###################################################################################
+
+    def source(self, name):
+        ''' Light curve column of the flare FITS file (FlareSeries).
+        '''
+        if self.flare_data is None:
+            self.flare_data = FitsCache(self.flare_fits).load()
+        return self.flare_data[name]
+
+    def compute(self, kind, *args):
+        if kind == 'diff':
+            name, n = args
+            return self.source(name).diff(n)
+        if kind == 'pct_diff':
+            name, n = args
+            return self.source(name).pct_diff(n)
+        if kind == 'ratio':
+            numerator, denominator = args
+            return self.source(numerator).astype(float)/self.source(denominator)
+        if kind == 'temp_diff':
+            n, = args
+            return self.source('xrsa').diff(n)/self.source('xrsb').diff(n)
+        if kind == 'increase':
+            return self.source('xrsb').astype(float) - np.asarray(self.source('background flux'), dtype=float)
+        if kind == 'increase_fraction':
+            background = np.asarray(self.source('background flux'), dtype=float)
+            return (self.source('xrsb').astype(float) - background)/background
+        if kind == 'expression':
+            text, = args
+            return ExpressionProgram([text]).evaluate(self.source)[0]
+        raise ValueError(f'Unknown feature {kind}!')
+
+    @staticmethod
+    def feature_key(kind, *args):
+        if kind == 'expression':
+            return f'expression_{expression_key(args[0])}'
+        return '_'.join([kind] + [str(arg).replace(' ', '-').replace('/', '-') for arg in args])
+
+    def prepare_expressions(self, texts):
+        ''' Makes every expression feature that is not cached yet with one ExpressionProgram, so their common
+        subexpressions are shared, and caches them.
+        '''
+        missing = []
+        for text in dict.fromkeys(texts):
+            key = self.feature_key('expression', text)
+            if key not in self.memory and not os.path.exists(self.feature_files(key)[0]):
+                missing.append(text)
+        if len(missing) == 0:
+            return
+        for text, series in zip(missing, ExpressionProgram(missing).evaluate(self.source)):
+            key = self.feature_key('expression', text)
+            self.misses += 1
+            self.write_to_disk(key, series)
+            series.source = self.feature_source(key)
+            self.remember(key, series)
+
+    def feature(self, kind, *args):
+        ''' Returns the FlareSeries of a feature, from memory, then from disk, and otherwise it is computed and saved
+        in both.
+        '''
+        key = self.feature_key(kind, *args)
+        if key in self.memory:
+            self.hits += 1
+            self.memory.move_to_end(key)
+            return self.memory[key]
+        series = self.read_from_disk(key)
+        if series is not None:
+            self.disk_hits += 1
+        else:
+            self.misses += 1
+            series = self.compute(kind, *args)
+            self.write_to_disk(key, series)
+        series.source = self.feature_source(key)
+        self.remember(key, series)
+        return series
+
+    def feature_source(self, key):
+        ''' FlareSeries.source of a feature: the flare FITS file and sha1 it was made from, and the feature key.
+        '''
+        return (self.flare_fits, FitsCache(self.flare_fits).current_manifest()['sha1'], key)
+
+    def remember(self, key, series):
+        self.memory[key] = series
+        while len(self.memory) > 1 and sum(s.values.nbytes for s in self.memory.values()) > self.memory_budget:
+            self.memory.popitem(last=False)
+
+############### Disk cache ########################################################################################
+
+    def feature_files(self, key):
+        cache_dir = self.cache_dir
+        return os.path.join(cache_dir, f'{key}_values.npy'), os.path.join(cache_dir, f'{key}_offsets.npy')
+
+    def read_from_disk(self, key):
+        values_file, offsets_file = self.feature_files(key)
+        if not (os.path.exists(values_file) and os.path.exists(offsets_file)):
+            return None
+        for feature_file in (values_file, offsets_file):
+            os.utime(feature_file) #marks it as recently used for the disk LRU
+        return FlareSeries(np.asarray(np.load(values_file, mmap_mode='r')), np.load(offsets_file))
+
+    def write_to_disk(self, key, series):
+        values_file, offsets_file = self.feature_files(key)
+        os.makedirs(os.path.dirname(values_file), exist_ok=True)
+        #written under a temporary name and swapped in, so other processes never see half a file
+        for feature_file, arr in ((offsets_file, series.offsets), (values_file, np.asarray(series.values))):
+            temp_file = f'{feature_file}.{os.getpid()}.npy'
+            np.save(temp_file, arr)
+            os.replace(temp_file, feature_file)
+        self.evict_from_disk()
+
+    def evict_from_disk(self):
+        ''' Removes the least recently used features until the disk cache is under disk_budget.
+        '''
+        values_files = glob.glob(os.path.join(self.cache_dir, '*_values.npy'))
+        features = []
+        for values_file in values_files:
+            offsets_file = values_file[:-len('_values.npy')] + '_offsets.npy'
+            try:
+                size = os.path.getsize(values_file) + os.path.getsize(offsets_file)
+                features.append((os.path.getmtime(values_file), size, values_file, offsets_file))
+            except FileNotFoundError: #another process removed it first
+                continue
+        total_size = sum(size for _, size, _, _ in features)
+        for _, size, values_file, offsets_file in sorted(features)[:-1]:
+            if total_size <= self.disk_budget:
+                break
+            for feature_file in (values_file, offsets_file):
+                if os.path.exists(feature_file):
+                    os.remove(feature_file)
+            total_size -= size
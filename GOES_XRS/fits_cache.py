@@ -0,0 +1,170 @@
+import numpy as np
+from astropy.io import fits
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+from flare_series import FlareSeries
+
+
+class CachedColumns:
+    ''' Read-only stand-in for the FITS data/Table, made from the cache. data[name] gives a column (light curve
+    columns are a FlareSeries over the memmapped values, which can be used like the FITS variable length columns), and
+    data[rows] gives the same thing for a subset of the flares. Column names are matched without case, like FITS_rec.
+    '''
+
+    def __init__(self, columns):
+        self.columns = columns
+        self.names = list(columns.keys())
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            if key in self.columns:
+                return self.columns[key]
+            for name in self.names:
+                if name.lower() == key.lower():
+                    return self.columns[name]
+            raise KeyError(key)
+        return CachedColumns({name: column[key] for name, column in self.columns.items()})
+
+    def __len__(self):
+        return len(self.columns[self.names[0]]) if len(self.names) > 0 else 0
+
+    def keys(self):
+        return self.names
+
+
+class FitsCache:
+    ''' One-time conversion of a FITS table into .npy files that are memory mapped on load, so no process has to decode
+    the variable length columns through astropy again.
+
+    Each variable length column is saved as a flat values array and an offsets array ({column #}_values.npy and
+    {column #}_offsets.npy), and every other column as one array ({column #}.npy). The manifest saves the column names
+    and kinds, and a sha1 of the FITS file contents. If the FITS file changes, the cache is rebuilt the next time it is
+    loaded (the hash is only redone when the file size or modification time changed).
+
+    cache_dir = where to save the cache, by default fits_cache/{FITS file name} next to the FITS file.
+    '''
+
+    def __init__(self, fits_file, cache_dir=None):
+        self.fits_file = fits_file
+        if cache_dir is None:
+            fits_name = os.path.splitext(os.path.basename(fits_file))[0]
+            cache_dir = os.path.join(os.path.dirname(fits_file), 'fits_cache', fits_name)
+        self.cache_dir = cache_dir
+        self.manifest_file = os.path.join(cache_dir, 'manifest.json')
+
+    def file_hash(self):
+        file_hash = hashlib.sha1()
+        with open(self.fits_file, 'rb') as f:
+            for chunk in iter(lambda: f.read(2**24), b''):
+                file_hash.update(chunk)
+        return file_hash.hexdigest()
+
+    def read_manifest(self):
+        if not os.path.exists(self.manifest_file):
+            return None
+        with open(self.manifest_file) as f:
+            return json.load(f)
+
+    def is_current(self, manifest):
+        ''' True if the cache was made from the FITS file as it is now.
+        '''
+        if manifest is None:
+            return False
+        stat = os.stat(self.fits_file)
+        if manifest['size'] == stat.st_size and manifest['mtime_ns'] == stat.st_mtime_ns:
+            return True
+        if manifest['size'] == stat.st_size and manifest['sha1'] == self.file_hash():
+            manifest['mtime_ns'] = stat.st_mtime_ns
+            self.write_manifest(manifest)
+            return True
+        return False
+
+    def write_manifest(self, manifest, cache_dir=None):
+        manifest_file = self.manifest_file if cache_dir is None else os.path.join(cache_dir, 'manifest.json')
+        temp_file = f'{manifest_file}.{os.getpid()}'
+        with open(temp_file, 'w') as f:
+            json.dump(manifest, f, indent=1)
+        os.replace(temp_file, manifest_file)
+
+    @staticmethod
+    def native(arr):
+        arr = np.asarray(arr)
+        if arr.dtype.kind == 'S':
+            return np.char.decode(arr)
+        return arr.astype(arr.dtype.newbyteorder('='))
+
+    def build(self):
+        ''' Decodes every column of the FITS table once, and saves it in the cache. Only one process builds at a time
+        ({cache_dir}.lock), and a process that waited for another one's build uses that cache instead of building again.
+        '''
+        os.makedirs(os.path.dirname(os.path.abspath(self.cache_dir)), exist_ok=True)
+        with open(f'{self.cache_dir}.lock', 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX) #released when the file is closed (or the process dies)
+            if self.is_current(self.read_manifest()):
+                return
+            self.build_locked()
+
+    def build_locked(self):
+        print(f'building FITS cache for {self.fits_file}')
+        stat = os.stat(self.fits_file)
+        sha1 = self.file_hash()
+        build_dir = f'{self.cache_dir}.building{os.getpid()}'
+        shutil.rmtree(build_dir, ignore_errors=True) #left over from a build that was killed
+        os.makedirs(build_dir)
+        data = fits.open(self.fits_file)[1].data
+        kinds = {}
+        for c, name in enumerate(data.columns.names):
+            column = data[name]
+            if column.dtype == object:
+                flare_arrays = [self.native(arr) for arr in column]
+                offsets = np.concatenate([[0], np.cumsum([len(arr) for arr in flare_arrays])]).astype(np.int64)
+                values = np.concatenate(flare_arrays) if len(flare_arrays) else np.empty(0)
+                np.save(os.path.join(build_dir, f'{c}_values.npy'), values)
+                np.save(os.path.join(build_dir, f'{c}_offsets.npy'), offsets)
+                kinds[name] = 'ragged'
+            else:
+                np.save(os.path.join(build_dir, f'{c}.npy'), self.native(column))
+                kinds[name] = 'column'
+        self.write_manifest({'fits_file': os.path.basename(self.fits_file), 'sha1': sha1, 'size': stat.st_size,
+                        'mtime_ns': stat.st_mtime_ns, 'names': data.columns.names, 'kinds': kinds}, build_dir)
+        #the finished cache (with its manifest) is swapped in at the end, so a half built cache is never loaded. The old
+        #one is moved out of the way first, and processes that have its files memory mapped can keep using them
+        old_dir = f'{self.cache_dir}.old{os.getpid()}'
+        if os.path.exists(self.cache_dir):
+            os.replace(self.cache_dir, old_dir)
+        os.replace(build_dir, self.cache_dir)
+        shutil.rmtree(old_dir, ignore_errors=True)
+
+    def current_manifest(self):
+        ''' Manifest of the cache, building the cache first if it is missing or out of date.
+        '''
+        manifest = self.read_manifest()
+        if not self.is_current(manifest):
+            self.build()
+            manifest = self.read_manifest()
+        return manifest
+
+    def load(self):
+        ''' Returns the CachedColumns of the FITS table.
+        '''
+        manifest = self.current_manifest()
+        columns = {}
+        for c, name in enumerate(manifest['names']):
+            if manifest['kinds'][name] == 'ragged':
+                columns[name] = FlareSeries(*self.load_ragged(name, manifest), source=(self.fits_file, manifest['sha1'], name))
+            else:
+                columns[name] = np.load(os.path.join(self.cache_dir, f'{c}.npy'), mmap_mode='r')
+        return CachedColumns(columns)
+
+    def load_ragged(self, name, manifest=None):
+        ''' Flat values (memmap) and offsets of one variable length column, for code that works on the flat buffer.
+        '''
+        if manifest is None:
+            manifest = self.current_manifest()
+        c = manifest['names'].index(name)
+        values = np.asarray(np.load(os.path.join(self.cache_dir, f'{c}_values.npy'), mmap_mode='r'))
+        offsets = np.load(os.path.join(self.cache_dir, f'{c}_offsets.npy'))
+        return values, offsets
@@ -0,0 +1,349 @@
+import numpy as np
+
+
+def ragged_arange(starts, lengths):
+    ''' Concatenation of np.arange(start, start + length) for every (start, length) pair.
+    '''
+    segment_offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+    return np.repeat(starts - segment_offsets[:-1], lengths) + np.arange(segment_offsets[-1])
+
+
+def first_true_per_segment(mask, offsets):
+    ''' Finds the first True value of each flare (segment) for every row of a 2D boolean mask over the flat time axis.
+
+    Input:
+    mask = boolean array with shape (rows, total samples).
+    offsets = flare start indices, same as FlareSeries.offsets.
+
+    Returns:
+    (rows, flares) array of the index (within the flare) of the first True value. -1 if there is none.
+    '''
+    mask = np.atleast_2d(mask)
+    lengths = np.diff(offsets)
+    first = np.full((mask.shape[0], len(lengths)), -1, dtype=np.int64)
+    nonempty = np.flatnonzero(lengths > 0)
+    if len(nonempty) == 0:
+        return first
+    n_samples = mask.shape[1]
+    position_dtype = np.int32 if n_samples < np.iinfo(np.int32).max else np.int64
+    position = np.where(mask, np.arange(n_samples, dtype=position_dtype), position_dtype(n_samples))
+    #empty flares are skipped, so each reduceat segment runs right up to the start of the next non-empty flare
+    segment_first = np.minimum.reduceat(position, offsets[nonempty], axis=1)
+    found = segment_first < offsets[nonempty + 1]
+    first[:, nonempty] = np.where(found, segment_first - offsets[nonempty], -1)
+    return first
+
+
+def run_lengths(mask, offsets):
+    ''' For every row of a 2D boolean mask over the flat time axis, how many samples in a row are True up to and 
+    including each sample (0 where it is False). Runs never carry over from one flare (segment) to the next.
+
+    The position of the last False sample before each sample comes from one np.maximum.accumulate along the rows, with 
+    the sample before every flare start counted as False, and the run length is the distance to it.
+    '''
+    mask = np.atleast_2d(mask)
+    position = np.arange(mask.shape[1])
+    last_false = np.where(mask, -1, position)
+    starts = offsets[:-1][np.diff(offsets) > 0] - offsets[0]
+    last_false[:, starts] = np.maximum(last_false[:, starts], starts - 1)
+    np.maximum.accumulate(last_false, axis=1, out=last_false)
+    return position - last_false
+
+
+class FlareSeries:
+    ''' Many flares of different lengths, kept as one flat values array and an offsets array (flare i is
+    values[offsets[i]:offsets[i+1]]), so anything done to every flare is done on the flat array in one go instead of
+    looping through the flares.
+
+    It can be used like the list of per-flare arrays it replaces: len(series) is the number of flares, series[i] is a
+    view of flare i, and looping over it gives the flares. series[rows] (slice, bool mask or index array) gives the
+    FlareSeries of those flares. Arithmetic and comparisons work sample by sample with another FlareSeries of the same
+    flares, a number, or one number per flare (like the background flux).
+
+    source = (FITS file, FITS sha1, column name) of a column that was loaded from the FitsCache or FeatureStore, so
+    things made from the column (like the crossing index) can be saved under it without hashing the values. It is None
+    for anything computed from it.
+    '''
+
+    __array_ufunc__ = None #so numpy arrays on the left hand side hand the arithmetic over to FlareSeries
+
+    def __init__(self, values, offsets, source=None):
+        self.values = values
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.source = source
+
+    @classmethod
+    def from_arrays(cls, flare_arrays, dtype=None):
+        ''' FlareSeries of a list (or FITS/object array) of per-flare arrays. A FlareSeries is given back as it is.
+        '''
+        if isinstance(flare_arrays, cls):
+            return flare_arrays if dtype is None else flare_arrays.astype(dtype)
+        flare_arrays = [np.asarray(arr, dtype=dtype) for arr in flare_arrays]
+        offsets = np.concatenate([[0], np.cumsum([len(arr) for arr in flare_arrays])]).astype(np.int64)
+        values = np.concatenate(flare_arrays) if len(flare_arrays) else np.empty(0, dtype=dtype or float)
+        return cls(values, offsets)
+
+    def with_values(self, values):
+        ''' FlareSeries of new values for the same flares.
+        '''
+        return FlareSeries(values, self.offsets)
+
+    def astype(self, dtype):
+        return self.with_values(np.asarray(self.values, dtype=dtype))
+
+    def to_arrays(self):
+        ''' Object array of per-flare views, like a FITS variable length column (for writing a Table).
+        '''
+        flare_arrays = np.empty(self.n_flares, dtype=object)
+        for i in range(self.n_flares):
+            flare_arrays[i] = self[i]
+        return flare_arrays
+
+############### Shape ##############################################################################################
+
+    @property
+    def n_flares(self):
+        return len(self.offsets) - 1
+
+    @property
+    def n_samples(self):
+        return int(self.offsets[-1] - self.offsets[0])
+
+    @property
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    @property
+    def flare_index(self):
+        ''' Flare # of every sample.
+        '''
+        return np.repeat(np.arange(self.n_flares), self.lengths)
+
+    @property
+    def sample_index(self):
+        ''' Index of every sample within its flare.
+        '''
+        return np.arange(self.n_samples) - np.repeat(self.offsets[:-1] - self.offsets[0], self.lengths)
+
+    @property
+    def flare_ends(self):
+        ''' Flat index of the end of every sample's flare.
+        '''
+        return np.repeat(self.offsets[1:] - self.offsets[0], self.lengths)
+
+    def __len__(self):
+        return self.n_flares
+
+    def __iter__(self):
+        for i in range(self.n_flares):
+            yield self[i]
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, np.integer)):
+            if key < 0:
+                key += self.n_flares
+            return self.values[self.offsets[key]:self.offsets[key+1]]
+        if isinstance(key, slice) and key.step in (None, 1):
+            start, stop, _ = key.indices(self.n_flares)
+            stop = max(start, stop)
+            offsets = self.offsets[start:stop+1]
+            return FlareSeries(self.values[offsets[0]:offsets[-1]], offsets - offsets[0])
+        rows = np.arange(self.n_flares)[key]
+        lengths = self.lengths[rows]
+        samples = ragged_arange(self.offsets[rows], lengths)
+        return FlareSeries(self.values[samples], np.concatenate([[0], np.cumsum(lengths)]))
+
+############### Sample by sample ###################################################################################
+
+    def broadcast(self, other):
+        ''' Flat values of other, lined up with this series' samples.
+        '''
+        if isinstance(other, FlareSeries):
+            if not np.array_equal(other.lengths, self.lengths):
+                raise ValueError('FlareSeries have different flare lengths!')
+            return other.values
+        if np.ndim(other) == 0:
+            return other
+        other = np.asarray(other)
+        if len(other) != self.n_flares:
+            raise ValueError(f'Need one value per flare ({self.n_flares}), got {len(other)}.')
+        return np.repeat(other, self.lengths)
+
+    def __add__(self, other):
+        return self.with_values(self.values + self.broadcast(other))
+
+    def __radd__(self, other):
+        return self.with_values(self.broadcast(other) + self.values)
+
+    def __sub__(self, other):
+        return self.with_values(self.values - self.broadcast(other))
+
+    def __rsub__(self, other):
+        return self.with_values(self.broadcast(other) - self.values)
+
+    def __mul__(self, other):
+        return self.with_values(self.values * self.broadcast(other))
+
+    def __rmul__(self, other):
+        return self.with_values(self.broadcast(other) * self.values)
+
+    def __truediv__(self, other):
+        return self.with_values(self.values / self.broadcast(other))
+
+    def __rtruediv__(self, other):
+        return self.with_values(self.broadcast(other) / self.values)
+
+    def __neg__(self):
+        return self.with_values(-self.values)
+
+    def __gt__(self, other):
+        return self.with_values(self.values > self.broadcast(other))
+
+    def __ge__(self, other):
+        return self.with_values(self.values >= self.broadcast(other))
+
+    def __lt__(self, other):
+        return self.with_values(self.values < self.broadcast(other))
+
+    def __le__(self, other):
+        return self.with_values(self.values <= self.broadcast(other))
+
+    def __and__(self, other):
+        return self.with_values(self.values & self.broadcast(other))
+
+    def __or__(self, other):
+        return self.with_values(self.values | self.broadcast(other))
+
+    def __invert__(self):
+        return self.with_values(~self.values)
+
+    def shift(self, n):
+        ''' Every flare moved n samples later (n < 0 is earlier), with NaN where the flare has no sample to move in.
+        '''
+        values = np.asarray(self.values)
+        if values.dtype.kind != 'f':
+            values = values.astype(float)
+        shifted = np.full(len(values), np.nan, dtype=values.dtype)
+        if n >= 0:
+            keep = np.flatnonzero(self.sample_index >= n)
+        else:
+            keep = np.flatnonzero(np.arange(len(values)) - n < self.flare_ends)
+        shifted[keep] = values[keep - n]
+        return self.with_values(shifted)
+
+    def lag(self, n):
+        ''' Value n samples earlier (NaN for the first n samples of every flare).
+        '''
+        return self.shift(n)
+
+    def lead(self, n):
+        ''' Value n samples later (NaN for the last n samples of every flare).
+        '''
+        return self.shift(-n)
+
+    def diff(self, n):
+        ''' n-sample differences, arr[i] - arr[i-n], NaN for the first n samples of every flare.
+        '''
+        return (self - self.lag(n)).astype(float)
+
+    def pct_diff(self, n):
+        ''' n-sample differences as a % of the current value, (arr[i] - arr[i-n])/arr[i]*100.
+        '''
+        return self.diff(n)/self*100
+
+    def ratio(self, other):
+        return self/other
+
+    def rolling(self, window, func='mean'):
+        ''' func ('sum', 'mean', 'max' or 'min') over the window samples ending at every sample of the same flare.
+        Samples with fewer than window samples before them (in their flare) are NaN.
+        '''
+        combine = {'sum': np.add, 'mean': np.add, 'max': np.maximum, 'min': np.minimum}[func]
+        rolled = self.shift(0).values
+        for k in range(1, window):
+            rolled = combine(rolled, self.shift(k).values)
+        if func == 'mean':
+            rolled = rolled/window
+        return self.with_values(rolled)
+
+    def cummax(self):
+        ''' Running maximum of every flare (NaN ignored, like np.fmax.accumulate). The samples are ranked once, and the
+        flare # is put above the rank, so one np.maximum.accumulate over the flat array restarts at every flare.
+        '''
+        values = np.asarray(self.values, dtype=float)
+        order = np.argsort(values, kind='stable')
+        ranks = np.empty(len(values), dtype=np.int64)
+        ranks[order] = np.arange(len(values))
+        ranks[np.isnan(values)] = -1
+        flare_base = self.flare_index.astype(np.int64) * (len(values) + 1)
+        running = np.maximum.accumulate(flare_base + ranks) - flare_base
+        return self.with_values(np.where(running >= 0, values[order[np.maximum(running, 0)]], np.nan))
+
+############### Per flare ##########################################################################################
+
+    def reduce(self, ufunc, empty=np.nan):
+        ''' ufunc.reduceat over every flare, with empty for flares with no samples.
+        '''
+        values = np.asarray(self.values)
+        reduced = np.full(self.n_flares, empty, dtype=np.result_type(values, type(empty)))
+        nonempty = np.flatnonzero(self.lengths > 0)
+        if len(nonempty) > 0:
+            reduced[nonempty] = ufunc.reduceat(values, self.offsets[nonempty] - self.offsets[0])
+        return reduced
+
+    def max(self):
+        return self.reduce(np.maximum)
+
+    def min(self):
+        return self.reduce(np.minimum)
+
+    def sum(self):
+        return self.reduce(np.add, 0)
+
+    def mean(self):
+        return self.sum()/np.where(self.lengths > 0, self.lengths, np.nan)
+
+    def any(self):
+        return self.reduce(np.logical_or, False).astype(bool)
+
+    def argmax(self):
+        ''' Index (within the flare) of every flare's max, the first one if it is there more than once (or the first
+        NaN, like np.argmax). -1 for empty flares.
+        '''
+        peak = np.repeat(self.max(), self.lengths)
+        values = np.asarray(self.values)
+        return self.first_true((values == peak) | (np.isnan(values) & np.isnan(peak)))
+
+    def run_lengths(self, mask=None):
+        ''' FlareSeries of how many samples in a row mask (or this bool series) has been True, at every sample.
+        '''
+        if mask is None:
+            mask = self
+        if isinstance(mask, FlareSeries):
+            mask = mask.values
+        return self.with_values(run_lengths(np.asarray(mask, dtype=bool)[None, :], self.offsets)[0])
+
+    def longest_run(self, mask=None):
+        ''' Longest run of True samples in every flare (0 for none, or for empty flares).
+        '''
+        return self.run_lengths(mask).reduce(np.maximum, 0)
+
+    def first_true(self, mask=None):
+        ''' Index of the first True sample of every flare (-1 if none), of mask (a FlareSeries or flat array of the same
+        samples), or of this series if it is a bool series.
+        '''
+        if mask is None:
+            mask = self
+        if isinstance(mask, FlareSeries):
+            mask = mask.values
+        return first_true_per_segment(np.asarray(mask, dtype=bool)[None, :], self.offsets - self.offsets[0])[0]
+
+
+def flare_series_columns(parameter_arrays):
+    ''' The parameter arrays as a list of FlareSeries, one per parameter. Takes either that list already, or the older
+    per-flare tuples (one array per parameter for every flare).
+    '''
+    if all(isinstance(column, FlareSeries) for column in parameter_arrays):
+        return list(parameter_arrays)
+    n_params = len(parameter_arrays[0])
+    return [FlareSeries.from_arrays([flare[k] for flare in parameter_arrays]) for k in range(n_params)]
@@ -4,7 +4,114 @@ from astropy.io import fits
 from astropy.table import Table, Column
 from matplotlib import pyplot as plt
 from scipy import stats as st
-import math
+import re
+from fits_cache import FitsCache
+from flare_series import FlareSeries
+
+class DerivedParameterBuilder:
+    ''' Makes the derived parameter columns (lagged differences, % differences, temperature and temperature 
+    differences, increase above background) for any set of lags, straight from the flat FlareSeries buffers. All the 
+    lags of a channel are found in one gather over a (lags, samples) array, and the differences are shared between the 
+    difference, % difference and temp difference columns, so nothing is looped through per flare or per sample.
+    
+    Only the requested columns are made. The column names are the ones already used in the FITS files:
+    'XRSB {n}-min Differences', 'XRSB {n}-min Differences %' (same for XRSA), 'Temp {n}-min Differences', 
+    '{n}-min em diff', '{n}-min em diff %', 'Temperature (xrsa/xrsb)', 'Increase above Background' and 
+    'Increase above Background Fraction'.
+    
+    Input:
+    channels = {'xrsb': ..., 'xrsa': ..., 'em': ...} light curves (FlareSeries or one array per flare), only the ones 
+        the requested columns need.
+    background = background flux of each flare, only needed for the increase above background columns.
+    '''
+    
+    column_patterns = [
+        (re.compile(r'^(XRSB|XRSA) (\d+)-min Differences$'), 'diff'),
+        (re.compile(r'^(XRSB|XRSA) (\d+)-min Differences %$'), 'pct diff'),
+        (re.compile(r'^(em) (\d+)-min diff$'), 'diff'),
+        (re.compile(r'^(em) (\d+)-min diff %$'), 'pct diff'),
+        (re.compile(r'^(Temp) (\d+)-min Differences$'), 'temp diff'),
+        ]
+    fixed_columns = {'Temperature (xrsa/xrsb)': 'temp', 'Increase above Background': 'increase', 
+                    'Increase above Background Fraction': 'increase fraction'}
+    
+    def __init__(self, channels, background=None):
+        self.channels = {name.lower(): FlareSeries.from_arrays(channel) for name, channel in channels.items()}
+        self.background = background
+        
+    @staticmethod
+    def difference_column_names(lags, channels=('xrsb', 'xrsa'), temp_differences=True):
+        ''' Names of the difference, % difference (and temp difference) columns for every lag, in the order 
+        MakingParamArrays has always saved them.
+        '''
+        column_names = []
+        for n in lags:
+            for channel in channels:
+                if channel == 'em':
+                    column_names += [f'{n}-min em diff', f'{n}-min em diff %']
+                else:
+                    column_names += [f'{channel.upper()} {n}-min Differences', f'{channel.upper()} {n}-min Differences %']
+            if temp_differences:
+                column_names.append(f'Temp {n}-min Differences')
+        return column_names
+        
+    def parse_column_name(self, column_name):
+        ''' (kind, channel, lag) of a column name. '''
+        if column_name in self.fixed_columns:
+            return self.fixed_columns[column_name], None, None
+        for pattern, kind in self.column_patterns:
+            #the em names are '{n}-min em diff', so they are turned around to match the same way as the others
+            match = pattern.match(re.sub(r'^(\d+)-min em ', r'em \1-min ', column_name))
+            if match is not None:
+                return kind, match.group(1).lower(), int(match.group(2))
+        raise ValueError(f'Do not know how to make the column {column_name}!')
+        
+    def lagged_differences(self, channel, lags):
+        ''' Dictionary of arr[i] - arr[i-n] for every lag n (NaN for the first n samples of each flare), all from one 
+        (lags, samples) gather. The subtraction is done in the column's own dtype, like slicing each flare.
+        '''
+        series = self.channels[channel]
+        values = np.asarray(series.values)
+        lags = np.array(sorted(lags), dtype=np.int64)[:, None]
+        earlier = np.arange(series.n_samples) - lags
+        has_earlier = series.sample_index >= lags
+        differences = np.full(earlier.shape, np.nan, dtype=values.dtype if values.dtype.kind == 'f' else float)
+        differences[has_earlier] = np.broadcast_to(values, earlier.shape)[has_earlier] - values[earlier[has_earlier]]
+        return {n: series.with_values(differences[k].astype(float)) for k, n in enumerate(lags[:, 0])}
+        
+    def build(self, column_names):
+        ''' Returns {column name: FlareSeries} of only the requested columns. '''
+        recipes = {column_name: self.parse_column_name(column_name) for column_name in column_names}
+        needed_lags = {}
+        for kind, channel, n in recipes.values():
+            for needed_channel in (('xrsa', 'xrsb') if kind == 'temp diff' else (channel,)):
+                if n is not None:
+                    needed_lags.setdefault(needed_channel, set()).add(n)
+        differences = {channel: self.lagged_differences(channel, lags) for channel, lags in needed_lags.items()}
+        columns = {}
+        for column_name, (kind, channel, n) in recipes.items():
+            if kind == 'diff':
+                columns[column_name] = differences[channel][n]
+            elif kind == 'pct diff':
+                columns[column_name] = differences[channel][n]/self.channels[channel]*100
+            elif kind == 'temp diff':
+                columns[column_name] = differences['xrsa'][n]/differences['xrsb'][n]
+            elif kind == 'temp':
+                columns[column_name] = self.channels['xrsa']/self.channels['xrsb']
+            elif kind == 'increase':
+                columns[column_name] = self.channels['xrsb'] - self.background
+            elif kind == 'increase fraction':
+                columns[column_name] = (self.channels['xrsb'] - self.background)/self.background
+        return columns
+        
+        
+def find_c5_10min_bool(xrsb, c5_thresh=5e-6, minutes=10):
+    ''' True for every flare that is above c5_thresh for at least minutes samples in a row (a rolling sum of the 
+    above C5 samples reaching minutes, the same as the np.convolve 'valid' check), for all flares at once.
+    '''
+    above_c5 = FlareSeries.from_arrays(xrsb) > c5_thresh
+    return (above_c5.astype(float).rolling(minutes, 'sum') >= minutes).any()
+
 
 class MakingParamArrays:
     
@@ -15,111 +122,61 @@ class MakingParamArrays:
     diff_column_names = []
     
     def __init__(self):
-        fitsfile = fits.open(self.flare_fits)
-        self.data = Table(fitsfile[1].data)[:]
-        self.header = fitsfile[1].header
+        self.data = FitsCache(self.flare_fits).load()
         self.xrsb = self.data['xrsb'][:]
         self.xrsa = self.data['xrsa'][:]
+        self.builder = DerivedParameterBuilder({'xrsb': self.xrsb, 'xrsa': self.xrsa}, background=self.data['background flux'][:])
+        
+    def save_columns(self, column_names):
+        ''' Makes only the requested columns with the DerivedParameterBuilder and adds them to the table columns. '''
+        built = self.builder.build(column_names)
+        for column_name in column_names:
+            self.columns.append(built[column_name])
+            self.column_names.append(column_name)
         
     def save_xrsb_rise_above_background(self):
-        bk = self.data['background flux'][:]
-        self.increase = self.xrsb - bk
-        self.increase_pct = (self.xrsb-bk)/bk
-        self.columns.append(self.increase)
-        self.columns.append(self.increase_pct)
-        self.column_names.append('Increase above Background')
-        self.column_names.append('Increase above Background Fraction')
+        self.save_columns(['Increase above Background', 'Increase above Background Fraction'])
     
     def save_differences_between_further_points(self, n):
-        diff_xrsb_list = []
-        diff_xrsb_pct_list = []
-        for arr in self.xrsb:
-            diff_xrsb = arr[n:] - arr[:-n]
-            diff_xrsb = np.concatenate([np.full(n, math.nan), diff_xrsb]) #appending the right amount of zeros to front to make the indices correct
-            diff_xrsb_list.append(diff_xrsb)
-            diff_xrsb_pct = []
-            for i, diffy in enumerate(diff_xrsb):
-                diff_xrsb_pct.append(diffy/arr[i]*100)
-            diff_xrsb_pct_list.append(diff_xrsb_pct)
-        self.columns.append(diff_xrsb_list)
-        self.column_names.append(f'XRSB {n}-min Differences')
-        self.columns.append(diff_xrsb_pct_list)
-        self.column_names.append(f'XRSB {n}-min Differences %')
-        diff_xrsa_list = []
-        diff_xrsa_pct_list = []
-        for arr in self.xrsa:
-            diff_xrsa = arr[n:] - arr[:-n]
-            diff_xrsa = np.concatenate([np.full(n, math.nan), diff_xrsa])
-            diff_xrsa_list.append(diff_xrsa)
-            diff_xrsa_pct = []
-            for i, diffy in enumerate(diff_xrsa):
-                diff_xrsa_pct.append(diffy/arr[i]*100)
-            diff_xrsa_pct_list.append(diff_xrsa_pct)
-        self.columns.append(diff_xrsa_list)
-        self.column_names.append(f'XRSA {n}-min Differences')
-        self.columns.append(diff_xrsa_pct_list)
-        self.column_names.append(f'XRSA {n}-min Differences %')
-        #also doing temp differences:
-        temp_diff_list = []
-        for i, arr in enumerate(diff_xrsa_list):
-            temp = arr/diff_xrsb_list[i]
-            temp_diff_list.append(temp)
-        self.columns.append(temp_diff_list)
-        self.column_names.append(f'Temp {n}-min Differences')
+        self.save_derived_parameters([n])
+        
+    def save_derived_parameters(self, lags):
+        ''' XRSB and XRSA differences and % differences, and temp differences, for every lag in one pass. '''
+        self.save_columns(DerivedParameterBuilder.difference_column_names(lags))
         
     def save_temp(self):
-        temp = self.xrsa/self.xrsb
-        self.columns.append(temp)
-        self.column_names.append('Temperature (xrsa/xrsb)')
+        self.save_columns(['Temperature (xrsa/xrsb)'])
         
     def make_table(self):
-        self.t = Table(self.columns, names=self.column_names)
+        self.t = Table([column.to_arrays() if isinstance(column, FlareSeries) else column for column in self.columns], 
+                        names=self.column_names)
         print(self.t.info)
         self.t.write('GOES_computed_parameters.fits', overwrite=True)
 
        
-def add_c5_10min_bool_and_em():
+def add_c5_10min_bool_and_em(lags=(1, 2, 3, 4, 5)):
     ''' adding function to add on the C5 flux for 10 min or longer bool. This is what we will use for the true/false
     in the new ROC curves for deciding if the flare is viable or not. (will change the C5 to C5 10 min or longer)
+    The em differences are made with the DerivedParameterBuilder, for every lag at once.
     '''
     flare_fits = 'GOES_XRS_historical_testerem.fits'
     fitsfile = fits.open(flare_fits)
     data = Table(fitsfile[1].data)[:]
     print(data.columns)
     header = fitsfile[1].header
-    xrsb = data['xrsb'][:]
-    
-    c5_10min_bool_list = []
-    c5_thresh = 5e-6
-    minutes = 10
-    for flare in xrsb:
-        above_c5_arr = np.flatnonzero(np.convolve(flare>c5_thresh, np.ones(minutes, dtype=int),'valid')>=minutes)
-        if len(above_c5_arr) > 0:
-            c5_10min_bool_list.append(True)
-        else:
-            c5_10min_bool_list.append(False)
+    
+    c5_10min_bool_list = find_c5_10min_bool(data['xrsb'], c5_thresh=5e-6, minutes=10)
     
     #adding column to fits: 
     data.add_column(c5_10min_bool_list, name='above C5 10min', index=9)
     print(data.columns)
     #data.write('GOES_XRS_historical_finalversion.fits', overwrite=True)
     
-    em = data['em'][:]
-    
-    for n in [1,2,3,4,5]:
-        diff_em_list = []
-        diff_em_pct_list = []
-        for arr in em:
-            diff_em = arr[n:] - arr[:-n]
-            diff_em = np.concatenate([np.full(n, math.nan), diff_em]) #appending the right amount of zeros to front to make the indices correct
-            diff_em_list.append(diff_em)
-            diff_em_pct = []
-            for i, diffy in enumerate(diff_em):
-                diff_em_pct.append(diffy/arr[i]*100)
-            diff_em_pct_list.append(diff_em_pct)
-        data.add_column(diff_em_list, name=f'{n}-min em diff')
-        data.add_column(diff_em_pct_list, name=f'{n}-min em diff %')
-        print(data.columns)
+    em_columns = DerivedParameterBuilder({'em': data['em']}).build(
+                    DerivedParameterBuilder.difference_column_names(lags, channels=('em',), temp_differences=False))
+    for column_name, column in em_columns.items():
+        data.add_column(column.to_arrays(), name=column_name)
+    print(data.columns)
     data.write('GOES_XRS_historical_finalversion.fits', overwrite=True)
     
 # def add_em_differences(n):
@@ -167,16 +224,8 @@ if __name__ == '__main__':
     # print('increase done')
     # t.save_temp()
     # print('temp done')
-    # t.save_differences_between_further_points(1)
-    # print('1 min done')
-    # t.save_differences_between_further_points(2)
-    # print('2 min done')
-    # t.save_differences_between_further_points(3)
-    # print('3 min done')
-    # t.save_differences_between_further_points(4)
-    # print('4 min done')
-    # t.save_differences_between_further_points(5)
-    # print('5 min done')
+    # t.save_derived_parameters([1, 2, 3, 4, 5]) #every lag in one pass, any lags can be used
+    # print('differences done')
     # t.make_table()
     # print('fits saved')
     ''' Uncomment this for adding the C5 for 10min or longer bool to the original .fits file